@@ -1,9 +1,88 @@
-from flask import Flask, jsonify, request
-from storage import get_valid_snapshots, get_discarded_snapshots
+from flask import Flask, Response, g, jsonify, request
+from storage import (get_valid_snapshots, get_discarded_snapshots, get_snapshots_json, builds_json,
+                     iter_valid_snapshots, iter_discarded_snapshots, iter_valid_batches,
+                     get_aggregated_snapshots, add_write_listener, VALID, DISCARDED)
+from serialization import JSONProvider, encode_rows, encode_array
+from cache import ResponseCache, naive
+from rollups import BUCKETS
+from validation import DISCARD_REASONS
+from export import FORMATS, available, generate_export
+from feed import broker, publish_rows, FeedFull
+from hot_window import hot_window
+from metrics import Gauge, request_latency, response_size, render_metrics
+from database import check_db
+from config import (API_MAX_LIMIT, API_DEFAULT_LIMIT, STREAM_CHUNK_ROWS, API_HOST, API_PORT,
+                    FEED_HEARTBEAT, API_DATABASE_JSON)
 from datetime import datetime
+import base64
+import binascii
 import logging
+import time
 
 app = Flask(__name__)
+# orjson when it is installed, the stdlib json module otherwise
+app.json = JSONProvider(app)
+
+# e.g. "'age', 'range', 'suspect' or 'system'" for error messages
+REASONS_TEXT = ', '.join(f"'{reason}'" for reason in DISCARD_REASONS[:-1]) + f" or '{DISCARD_REASONS[-1]}'"
+
+# Serialized responses for recently requested windows
+response_cache = ResponseCache()
+
+# Drop cached windows that newly saved snapshots fall inside
+def invalidate_cache(valid_rows, discarded_rows):
+    response_cache.invalidate(VALID, [row[1] for row in valid_rows])
+    response_cache.invalidate(DISCARDED, [row[1] for row in discarded_rows])
+
+add_write_listener(invalidate_cache)
+
+# Push snapshots saved in this process to live feed subscribers
+add_write_listener(publish_rows)
+
+# Keep the hot window up to date with snapshots saved in this process
+add_write_listener(hot_window.add)
+
+# Snapshots saved by the ingest process, received by API workers through
+# LISTEN/NOTIFY, expire cached windows, go to live feed subscribers and
+# are added to the hot window
+def on_remote_write(valid_rows, discarded_rows):
+    invalidate_cache(valid_rows, discarded_rows)
+    publish_rows(valid_rows, discarded_rows)
+    hot_window.add(valid_rows, discarded_rows)
+
+# Called after a notification that left out saved snapshots. Any cached
+# page could be stale and the hot window is missing rows, so both are
+# rebuilt. Live feed subscribers aren't told about the rows
+def on_remote_missed():
+    response_cache.clear()
+    hot_window.start()
+
+# Cache counters, read when /metrics is scraped
+Gauge('api_cache_hits', 'Response cache hits', lambda: response_cache.hits)
+Gauge('api_cache_misses', 'Response cache misses', lambda: response_cache.misses)
+Gauge('api_cache_evictions', 'Response cache evictions', lambda: response_cache.evictions)
+Gauge('api_cache_invalidations', 'Response cache entries invalidated by writes',
+      lambda: response_cache.invalidations)
+Gauge('api_cache_bytes', 'Bytes of response bodies in the cache', response_cache.size)
+Gauge('api_cache_too_large', 'Responses too large to cache', lambda: response_cache.too_large)
+
+# Time every request
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+# Record latency and response size per route
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.labels(route).observe(time.perf_counter() - started)
+
+        # Streamed responses have no length up front
+        if response.content_length is not None:
+            response_size.labels(route).observe(response.content_length)
+    return response
 
 # Validates ISO format
 def datetime_valid(dt_str):
@@ -45,18 +124,169 @@ def set_times(start_time, end_time):
     logging.debug(f'Start type: {type(start)}, End type: {type(end)}')
     return [start, end]
 
+# Cursors are the (time, id) of the last row on a page, encoded so clients
+# treat them as opaque
+def encode_cursor(time, id):
+    raw = f"{time.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        time_str, id_str = raw.split('|')
+        return (datetime.fromisoformat(time_str), int(id_str))
+    except (ValueError, binascii.Error, UnicodeError):
+        return None
+
+# Helper function to validate limit and cursor pagination parameters
+# returns [limit, after] for database querying, with 'default' as the
+# limit when none is given
+def set_page(limit_str, cursor, default=None):
+    limit = default or None
+    if limit_str:
+        if not limit_str.isdigit() or not 0 < int(limit_str) <= API_MAX_LIMIT:
+            logging.error(f'Invalid limit value: {limit_str}')
+            return jsonify({'error': f"'limit' must be a whole number between 1 and {API_MAX_LIMIT}"}), 400
+        limit = int(limit_str)
+
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            logging.error(f'Invalid cursor value: {cursor}')
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    return [limit, after]
+
+# Helper function to validate tag, tags_any and tags_all parameters, the
+# last two take comma separated tags. Returns [tags_all, tags_any] as
+# tuples, or None when not given, for database querying
+def set_tags(tag, tags_any, tags_all):
+    parsed = {}
+    for name, value in (('tags_any', tags_any), ('tags_all', tags_all)):
+        if value is None:
+            parsed[name] = ()
+            continue
+
+        tags = tuple(sorted({part.strip() for part in value.split(',') if part.strip()}))
+        if not tags:
+            logging.error(f'Invalid {name} value: {value}')
+            return jsonify({'error': f"'{name}' must be a comma separated list of tags"}), 400
+        parsed[name] = tags
+
+    if tag is not None:
+        if not tag.strip():
+            logging.error(f'Invalid tag value: {tag}')
+            return jsonify({'error': "'tag' must not be empty"}), 400
+        # A single tag is the same as requiring it with tags_all
+        parsed['tags_all'] = tuple(sorted(set(parsed['tags_all']) | {tag.strip()}))
+
+    return [parsed['tags_all'] or None, parsed['tags_any'] or None]
+
+# Reads a page and returns (body, headers), with the cursor for the next
+# page in the X-Next-Cursor header when the page is full. Recent rows come
+# from the hot window and older ones from the database. Rows are encoded
+# straight from the query's tuples, or by Postgres with API_DATABASE_JSON
+# when the backend is Postgres and the window holds none of the page
+def read_page(table, times, filters, page):
+    limit, after = page
+    headers = {}
+
+    if API_DATABASE_JSON and builds_json() and not hot_window.holds(table, times[1]):
+        body, count, last = get_snapshots_json(table, times[0], times[1], limit, after, *filters)
+        if limit and count == limit:
+            headers['X-Next-Cursor'] = encode_cursor(*last)
+        return body.encode(), headers
+
+    def read_db(start, end, limit, after):
+        if table == VALID:
+            return get_valid_snapshots(start, end, limit, after, *filters[1:])
+        return get_discarded_snapshots(start, end, filters[0], limit, after, *filters[1:])
+
+    rows = hot_window.read(table, times[0], times[1], limit, after, filters, read_db)
+
+    if limit and len(rows) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(rows[-1][1], rows[-1][0])
+    return encode_array(table, rows), headers
+
+# Returns a page from the response cache, reading it on a miss. 'filters'
+# is (reason, tags_all, tags_any). Responses carry an ETag so unchanged
+# windows can be answered with a 304
+def cached_page(table, times, filters, page):
+    key = (table, naive(times[0]), naive(times[1]), filters, page[0], page[1])
+
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation()
+        body, headers = read_page(table, times, filters, page)
+        entry = response_cache.put(key, body, headers, table, times[0], times[1], generation)
+
+    response = app.response_class(entry.body, mimetype='application/json', headers=entry.headers)
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+NDJSON = 'application/x-ndjson'
+
+# True when the client prefers NDJSON over plain JSON
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+# Streaming is used when asked for with stream=true, or for NDJSON clients
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('true', '1') or wants_ndjson()
+
+# Streams snapshots as they are read from the database instead of building
+# the whole response in memory. Writes a JSON array, or one object per line
+# for NDJSON clients. Rows are encoded and sent in chunks of STREAM_CHUNK_ROWS
+def stream_response(kind, rows):
+    ndjson = wants_ndjson()
+    separator = '\n' if ndjson else ','
+
+    # Encodes a chunk of rows, with a comma before all but the first in a JSON array
+    def encode_chunk(chunk, first):
+        if not chunk:
+            return ''
+        text = separator.join(encode_rows(kind, chunk))
+        if ndjson:
+            return text + '\n'
+        return text if first else ',' + text
+
+    def generate():
+        # Send the opening bracket before the query runs so the first
+        # byte goes out straight away
+        if not ndjson:
+            yield '['
+
+        chunk = []
+        first = True
+        try:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield encode_chunk(chunk, first)
+                    chunk = []
+                    first = False
+        except Exception as e:
+            # Headers are already sent, so the body is left incomplete
+            logging.error(f'Error while streaming response: {e}')
+            raise
+
+        yield encode_chunk(chunk, first) + ('' if ndjson else ']')
+
+    return Response(generate(), mimetype=NDJSON if ndjson else 'application/json')
+
 # GET/ Returns all valid snapshots, optional start and end time parameters
 @app.route('/snapshots')
 def get_snapshots():
     try:
         # First check start and end parameters, if they exist
-        valid_params = {'start', 'end'}
+        valid_params = {'start', 'end', 'limit', 'cursor', 'stream', 'tag', 'tags_any', 'tags_all'}
         params = set(request.args.keys())
         unknown_params = params - valid_params
 
         if unknown_params:
             logging.error(f'Invalid parameters: {unknown_params}')
-            return jsonify({'error': "Invalid parameters, only 'start' or 'end' accepted"}), 400
+            return jsonify({'error': "Invalid parameters, only 'start', 'end', 'limit', 'cursor', 'stream', 'tag', 'tags_any' or 'tags_all' accepted"}), 400
 
         start_time = request.args.get('start')
         end_time = request.args.get('end')
@@ -67,33 +297,185 @@ def get_snapshots():
         if not isinstance(times, list):
             return times
         
-        valid_snapshots = get_valid_snapshots(times[0], times[1])
-        return jsonify(valid_snapshots)
+        # Validate and set page size and position. Pages that aren't
+        # streamed have API_DEFAULT_LIMIT rows when no limit is given
+        stream = wants_stream()
+        page = set_page(request.args.get('limit'), request.args.get('cursor'),
+                        None if stream else API_DEFAULT_LIMIT)
+        if not isinstance(page, list):
+            return page
+
+        # Validate and set tag filters
+        tags = set_tags(request.args.get('tag'), request.args.get('tags_any'), request.args.get('tags_all'))
+        if not isinstance(tags, list):
+            return tags
+
+        if stream:
+            return stream_response(VALID, iter_valid_snapshots(times[0], times[1], page[0], page[1], *tags))
+
+        return cached_page(VALID, times, (None, *tags), page)
     
     except Exception as e:
         logging.error(f'Server error: {e}')
         return jsonify({'error': f'Server error: {e}'}), 500
 
+# GET/ Streams valid snapshots as a Parquet file, an Arrow IPC stream or CSV,
+# optional start/end/format parameters
+@app.route('/snapshots/export')
+def export_snapshots():
+    try:
+        # First check parameters are correct, if they exist
+        valid_params = {'start', 'end', 'format'}
+        params = set(request.args.keys())
+        unknown_params = params - valid_params
+
+        if unknown_params:
+            logging.error(f'Invalid parameters: {unknown_params}')
+            return jsonify({'error': "Invalid parameters, only 'start', 'end' or 'format' accepted"}), 400
+
+        export_format = request.args.get('format', 'parquet')
+        if export_format not in FORMATS:
+            logging.error(f'Invalid format value: {export_format}')
+            return jsonify({'error': "Invalid 'format' value. Only 'parquet', 'arrow' or 'csv' accepted"}), 400
+
+        if not available(export_format):
+            logging.error(f'Export format unavailable, pyarrow is not installed: {export_format}')
+            return jsonify({'error': f"'{export_format}' export is not available on this server"}), 501
+
+        # Validate and set start/end times
+        times = set_times(request.args.get('start'), request.args.get('end'))
+
+        # If not a list then return the error message
+        if not isinstance(times, list):
+            return times
+
+        body = generate_export(iter_valid_batches(times[0], times[1]), export_format)
+        return Response(body, mimetype=FORMATS[export_format], headers={
+            'Content-Disposition': f'attachment; filename=snapshots.{export_format}'
+        })
+
+    except Exception as e:
+        logging.error(f'Server error: {e}')
+        return jsonify({'error': f'Server error: {e}'}), 500
+
+FEED_KINDS = {
+    'valid': (VALID,),
+    'discarded': (DISCARDED,),
+    'all': (VALID, DISCARDED)
+}
+
+# GET/ Pushes snapshots to the client as Server-Sent Events as they are saved,
+# optional kind/tag/tags_any/tags_all parameters
+@app.route('/snapshots/stream')
+def stream_snapshots():
+    try:
+        # First check parameters are correct, if they exist
+        valid_params = {'kind', 'tag', 'tags_any', 'tags_all'}
+        params = set(request.args.keys())
+        unknown_params = params - valid_params
+
+        if unknown_params:
+            logging.error(f'Invalid parameters: {unknown_params}')
+            return jsonify({'error': "Invalid parameters, only 'kind', 'tag', 'tags_any' or 'tags_all' accepted"}), 400
+
+        kind = request.args.get('kind', 'valid')
+        if kind not in FEED_KINDS:
+            logging.error(f'Invalid kind value: {kind}')
+            return jsonify({'error': "Invalid 'kind' value. Only 'valid', 'discarded' or 'all' accepted"}), 400
+
+        # Validate and set tag filters
+        tags = set_tags(request.args.get('tag'), request.args.get('tags_any'), request.args.get('tags_all'))
+        if not isinstance(tags, list):
+            return tags
+
+        subscription = broker.subscribe(FEED_KINDS[kind], *tags)
+
+    except FeedFull as e:
+        logging.warning(f'Live feed subscription refused: {e}')
+        return jsonify({'error': 'Too many live feed subscribers, try again later'}), 503
+
+    except Exception as e:
+        logging.error(f'Server error: {e}')
+        return jsonify({'error': f'Server error: {e}'}), 500
+
+    def generate():
+        try:
+            # Sent straight away so the client sees the stream is open
+            yield ': connected\n\n'
+
+            # Ends when the client disconnects (the next write fails) or when
+            # it falls too far behind and the broker drops it
+            while not subscription.dropped:
+                events = subscription.get_batch(FEED_HEARTBEAT)
+                if subscription.dropped:
+                    break
+                if not events:
+                    # Keep-alive comment, also detects clients that have gone away
+                    yield ': keep-alive\n\n'
+                    continue
+                yield ''.join(event.message for event in events)
+
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# GET/ Returns min/max/avg of valid snapshots per time bucket,
+# optional start/end/tag parameters
+@app.route('/snapshots/aggregate')
+def get_aggregate():
+    try:
+        # First check parameters are correct, if they exist
+        valid_params = {'start', 'end', 'bucket', 'tag'}
+        params = set(request.args.keys())
+        unknown_params = params - valid_params
+
+        if unknown_params:
+            logging.error(f'Invalid parameters: {unknown_params}')
+            return jsonify({'error': "Invalid parameters, only 'start', 'end', 'bucket' or 'tag' accepted"}), 400
+
+        bucket = request.args.get('bucket')
+        if bucket not in BUCKETS:
+            logging.error(f'Invalid bucket value: {bucket}')
+            return jsonify({'error': "Invalid 'bucket' value. Only '1m', '1h' or '1d' accepted"}), 400
+
+        # Validate and set start/end times
+        times = set_times(request.args.get('start'), request.args.get('end'))
+
+        # If not a list then return the error message
+        if not isinstance(times, list):
+            return times
+
+        aggregates = get_aggregated_snapshots(bucket, times[0], times[1], request.args.get('tag'))
+        return jsonify(aggregates)
+
+    except Exception as e:
+        logging.error(f'Server error: {e}')
+        return jsonify({'error': f'Server error: {e}'}), 500
+
 # GET/ Returns all discarded snapshots, optional start/end/reason parameters
 @app.route('/discarded')
 def get_discarded():
     try:
         # First check parameters are correct, if they exist
-        valid_params = {'start', 'end', 'reason'}
+        valid_params = {'start', 'end', 'reason', 'limit', 'cursor', 'stream', 'tag', 'tags_any', 'tags_all'}
         params = set(request.args.keys())
         unknown_params = params - valid_params
 
         if unknown_params:
             logging.error(f'Invalid parameters: {unknown_params}')
-            return jsonify({'error': "Invalid parameters, only 'start', 'end' or 'reason' accepted"}), 400
+            return jsonify({'error': "Invalid parameters, only 'start', 'end', 'reason', 'limit', 'cursor', 'stream', 'tag', 'tags_any' or 'tags_all' accepted"}), 400
 
         start_time = request.args.get('start')
         end_time = request.args.get('end')
         reason = request.args.get('reason')
 
-        if reason and reason not in ['age', 'suspect', 'system']:
+        if reason and reason not in DISCARD_REASONS:
             logging.error(f'Invalid reason value: {reason}')
-            return jsonify({'error': "Invalid 'reason' value. Only 'age', 'suspect' or 'system' accepted"}), 400
+            return jsonify({'error': f"Invalid 'reason' value. Only {REASONS_TEXT} accepted"}), 400
         
         # Validate and set start/end times
         times = set_times(start_time, end_time)
@@ -102,12 +484,49 @@ def get_discarded():
         if not isinstance(times, list):
             return times        
         
-        discarded_snapshots = get_discarded_snapshots(times[0], times[1], reason)
-        return jsonify(discarded_snapshots)
+        # Validate and set page size and position. Pages that aren't
+        # streamed have API_DEFAULT_LIMIT rows when no limit is given
+        stream = wants_stream()
+        page = set_page(request.args.get('limit'), request.args.get('cursor'),
+                        None if stream else API_DEFAULT_LIMIT)
+        if not isinstance(page, list):
+            return page
+
+        # Validate and set tag filters
+        tags = set_tags(request.args.get('tag'), request.args.get('tags_any'), request.args.get('tags_all'))
+        if not isinstance(tags, list):
+            return tags
+
+        if stream:
+            return stream_response(DISCARDED, iter_discarded_snapshots(times[0], times[1], reason, page[0], page[1], *tags))
+
+        return cached_page(DISCARDED, times, (reason, *tags), page)
     
     except Exception as e:
         logging.error(f'Server error: {e}')
         return jsonify({'error': f'Server error: {e}'}), 500
     
-def start_api():
-    app.run(port=8080, use_reloader=False, threaded=True)
\ No newline at end of file
+# GET/ Returns 200 when the API and its database are usable, 503 otherwise
+@app.route('/health')
+def get_health():
+    if not check_db():
+        return jsonify({'status': 'unavailable', 'database': 'unreachable'}), 503
+    return jsonify({'status': 'ok', 'database': 'ok'})
+
+# GET/ Returns counters and histograms in Prometheus text format
+@app.route('/metrics')
+def get_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# GET/ Returns response cache counters for sizing the cache
+@app.route('/cache/stats')
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+# Runs Flask's development server, see server.py for production serving.
+# 'hot' loads the hot window first, for an API in a process that is told
+# about every saved snapshot through its write listeners
+def start_api(hot=False):
+    if hot:
+        hot_window.start()
+    app.run(host=API_HOST, port=API_PORT, use_reloader=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,17 @@
+from config import DB_BACKEND
+
+BACKENDS = ('postgres', 'sqlite', 'memory')
+
+# Creates the storage backend called 'name'. Each is imported only when
+# chosen, so the others' drivers and settings aren't needed
+def create_backend(name=DB_BACKEND):
+    if name == 'postgres':
+        from backends.postgres import PostgresBackend
+        return PostgresBackend()
+    if name == 'sqlite':
+        from backends.sqlite import SQLiteBackend
+        return SQLiteBackend()
+    if name == 'memory':
+        from backends.memory import MemoryBackend
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend '{name}', expected one of {', '.join(BACKENDS)}")
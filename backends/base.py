@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+from rollups import bucket_start
+from config import STREAM_ITERSIZE, RETENTION_DAYS
+
+VALID = 'valid'
+DISCARDED = 'discarded'
+
+# Interface every storage backend implements. Valid rows are written as
+# (time, value, tags, source) and discarded rows as (time, value, tags,
+# reason, discarded_at, source). Both are read back with their id in front
+# and without the source, which is only part of the unique key. Reads are
+# ordered by (time, id) so 'after' can be the (time, id) of the last row of
+# the previous page
+class Backend:
+    name = None
+    # Other processes see what this one writes, so the API and ingest can
+    # run as separate processes
+    shared = True
+    # Saved snapshots can be announced to other processes with NOTIFY
+    notifies = False
+    # Pages can be read as JSON built by the database, see get_snapshots_json
+    builds_json = False
+
+    # Opens connections and, unless create is False, creates the tables.
+    # API worker processes pass create=False as tables are made before they fork
+    def init(self, create=True):
+        pass
+
+    def close(self):
+        pass
+
+    # Brings tables made by earlier versions up to date. Changes that delete
+    # data are only made here, never when the application starts
+    def migrate(self):
+        self.init()
+
+    # True if the backend answers a simple query, used by health checks
+    def check(self):
+        return True
+
+    # Applies the retention policy, run every PARTITION_MAINTENANCE_INTERVAL seconds
+    def maintain(self):
+        pass
+
+    # Saves a batch in a single transaction, skipping rows whose (time, tags,
+    # source) is already stored. Returns the (valid_rows, discarded_rows)
+    # inserted, as they are read back
+    def insert_snapshots(self, valid_rows, discarded_rows):
+        raise NotImplementedError
+
+    # Valid rows as (id, time, value, tags) tuples
+    def get_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        raise NotImplementedError
+
+    # Discarded rows as (id, time, value, tags, reason, discarded_at) tuples,
+    # for one reason or all of them
+    def get_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                tags_all=None, tags_any=None):
+        raise NotImplementedError
+
+    # Streamed versions of the queries above. Backends that can't stream
+    # read the whole result first
+    def iter_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        yield from self.get_valid_snapshots(start, end, limit, after, tags_all, tags_any)
+
+    def iter_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                 tags_all=None, tags_any=None):
+        yield from self.get_discarded_snapshots(start, end, reason, limit, after, tags_all, tags_any)
+
+    # Valid rows in lists of up to STREAM_ITERSIZE, for exports
+    def iter_valid_batches(self, start, end):
+        rows = self.get_valid_snapshots(start, end)
+        for offset in range(0, len(rows), STREAM_ITERSIZE):
+            yield rows[offset:offset + STREAM_ITERSIZE]
+
+    # min/max/avg per bucket, for one tag or for all snapshots when tag is
+    # not given. Includes the bucket the start time falls in
+    def get_aggregated_snapshots(self, bucket, start, end, tag=None):
+        rows = self.get_valid_snapshots(bucket_start(start, bucket), end,
+                                        tags_all=(tag,) if tag else None)
+        return aggregate_rows(rows, bucket)
+
+    # A page as a JSON array built by the database, with the row count and
+    # (time, id) of the last row. Only used when builds_json is True
+    def get_snapshots_json(self, kind, start, end, limit=None, after=None, reason=None,
+                           tags_all=None, tags_any=None):
+        raise NotImplementedError(f"The {self.name} backend can't build JSON pages")
+
+# Time before which snapshots are deleted, or None when everything is kept
+def retention_cutoff(now=None, retention_days=RETENTION_DAYS):
+    if retention_days <= 0:
+        return None
+    return (now or datetime.now()) - timedelta(days=retention_days)
+
+# Aggregates (id, time, value, tags) rows ordered by time into one
+# {'time', 'count', 'avg', 'min', 'max'} dictionary per bucket
+def aggregate_rows(rows, bucket):
+    buckets = []
+    current = None
+    for row in rows:
+        start = bucket_start(row[1], bucket)
+        if current is None or current[0] != start:
+            current = [start, 0, 0.0, row[2], row[2]]
+            buckets.append(current)
+        current[1] += 1
+        current[2] += row[2]
+        current[3] = min(current[3], row[2])
+        current[4] = max(current[4], row[2])
+
+    return [{
+        'time': start.isoformat(),
+        'count': count,
+        'avg': total / count,
+        'min': low,
+        'max': high
+    } for start, count, total, low, high in buckets]
@@ -0,0 +1,126 @@
+import threading
+from bisect import bisect_left, bisect_right
+from cache import naive
+from backends.base import Backend, retention_cutoff
+
+# One table held as parallel arrays sorted by time: 'times' for bisecting,
+# 'rows' with the (id, time, value, tags, ...) tuples as they are read back
+# and 'sources' with each row's source. Rows with the same time stay in id
+# order, as new rows go after existing ones
+class SnapshotTable:
+
+    def __init__(self):
+        self.times = []
+        self.rows = []
+        self.sources = []
+        self._keys = set()
+        self._next_id = 1
+
+    # Adds rows whose (time, tags, source) isn't stored yet and returns them
+    # with their ids
+    def insert(self, rows):
+        inserted = []
+        for row in rows:
+            key = (row[0], tuple(row[2]), row[-1])
+            if key in self._keys:
+                continue
+            self._keys.add(key)
+
+            # Readings mostly arrive in time order, so this is nearly always an append
+            stored = (self._next_id, *row[:-1])
+            self._next_id += 1
+            position = bisect_right(self.times, row[0])
+            self.times.insert(position, row[0])
+            self.rows.insert(position, stored)
+            self.sources.insert(position, row[-1])
+            inserted.append(stored)
+        return inserted
+
+    # Rows from start to end inclusive that come after the (time, id) cursor
+    # and pass 'match', up to 'limit' of them
+    def select(self, start, end, after=None, match=None, limit=None):
+        low = bisect_left(self.times, start)
+        high = bisect_right(self.times, end)
+
+        if after:
+            after_time, after_id = after
+            first = bisect_left(self.times, after_time)
+            while (first < len(self.times) and self.times[first] == after_time
+                   and self.rows[first][0] <= after_id):
+                first += 1
+            low = max(low, first)
+
+        if match is None:
+            return self.rows[low:min(high, low + limit) if limit else high]
+
+        selected = []
+        for index in range(low, high):
+            row = self.rows[index]
+            if match(row):
+                selected.append(row)
+                if limit and len(selected) >= limit:
+                    break
+        return selected
+
+    # Removes rows older than cutoff, returns how many
+    def delete_before(self, cutoff):
+        count = bisect_left(self.times, cutoff)
+        for row, source in zip(self.rows[:count], self.sources[:count]):
+            self._keys.discard((row[1], tuple(row[3]), source))
+        del self.times[:count]
+        del self.rows[:count]
+        del self.sources[:count]
+        return count
+
+# Row filter for tags and reason, or None when nothing is filtered on
+def row_matcher(reason=None, tags_all=None, tags_any=None):
+    if not (reason or tags_all or tags_any):
+        return None
+
+    tags_all = set(tags_all or ())
+    tags_any = set(tags_any or ())
+
+    def match(row):
+        if reason and row[4] != reason:
+            return False
+        if tags_all and not tags_all.issubset(row[3]):
+            return False
+        if tags_any and tags_any.isdisjoint(row[3]):
+            return False
+        return True
+
+    return match
+
+# Keeps snapshots in this process's memory, for tests and benchmarks.
+# Nothing is saved, and API processes started separately see none of it
+class MemoryBackend(Backend):
+    name = 'memory'
+    shared = False
+
+    def __init__(self):
+        self.valid = SnapshotTable()
+        self.discarded = SnapshotTable()
+        self._lock = threading.Lock()
+
+    def insert_snapshots(self, valid_rows, discarded_rows):
+        with self._lock:
+            return self.valid.insert(valid_rows), self.discarded.insert(discarded_rows)
+
+    def get_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        match = row_matcher(tags_all=tags_all, tags_any=tags_any)
+        with self._lock:
+            return self.valid.select(naive(start), naive(end), after, match, limit)
+
+    def get_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                tags_all=None, tags_any=None):
+        match = row_matcher(reason, tags_all, tags_any)
+        with self._lock:
+            return self.discarded.select(naive(start), naive(end), after, match, limit)
+
+    def maintain(self):
+        cutoff = retention_cutoff()
+        if cutoff is None:
+            return
+        with self._lock:
+            self.valid.delete_before(cutoff)
+            self.discarded.delete_before(cutoff)
@@ -0,0 +1,332 @@
+import logging
+import uuid
+from psycopg2.extras import execute_values
+import database
+from rollups import update_rollups, bucket_start, ALL_TAGS
+from backends.base import Backend, VALID, DISCARDED
+from config import STREAM_ITERSIZE
+
+# Builds the WHERE/ORDER BY/LIMIT part of a snapshot query. Rows are ordered
+# by (time, id) so 'after' can be the (time, id) of the last row of the
+# previous page
+def build_filters(start, end, limit=None, after=None, reason=None, tags_all=None, tags_any=None):
+    conditions = ["time >= %s", "time <= %s"]
+    params = [start, end]
+
+    if reason:
+        conditions.append("reason = %s")
+        params.append(reason)
+
+    # Array containment and overlap, both answered by the GIN index on tags
+    if tags_all:
+        conditions.append("tags @> %s::text[]")
+        params.append(list(tags_all))
+
+    if tags_any:
+        conditions.append("tags && %s::text[]")
+        params.append(list(tags_any))
+
+    if after:
+        conditions.append("(time, id) > (%s, %s)")
+        params.extend(after)
+
+    clause = "WHERE " + " AND ".join(conditions) + " ORDER BY time, id"
+
+    if limit:
+        clause += " LIMIT %s"
+        params.append(limit)
+
+    return clause, params
+
+VALID_QUERY = """
+    SELECT id, time, value, tags
+    FROM valid_snapshots
+    {filters}
+"""
+
+DISCARDED_QUERY = """
+    SELECT id, time, value, tags, reason, discarded_at
+    FROM discarded_snapshots
+    {filters}
+"""
+
+# A timestamp column as text in the format of datetime.isoformat: six
+# fractional digits, or none when there are no microseconds. Postgres's own
+# JSON output drops trailing zeros, which would change the body and ETag
+# of a page depending on which path built it
+def iso_time(column):
+    return (f"CASE WHEN {column} = date_trunc('second', {column}) "
+            f"THEN to_char({column}, 'YYYY-MM-DD\"T\"HH24:MI:SS') "
+            f"ELSE to_char({column}, 'YYYY-MM-DD\"T\"HH24:MI:SS.US') END")
+
+# Postgres builds the response body itself, with the same keys in the same
+# order and the same time format as serialization.encode_rows. Also returns
+# the number of rows and the (time, id) of the last one, for the next
+# page's cursor
+JSON_QUERY = """
+    SELECT coalesce(json_agg({row} ORDER BY time, id), '[]')::text,
+           count(*),
+           max(time),
+           (array_agg(id ORDER BY time DESC, id DESC))[1]
+    FROM ({query}) AS page
+"""
+
+JSON_ROWS = {
+    VALID: f"json_build_object('id', id, 'tags', tags, 'time', {iso_time('time')}, 'value', value)",
+    DISCARDED: (f"json_build_object('discarded_at', {iso_time('discarded_at')}, 'id', id, "
+                f"'reason', reason, 'tags', tags, 'time', {iso_time('time')}, 'value', value)")
+}
+
+# Runs a query on a named (server-side) cursor and yields rows one at a time,
+# fetching them from Postgres in batches of STREAM_ITERSIZE. The connection
+# is held until the generator is exhausted or closed
+def stream_query(query, params, kind):
+
+    # Gets connection from pool and create cursor, the connection
+    # goes back to the pool when the with block exits
+    with database.pooled_connection() as connection:
+        cursor = connection.cursor(name=f'stream_{kind}_{uuid.uuid4().hex}')
+        cursor.itersize = STREAM_ITERSIZE
+
+        try:
+            cursor.execute(query, params)
+
+            for row in cursor:
+                yield row
+
+        except Exception as e:
+            logging.error(f"Error streaming {kind} snapshots from database: {e}")
+            raise
+
+        finally:
+            # Close cursor and end the read transaction
+            cursor.close()
+            connection.rollback()
+
+# Runs a query on a named (server-side) cursor and yields the raw rows in
+# lists of up to STREAM_ITERSIZE. The connection is held until the generator
+# is exhausted or closed
+def stream_batches(query, params, kind):
+
+    # Gets connection from pool and create cursor, the connection
+    # goes back to the pool when the with block exits
+    with database.pooled_connection() as connection:
+        cursor = connection.cursor(name=f'batch_{kind}_{uuid.uuid4().hex}')
+
+        try:
+            cursor.execute(query, params)
+
+            while True:
+                rows = cursor.fetchmany(STREAM_ITERSIZE)
+                if not rows:
+                    break
+                yield rows
+
+        except Exception as e:
+            logging.error(f"Error exporting {kind} snapshots from database: {e}")
+            raise
+
+        finally:
+            # Close cursor and end the read transaction
+            cursor.close()
+            connection.rollback()
+
+# Stores snapshots in Postgres through the connection pool in database.py.
+# Tables are partitioned by time, aggregates are kept in the rollup table
+# and saved snapshots can be sent to API processes with NOTIFY
+class PostgresBackend(Backend):
+    name = 'postgres'
+    notifies = True
+    builds_json = True
+
+    def init(self, create=True):
+        database.open_pool(create)
+
+    def close(self):
+        database.close_connections()
+
+    def check(self):
+        try:
+            with database.pooled_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            logging.error(f"Database health check failed: {e}")
+            return False
+
+    # Removes snapshots stored twice before the unique keys existed, then
+    # creates the tables and keys
+    def migrate(self):
+        database.open_pool(create=False)
+        with database.pooled_connection() as conn:
+            database.remove_duplicate_snapshots(conn)
+            database.create_tables(conn)
+
+    # Creates upcoming partitions and drops expired ones
+    def maintain(self):
+        database.run_partition_maintenance()
+
+    def insert_snapshots(self, valid_rows, discarded_rows):
+
+        # Gets connection from pool and create cursor, the connection
+        # goes back to the pool when the with block exits
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                if valid_rows:
+                    valid_rows = execute_values(cursor, """
+                        INSERT INTO valid_snapshots (time, value, tags, source)
+                        VALUES %s
+                        ON CONFLICT (time, tags, source) DO NOTHING
+                        RETURNING id, time, value, tags
+                    """, valid_rows, page_size=len(valid_rows), fetch=True)
+
+                # Keep the aggregate rollups in step with the rows inserted
+                update_rollups(cursor, [row[1:] for row in valid_rows])
+
+                if discarded_rows:
+                    discarded_rows = execute_values(cursor, """
+                        INSERT INTO discarded_snapshots (time, value, tags, reason, discarded_at, source)
+                        VALUES %s
+                        ON CONFLICT (time, tags, source) DO NOTHING
+                        RETURNING id, time, value, tags, reason, discarded_at
+                    """, discarded_rows, page_size=len(discarded_rows), fetch=True)
+
+                # Save changes once for the whole batch
+                connection.commit()
+                return valid_rows, discarded_rows
+
+            except Exception as e:
+                connection.rollback()
+                logging.error("Error inserting snapshot batch into database: %s", e)
+                raise
+
+            finally:
+                # Close cursor
+                cursor.close()
+
+    def get_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+
+        # Gets connection from pool and create cursor, the connection
+        # goes back to the pool when the with block exits
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                filters, params = build_filters(start, end, limit, after,
+                                                tags_all=tags_all, tags_any=tags_any)
+
+                # Query valid_snapshots table
+                cursor.execute(VALID_QUERY.format(filters=filters), params)
+
+                # Rows are returned as (id, time, value, tags) tuples
+                return cursor.fetchall()
+
+            except Exception as e:
+                logging.error(f"Error reading valid snapshot in database: {e}")
+                raise
+
+            finally:
+                # Close cursor
+                cursor.close()
+
+    def get_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                tags_all=None, tags_any=None):
+
+        # Gets connection from pool and create cursor, the connection
+        # goes back to the pool when the with block exits
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                filters, params = build_filters(start, end, limit, after, reason, tags_all, tags_any)
+
+                # Query discarded_snapshots table, filtering by reason if provided
+                cursor.execute(DISCARDED_QUERY.format(filters=filters), params)
+
+                # Rows are returned as (id, time, value, tags, reason, discarded_at) tuples
+                return cursor.fetchall()
+
+            except Exception as e:
+                logging.error(f"Error reading discarded snapshot in database: {e}")
+                raise
+
+            finally:
+                # Close cursor
+                cursor.close()
+
+    # Streams from a server-side cursor, so only STREAM_ITERSIZE rows are
+    # held in memory whatever the size of the window
+    def iter_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, tags_all=tags_all, tags_any=tags_any)
+        yield from stream_query(VALID_QUERY.format(filters=filters), params, VALID)
+
+    def iter_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                 tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, reason, tags_all, tags_any)
+        yield from stream_query(DISCARDED_QUERY.format(filters=filters), params, DISCARDED)
+
+    def iter_valid_batches(self, start, end):
+        filters, params = build_filters(start, end)
+        yield from stream_batches(VALID_QUERY.format(filters=filters), params, VALID)
+
+    # Reads min/max/avg per bucket from the rollup table
+    def get_aggregated_snapshots(self, bucket, start, end, tag=None):
+
+        # Gets connection from pool and create cursor, the connection
+        # goes back to the pool when the with block exits
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                # Include the bucket the start time falls in
+                cursor.execute("""
+                    SELECT bucket_start, count, sum, min, max
+                    FROM snapshot_rollups
+                    WHERE bucket = %s AND tag = %s
+                    AND bucket_start >= %s AND bucket_start <= %s
+                    ORDER BY bucket_start
+                """, (bucket, tag or ALL_TAGS, bucket_start(start, bucket), end))
+
+                # Map rows into list of dictionaries
+                return [{
+                    'time': row[0].isoformat(),
+                    'count': row[1],
+                    'avg': row[2] / row[1],
+                    'min': row[3],
+                    'max': row[4]
+                } for row in cursor.fetchall()]
+
+            except Exception as e:
+                logging.error(f"Error reading snapshot aggregates in database: {e}")
+                raise
+
+            finally:
+                # Close cursor
+                cursor.close()
+
+    def get_snapshots_json(self, kind, start, end, limit=None, after=None, reason=None,
+                           tags_all=None, tags_any=None):
+
+        # Gets connection from pool and create cursor, the connection
+        # goes back to the pool when the with block exits
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                filters, params = build_filters(start, end, limit, after, reason, tags_all, tags_any)
+                query = (VALID_QUERY if kind == VALID else DISCARDED_QUERY).format(filters=filters)
+
+                cursor.execute(JSON_QUERY.format(row=JSON_ROWS[kind], query=query), params)
+                body, count, last_time, last_id = cursor.fetchone()
+                return body, count, (last_time, last_id)
+
+            except Exception as e:
+                logging.error(f"Error reading {kind} snapshots as JSON from database: {e}")
+                raise
+
+            finally:
+                # Close cursor
+                cursor.close()
@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from cache import naive
+from rollups import bucket_start
+from backends.base import Backend, retention_cutoff
+from config import SQLITE_PATH, SQLITE_BUSY_TIMEOUT, STREAM_ITERSIZE
+
+# Times are stored as ISO text with fixed-width microseconds, so text order
+# is time order. Tags are stored as JSON arrays
+def encode_time(time):
+    return naive(time).isoformat(timespec='microseconds')
+
+def encode_tags(tags):
+    return json.dumps(list(tags))
+
+VALID_COLUMNS = "id, time, value, tags"
+DISCARDED_COLUMNS = "id, time, value, tags, reason, discarded_at"
+
+# Characters of the stored time that make up each bucket, and what is added
+# to turn them back into a full time
+BUCKET_PREFIXES = {
+    '1m': (16, ':00'),
+    '1h': (13, ':00:00'),
+    '1d': (10, 'T00:00:00')
+}
+
+# Turns stored valid or discarded rows back into the tuples Postgres returns
+def decode_valid(row):
+    return (row[0], datetime.fromisoformat(row[1]), row[2], json.loads(row[3]))
+
+def decode_discarded(row):
+    return (row[0], datetime.fromisoformat(row[1]), row[2], json.loads(row[3]),
+            row[4], datetime.fromisoformat(row[5]))
+
+# Builds the WHERE/ORDER BY/LIMIT part of a snapshot query, the SQLite
+# version of the Postgres backend's build_filters. Tag filters look inside
+# the JSON arrays with json_each
+def build_filters(start, end, limit=None, after=None, reason=None, tags_all=None, tags_any=None):
+    conditions = ["time >= ?", "time <= ?"]
+    params = [encode_time(start), encode_time(end)]
+
+    if reason:
+        conditions.append("reason = ?")
+        params.append(reason)
+
+    for tag in tags_all or ():
+        conditions.append("EXISTS (SELECT 1 FROM json_each(tags) WHERE value = ?)")
+        params.append(tag)
+
+    if tags_any:
+        placeholders = ", ".join("?" * len(tags_any))
+        conditions.append(f"EXISTS (SELECT 1 FROM json_each(tags) WHERE value IN ({placeholders}))")
+        params.extend(tags_any)
+
+    if after:
+        conditions.append("(time, id) > (?, ?)")
+        params.extend((encode_time(after[0]), after[1]))
+
+    clause = "WHERE " + " AND ".join(conditions) + " ORDER BY time, id"
+
+    if limit:
+        clause += " LIMIT ?"
+        params.append(limit)
+
+    return clause, params
+
+# Stores snapshots in a single SQLite file in WAL mode, so readers don't
+# block the writer and several processes can share it. Each thread gets its
+# own connection, writes from this process take turns on a lock and each
+# batch is saved in one transaction
+class SQLiteBackend(Backend):
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH, busy_timeout=SQLITE_BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    # Connection for the calling thread. A process forked after connecting
+    # opens its own, connections can't be shared across a fork
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                     isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Safe with WAL, a power cut can lose the last commits but not corrupt the file
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def init(self, create=True):
+        logging.info("Opening SQLite database %s...", self.path)
+        if create:
+            self.create_tables()
+            self.maintain()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error as e:
+                logging.error("Error closing SQLite connection: %s", e)
+        self._local = threading.local()
+
+    def create_tables(self):
+        connection = self.connection()
+        with self._write_lock:
+            connection.executescript("""
+                BEGIN;
+                CREATE TABLE IF NOT EXISTS valid_snapshots(
+                    id INTEGER PRIMARY KEY,
+                    time TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    tags TEXT NOT NULL,
+                    source TEXT NOT NULL DEFAULT '',
+                    UNIQUE (time, tags, source)
+                );
+                CREATE INDEX IF NOT EXISTS idx_valid_time ON valid_snapshots(time, id);
+                CREATE TABLE IF NOT EXISTS discarded_snapshots(
+                    id INTEGER PRIMARY KEY,
+                    time TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    tags TEXT NOT NULL,
+                    reason TEXT NOT NULL,
+                    discarded_at TEXT NOT NULL,
+                    source TEXT NOT NULL DEFAULT '',
+                    UNIQUE (time, tags, source)
+                );
+                CREATE INDEX IF NOT EXISTS idx_discarded_time ON discarded_snapshots(time, id);
+                CREATE INDEX IF NOT EXISTS idx_discarded_reason_time ON discarded_snapshots(reason, time);
+                COMMIT;
+            """)
+        logging.info("SQLite tables created successfully")
+
+    def check(self):
+        try:
+            self.connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logging.error("Database health check failed: %s", e)
+            return False
+
+    # Deletes snapshots older than RETENTION_DAYS
+    def maintain(self):
+        cutoff = retention_cutoff()
+        if cutoff is None:
+            return
+        try:
+            with self._transaction() as connection:
+                for table in ('valid_snapshots', 'discarded_snapshots'):
+                    connection.execute(f"DELETE FROM {table} WHERE time < ?", (encode_time(cutoff),))
+        except sqlite3.Error as e:
+            logging.error("Error applying retention to SQLite database: %s", e)
+
+    # Writes happen one at a time inside BEGIN IMMEDIATE, which takes the
+    # file's write lock up front instead of failing halfway through
+    @contextmanager
+    def _transaction(self):
+        with self._write_lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def insert_snapshots(self, valid_rows, discarded_rows):
+        try:
+            with self._transaction() as connection:
+                valid_rows = self._insert(connection, """
+                    INSERT OR IGNORE INTO valid_snapshots (time, value, tags, source)
+                    VALUES (?, ?, ?, ?)
+                """, valid_rows)
+                discarded_rows = self._insert(connection, """
+                    INSERT OR IGNORE INTO discarded_snapshots (time, value, tags, reason, discarded_at, source)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, discarded_rows)
+            return valid_rows, discarded_rows
+
+        except sqlite3.Error as e:
+            logging.error("Error inserting snapshot batch into database: %s", e)
+            raise
+
+    # Inserts rows one statement each within the batch's transaction and
+    # returns those that weren't already stored, with their new ids and
+    # without their source
+    @staticmethod
+    def _insert(connection, query, rows):
+        inserted = []
+        cursor = connection.cursor()
+        for row in rows:
+            params = [encode_time(row[0]), row[1], encode_tags(row[2])]
+            if len(row) > 4:
+                params.extend((row[3], encode_time(row[4])))
+            params.append(row[-1])
+            cursor.execute(query, params)
+            if cursor.rowcount:
+                inserted.append((cursor.lastrowid, *row[:-1]))
+        return inserted
+
+    def _query(self, table, columns, filters, params):
+        return self.connection().execute(f"SELECT {columns} FROM {table} {filters}", params)
+
+    def get_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, tags_all=tags_all, tags_any=tags_any)
+        try:
+            rows = self._query('valid_snapshots', VALID_COLUMNS, filters, params).fetchall()
+        except sqlite3.Error as e:
+            logging.error("Error reading valid snapshot in database: %s", e)
+            raise
+        return list(map(decode_valid, rows))
+
+    def get_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, reason, tags_all, tags_any)
+        try:
+            rows = self._query('discarded_snapshots', DISCARDED_COLUMNS, filters, params).fetchall()
+        except sqlite3.Error as e:
+            logging.error("Error reading discarded snapshot in database: %s", e)
+            raise
+        return list(map(decode_discarded, rows))
+
+    # Reads STREAM_ITERSIZE rows at a time. The cursor keeps its read
+    # snapshot until it is exhausted, WAL lets writes carry on meanwhile
+    def _stream_batches(self, table, columns, filters, params, decode):
+        cursor = self._query(table, columns, filters, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(STREAM_ITERSIZE)
+                if not rows:
+                    break
+                yield list(map(decode, rows))
+
+        except sqlite3.Error as e:
+            logging.error("Error streaming %s from database: %s", table, e)
+            raise
+
+        finally:
+            cursor.close()
+
+    def iter_valid_snapshots(self, start, end, limit=None, after=None, tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, tags_all=tags_all, tags_any=tags_any)
+        for rows in self._stream_batches('valid_snapshots', VALID_COLUMNS, filters, params, decode_valid):
+            yield from rows
+
+    def iter_discarded_snapshots(self, start, end, reason=None, limit=None, after=None,
+                                 tags_all=None, tags_any=None):
+        filters, params = build_filters(start, end, limit, after, reason, tags_all, tags_any)
+        for rows in self._stream_batches('discarded_snapshots', DISCARDED_COLUMNS, filters, params,
+                                         decode_discarded):
+            yield from rows
+
+    def iter_valid_batches(self, start, end):
+        filters, params = build_filters(start, end)
+        yield from self._stream_batches('valid_snapshots', VALID_COLUMNS, filters, params, decode_valid)
+
+    # Aggregates are computed from the snapshots with GROUP BY on a prefix
+    # of the stored time, there is no rollup table
+    def get_aggregated_snapshots(self, bucket, start, end, tag=None):
+        length, suffix = BUCKET_PREFIXES[bucket]
+        conditions = "time >= ? AND time <= ?"
+        params = [length, encode_time(bucket_start(start, bucket)), encode_time(end)]
+        if tag:
+            conditions += " AND EXISTS (SELECT 1 FROM json_each(tags) WHERE value = ?)"
+            params.append(tag)
+
+        try:
+            rows = self.connection().execute(f"""
+                SELECT substr(time, 1, ?) AS bucket_start, count(*), sum(value), min(value), max(value)
+                FROM valid_snapshots
+                WHERE {conditions}
+                GROUP BY bucket_start
+                ORDER BY bucket_start
+            """, params).fetchall()
+        except sqlite3.Error as e:
+            logging.error("Error reading snapshot aggregates in database: %s", e)
+            raise
+
+        return [{
+            'time': datetime.fromisoformat(row[0] + suffix).isoformat(),
+            'count': row[1],
+            'avg': row[2] / row[1],
+            'min': row[3],
+            'max': row[4]
+        } for row in rows]
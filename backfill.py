@@ -0,0 +1,298 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from database import init_db, close_pool, pooled_connection, get_backend
+from storage import write_snapshots, notify_write_listeners
+from feed import notify_missed
+from rollups import update_rollups
+from validation import Snapshot, ValidationPipeline, AgeRule, build_pipeline
+from config import BACKFILL_CHUNK_SIZE, BACKFILL_JOBS, FEED_NOTIFY
+
+# Reads snapshot records from an NDJSON file, one {"time", "value", "tags"}
+# object per line, optionally with the "source" it was read from. A line
+# that isn't JSON is logged and yielded as None, so it still counts towards
+# the checkpoint and a resumed import doesn't stop on it again
+def read_ndjson(file):
+    for number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            logging.warning(f"Skipping line {number}, not valid JSON: {e}")
+            yield None
+
+# Reads snapshot records from a CSV file with a time,value,tags header and
+# an optional source column, tags are separated by ';'
+def read_csv(file):
+    for row in csv.DictReader(file):
+        row['tags'] = [tag for tag in row.get('tags', '').split(';') if tag]
+        yield row
+
+READERS = {
+    '.ndjson': read_ndjson,
+    '.jsonl': read_ndjson,
+    '.csv': read_csv
+}
+
+# Postgres array literal for a list of tags, e.g. {"night","sun-glint"}
+def array_literal(tags):
+    quoted = ('"' + tag.replace('\\', '\\\\').replace('"', '\\"') + '"' for tag in tags)
+    return '{' + ','.join(quoted) + '}'
+
+# Streams rows into a table with COPY FROM STDIN, encoded as CSV
+def copy_rows(cursor, table, columns, rows):
+    if not rows:
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(array_literal(field) if isinstance(field, list) else field for field in row)
+    buffer.seek(0)
+
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+VALID_COLUMNS = ('time', 'value', 'tags', 'source')
+DISCARDED_COLUMNS = ('time', 'value', 'tags', 'reason', 'discarded_at', 'source')
+
+# Inserted rows are returned as they are read back, for write listeners
+VALID_RETURNING = 'id, time, value, tags'
+DISCARDED_RETURNING = 'id, time, value, tags, reason, discarded_at'
+
+# COPYs rows into a temporary table, then moves them into 'table' skipping
+# snapshots already stored with the same (time, tags, source). Returns the
+# 'returning' columns of the rows that were inserted
+def copy_new_rows(cursor, table, columns, column_types, rows, returning=VALID_RETURNING):
+    if not rows:
+        return []
+
+    staging = f'backfill_{table}'
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} ({column_types}) ON COMMIT DELETE ROWS")
+    copy_rows(cursor, staging, columns, rows)
+
+    column_list = ', '.join(columns)
+    cursor.execute(f"""
+        INSERT INTO {table} ({column_list})
+        SELECT {column_list} FROM {staging}
+        ON CONFLICT (time, tags, source) DO NOTHING
+        RETURNING {returning}
+    """)
+    return cursor.fetchall()
+
+# Loads one chunk's valid and discarded rows in a single transaction, so a
+# chunk is either fully loaded or not at all. Loading the same file twice
+# doesn't store its snapshots twice. COPY is Postgres-only, other backends
+# take the chunk as one insert batch. Either way the rows inserted go to
+# this process's write listeners
+def load_chunk(valid_rows, discarded_rows):
+    backend = get_backend()
+    if backend.name != 'postgres':
+        write_snapshots(valid_rows, discarded_rows)
+        return
+
+    with pooled_connection() as connection:
+        cursor = connection.cursor()
+
+        try:
+            valid_rows = copy_new_rows(cursor, 'valid_snapshots', VALID_COLUMNS,
+                                       'time TIMESTAMP, value REAL, tags TEXT[], source TEXT', valid_rows)
+            discarded_rows = copy_new_rows(cursor, 'discarded_snapshots', DISCARDED_COLUMNS,
+                                           'time TIMESTAMP, value REAL, tags TEXT[], reason TEXT, '
+                                           'discarded_at TIMESTAMP, source TEXT',
+                                           discarded_rows, DISCARDED_RETURNING)
+            update_rollups(cursor, [row[1:] for row in valid_rows])
+            connection.commit()
+
+        except Exception as e:
+            connection.rollback()
+            logging.error(f"Error loading chunk: {e}")
+            raise
+
+        finally:
+            cursor.close()
+
+    notify_write_listeners(valid_rows, discarded_rows)
+
+# Records how many records of each file have been loaded, so an interrupted
+# import can carry on where it stopped
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.done = json.load(file)
+
+    def loaded(self, source):
+        return self.done.get(source, 0)
+
+    def save(self, source, records):
+        self.done[source] = records
+        if not self.path:
+            return
+
+        # Write then rename so a crash never leaves a half-written checkpoint
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.done, file)
+        os.replace(temp_path, self.path)
+
+# Validates records and splits them into valid and discarded rows. Records
+# without a source of their own are stored with 'source'
+def split_records(records, pipeline, now, source=''):
+    valid_rows = []
+    discarded_rows = []
+    discarded_at = datetime.now()
+
+    for record in records:
+        # Unreadable lines were already logged by the reader
+        if record is None:
+            continue
+
+        try:
+            record_source = record.get('source') if isinstance(record, dict) else None
+            snapshot, verdict = pipeline.validate(Snapshot.from_json(record, record_source or source), now)
+        except ValueError as e:
+            logging.warning(f"Skipping record: {e}")
+            continue
+
+        if verdict.valid:
+            valid_rows.append(snapshot.as_row())
+        else:
+            discarded_rows.append((snapshot.time, snapshot.value, snapshot.tags,
+                                   verdict.reason, discarded_at, snapshot.source))
+
+    return valid_rows, discarded_rows
+
+# Yields lists of up to chunk_size records, starting after 'skip' records
+def read_chunks(records, chunk_size, skip):
+    chunk = []
+    for index, record in enumerate(records):
+        if index < skip:
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Imports one file. Chunks are validated in this thread while up to 'jobs'
+# earlier chunks are loaded in parallel. The checkpoint only moves past a
+# chunk once it and every chunk before it has been committed
+def import_file(path, pipeline, checkpoint, chunk_size=BACKFILL_CHUNK_SIZE, jobs=BACKFILL_JOBS,
+                default_source=''):
+    reader = READERS.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        raise ValueError(f"Unsupported file type: {path}, expected .ndjson, .jsonl or .csv")
+
+    source = os.path.abspath(path)
+    position = checkpoint.loaded(source)
+    if position:
+        logging.info(f"Resuming {path} after {position} records")
+
+    started = time.monotonic()
+    totals = {'records': 0, 'valid': 0, 'discarded': 0}
+    pending = []
+
+    # Wait for the oldest chunk and move the checkpoint past it. A chunk
+    # that failed stays pending, so nothing after it is checkpointed
+    def finish_oldest():
+        nonlocal position
+        future, size, valid_count, discarded_count = pending[0]
+        future.result()
+        pending.pop(0)
+
+        position += size
+        checkpoint.save(source, position)
+        totals['records'] += size
+        totals['valid'] += valid_count
+        totals['discarded'] += discarded_count
+
+        elapsed = time.monotonic() - started
+        logging.info(f"{path}: {position} records loaded ({totals['valid']} valid, "
+                     f"{totals['discarded']} discarded), {totals['records'] / elapsed:.0f} records/s")
+
+    with open(path, newline='') as file, ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for chunk in read_chunks(reader(file), chunk_size, position):
+                valid_rows, discarded_rows = split_records(chunk, pipeline, time.time(), default_source)
+                future = executor.submit(load_chunk, valid_rows, discarded_rows)
+                pending.append((future, len(chunk), len(valid_rows), len(discarded_rows)))
+
+                # Keep at most 'jobs' chunks in flight
+                while len(pending) > jobs:
+                    finish_oldest()
+
+            while pending:
+                finish_oldest()
+
+        finally:
+            # If the import stopped early, record the chunks already handed
+            # to the executor that commit, up to the first one that doesn't
+            while pending:
+                try:
+                    finish_oldest()
+                except Exception:
+                    break
+
+    return totals
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import historical snapshots with COPY')
+    parser.add_argument('files', nargs='+', help='.ndjson/.jsonl or .csv files to import')
+    parser.add_argument('--checkpoint', default='backfill.checkpoint.json',
+                        help='File recording progress so an import can be resumed')
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE,
+                        help='Records loaded per COPY transaction')
+    parser.add_argument('--jobs', type=int, default=BACKFILL_JOBS,
+                        help='Chunks loaded in parallel')
+    parser.add_argument('--source', default='',
+                        help="Source stored with records that don't have one, e.g. the satellite's URL")
+    parser.add_argument('--no-age-check', action='store_true',
+                        help='Skip the age rule, for readings recorded during a downlink gap')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
+    args = parse_args(argv)
+
+    pipeline = build_pipeline()
+    if args.no_age_check:
+        pipeline = ValidationPipeline(rule for rule in pipeline.rules if not isinstance(rule, AgeRule))
+
+    checkpoint = Checkpoint(args.checkpoint)
+    init_db()
+
+    try:
+        for path in args.files:
+            started = time.monotonic()
+            totals = import_file(path, pipeline, checkpoint, args.chunk_size, args.jobs, args.source)
+            logging.info(f"Finished {path}: {totals['records']} records in "
+                         f"{time.monotonic() - started:.1f}s")
+
+        # History outside the premade partitions lands in the default
+        # partition, give it partitions of its own and apply retention
+        get_backend().maintain()
+    finally:
+        # Rows aren't announced one by one, history isn't news to live feed
+        # subscribers and would flood the channel. One notification has API
+        # processes drop cached pages and reload their hot window
+        if FEED_NOTIFY and get_backend().notifies:
+            try:
+                notify_missed()
+            except Exception as e:
+                logging.error(f"Could not tell API processes about the backfill: {e}")
+        close_pool()
+
+if __name__ == '__main__':
+    main()
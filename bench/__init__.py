@@ -0,0 +1,2 @@
+# Benchmarks for ingest and the API, run with 'python -m bench.<name>'
+# from the project root. Results are written to bench/results as JSON
@@ -0,0 +1,133 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_TAGS = 'night=6,day=3,system=0.5,suspect=0.5'
+
+# Parses 'tag=weight,...' into ([tags], [weights])
+def parse_tag_mix(value):
+    tags, weights = [], []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        tag, _, weight = entry.partition('=')
+        tags.append(tag.strip())
+        weights.append(float(weight) if weight else 1.0)
+    if not tags:
+        raise ValueError("Tag mix needs at least one tag")
+    return tags, weights
+
+# Stand-in for the satellite data-server. Each path ('/', '/sat/1/', ...) is
+# its own satellite producing 'rate' new snapshots per second, and like the
+# real server it returns the latest snapshot until the next one is due.
+# A 'no_data' fraction of snapshots are answered with 404 instead.
+# Snapshots are derived from their sequence number, so every poll of the
+# same slot gets the same reading
+class FakeDataServer:
+
+    def __init__(self, host='127.0.0.1', port=0, rate=1.0, tags=DEFAULT_TAGS,
+                 no_data=0.0, seed=0):
+        self.rate = rate
+        self.tags, self.weights = parse_tag_mix(tags)
+        self.no_data = no_data
+        self.seed = seed
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    # URL of satellite number 'index'
+    def source_url(self, index):
+        return f'{self.url}sat/{index}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-data-server',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Latest snapshot for a path, or None if that slot has no data
+    def snapshot(self, path, now=None):
+        now = time.time() if now is None else now
+        # Every satellite produces a reading at the start of each slot, so
+        # readings from different satellites share their times
+        sequence = int((now - self.started) * self.rate)
+        rng = random.Random(f'{self.seed}:{path}:{sequence}')
+        if rng.random() < self.no_data:
+            return None
+        return {
+            'time': self.started + sequence / self.rate,
+            'value': round(rng.uniform(-20.0, 40.0), 2),
+            'tags': [rng.choices(self.tags, self.weights)[0]],
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+
+                snapshot = server.snapshot(self.path)
+                if snapshot is None:
+                    body = b'{"error": "No data"}'
+                    self.send_response(404)
+                else:
+                    body = json.dumps(snapshot).encode()
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fake satellite data-server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address')
+    parser.add_argument('--port', type=int, default=28462, help='Port, the real data-server uses 28462')
+    parser.add_argument('--rate', type=float, default=1.0, help='New snapshots per second per satellite')
+    parser.add_argument('--tags', default=DEFAULT_TAGS, help="Tag mix as 'tag=weight,...'")
+    parser.add_argument('--no-data', type=float, default=0.0,
+                        help='Fraction of snapshots answered with 404')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for values and tags')
+    return parser.parse_args(argv)
+
+# Serves until interrupted, for pointing a full ingest process at
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
+    args = parse_args(argv)
+    server = FakeDataServer(args.host, args.port, args.rate, args.tags, args.no_data, args.seed).start()
+    logging.info(f"Fake data-server on {server.url}, {args.rate:g} snapshots/s per satellite")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
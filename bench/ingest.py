@@ -0,0 +1,175 @@
+import argparse
+import logging
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there
+    resource = None
+
+import database
+import satellite
+import storage
+from backends import BACKENDS
+from bench.data_server import FakeDataServer, DEFAULT_TAGS, parse_tag_mix
+from bench.results import summarize, write_results
+from fetch_client import close_clients
+from config import WRITE_BATCH_SIZE
+
+# Opens the chosen storage backend and returns the write function
+def use_backend(backend):
+    database.use_backend(backend)
+    database.init_db()
+    return storage.write_snapshots
+
+# Polls each URL back to back, or every 'interval' seconds, for 'duration'
+# seconds through satellite.get_snapshots, one thread per URL
+def run_polls(urls, duration, interval=0.0):
+    latencies = []
+    outcomes = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def poll(url):
+        local_latencies = []
+        local_outcomes = Counter()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            result = satellite.get_snapshots(url)
+            elapsed = time.perf_counter() - started
+            local_latencies.append(elapsed)
+            local_outcomes[result.outcome] += 1
+            if interval > elapsed:
+                time.sleep(interval - elapsed)
+        with lock:
+            latencies.extend(local_latencies)
+            outcomes.update(local_outcomes)
+
+    threads = [threading.Thread(target=poll, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes
+
+# Polls a fake data-server through the real fetch, validation and write
+# buffer path, then waits for the buffer to drain
+def bench_ingest(args):
+    saved = Counter()
+    storage.add_write_listener(lambda valid_rows, discarded_rows:
+                               saved.update(valid=len(valid_rows), discarded=len(discarded_rows)))
+
+    spool_dir = tempfile.TemporaryDirectory() if args.spool else None
+    storage.write_buffer = (storage.SpooledBuffer(spool_dir.name) if spool_dir
+                            else storage.SnapshotBuffer())
+
+    server = FakeDataServer(rate=args.rate, tags=args.tags, no_data=args.no_data,
+                            seed=args.seed).start()
+    try:
+        urls = [server.source_url(i) for i in range(args.sources)]
+        started = time.perf_counter()
+        latencies, outcomes = run_polls(urls, args.duration, args.interval)
+        polled = time.perf_counter() - started
+
+        # Time for the buffer to save what was queued once polling stops
+        drain_started = time.perf_counter()
+        storage.write_buffer.close()
+        drained = time.perf_counter() - drain_started
+    finally:
+        server.stop()
+        close_clients()
+        if spool_dir:
+            spool_dir.cleanup()
+
+    saved_count = saved['valid'] + saved['discarded']
+    return {
+        'polls_per_s': round(len(latencies) / polled, 1),
+        'poll_latency': summarize(latencies),
+        'outcomes': dict(outcomes),
+        'saved_count': saved_count,
+        'saved_per_s': round(saved_count / (polled + drained), 1),
+        'drain_s': round(drained, 3),
+    }
+
+# Synthetic (valid_rows, discarded_rows) batch with unique times ending now
+def make_batch(size, tags, weights, rng, offset):
+    now = datetime.now()
+    valid_rows, discarded_rows = [], []
+    for i in range(size):
+        row_time = now - timedelta(microseconds=offset + i)
+        tag = rng.choices(tags, weights)[0]
+        if tag in ('system', 'suspect'):
+            discarded_rows.append((row_time, round(rng.uniform(-20, 40), 2), [tag], tag, now, 'bench'))
+        else:
+            valid_rows.append((row_time, round(rng.uniform(-20, 40), 2), [tag], 'bench'))
+    return valid_rows, discarded_rows
+
+# Calls the backend's write_snapshots directly with full batches
+def bench_writes(write, batches, batch_size, tags, seed):
+    rng = random.Random(seed)
+    tag_names, weights = parse_tag_mix(tags)
+    latencies = []
+
+    for n in range(batches):
+        valid_rows, discarded_rows = make_batch(batch_size, tag_names, weights, rng, n * batch_size)
+        started = time.perf_counter()
+        write(valid_rows, discarded_rows)
+        latencies.append(time.perf_counter() - started)
+
+    total = sum(latencies)
+    return {
+        'rows_per_s': round(batches * batch_size / total, 1) if total else None,
+        'batch_latency': summarize(latencies),
+    }
+
+def peak_memory_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark snapshot ingest against a fake data-server')
+    parser.add_argument('--backend', choices=BACKENDS, default='memory',
+                        help="Where snapshots are written, 'postgres' uses the database in .env "
+                             "and 'sqlite' the file at SQLITE_PATH")
+    parser.add_argument('--sources', type=int, default=4, help='Satellites polled at the same time')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to poll for')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='Seconds between polls of a satellite, 0 polls back to back')
+    parser.add_argument('--rate', type=float, default=50.0, help='New snapshots per second per satellite')
+    parser.add_argument('--tags', default=DEFAULT_TAGS, help="Tag mix as 'tag=weight,...'")
+    parser.add_argument('--no-data', type=float, default=0.0, help='Fraction of polls answered with 404')
+    parser.add_argument('--spool', action='store_true', help='Buffer writes in an on-disk spool')
+    parser.add_argument('--batches', type=int, default=20, help='Batches written directly to storage')
+    parser.add_argument('--batch-size', type=int, default=WRITE_BATCH_SIZE, help='Rows per direct batch')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for snapshot values and tags')
+    parser.add_argument('--output', help='Result file, defaults to bench/results/')
+    parser.add_argument('--log-level', default='ERROR', help='Log level while benchmarking')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s | %(levelname)s | %(message)s')
+    started_at = datetime.now()
+
+    write = use_backend(args.backend)
+    try:
+        results = {
+            'ingest': bench_ingest(args),
+            'storage': bench_writes(write, args.batches, args.batch_size, args.tags, args.seed),
+            'peak_rss_kb': peak_memory_kb(),
+        }
+    finally:
+        database.close_pool()
+
+    path = write_results('ingest', vars(args), results, started_at, args.output)
+    print(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import logging
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+import requests
+from bench.results import summarize, write_results
+
+ENDPOINTS = ('snapshots', 'discarded')
+DEFAULT_WINDOWS = '60,3600,86400'
+
+# Query string for a window of 'seconds' ending at 'end'. Unless 'cached'
+# is set the end is moved by one microsecond per request, so every request
+# misses the response cache and reaches the database
+def window_params(seconds, end, n, cached, limit=None):
+    window_end = end if cached else end - timedelta(microseconds=n)
+    params = {
+        'start': (window_end - timedelta(seconds=seconds)).isoformat(),
+        'end': window_end.isoformat(),
+    }
+    if limit:
+        params['limit'] = limit
+    return params
+
+# Sends 'requests' GETs with 'concurrency' threads, each thread making
+# its own keep-alive session. Returns latencies, status counts and bytes
+def run_http(url, make_params, total, concurrency):
+    latencies = []
+    statuses = Counter()
+    sizes = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        local_latencies, local_statuses, local_sizes = [], Counter(), []
+        with requests.Session() as session:
+            while True:
+                with lock:
+                    n = next(counter, None)
+                if n is None:
+                    break
+                started = time.perf_counter()
+                try:
+                    response = session.get(url, params=make_params(n), timeout=60)
+                    local_sizes.append(len(response.content))
+                    local_statuses[str(response.status_code)] += 1
+                except requests.RequestException:
+                    local_statuses['error'] += 1
+                local_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+            sizes.extend(local_sizes)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, sizes
+
+# Sends requests one at a time through Flask's test client in this process,
+# tracing the peak memory allocated while handling each one
+def run_in_process(path, make_params, total):
+    from api import app
+
+    latencies = []
+    statuses = Counter()
+    sizes = []
+    peaks = []
+
+    with app.test_client() as client:
+        tracemalloc.start()
+        try:
+            for n in range(total):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                started = time.perf_counter()
+                response = client.get(path, query_string=make_params(n))
+                body = response.get_data()
+                latencies.append(time.perf_counter() - started)
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+                statuses[str(response.status_code)] += 1
+                sizes.append(len(body))
+        finally:
+            tracemalloc.stop()
+
+    return latencies, statuses, sizes, peaks
+
+# Runs every endpoint and window combination and collects the numbers
+def bench_load(args):
+    end = datetime.fromisoformat(args.end) if args.end else datetime.now()
+    windows = [int(window) for window in args.windows.split(',') if window.strip()]
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+
+    if args.in_process:
+        from database import init_db
+        init_db(create=False)
+
+    results = {}
+    try:
+        for endpoint in endpoints:
+            results[endpoint] = {}
+            for seconds in windows:
+                def make_params(n, seconds=seconds):
+                    return window_params(seconds, end, n, args.cached, args.limit)
+
+                started = time.perf_counter()
+                if args.in_process:
+                    latencies, statuses, sizes, peaks = run_in_process(f'/{endpoint}', make_params,
+                                                                       args.requests)
+                else:
+                    url = f"{args.url.rstrip('/')}/{endpoint}"
+                    latencies, statuses, sizes = run_http(url, make_params, args.requests,
+                                                          args.concurrency)
+                    peaks = []
+                elapsed = time.perf_counter() - started
+
+                result = {
+                    'requests_per_s': round(len(latencies) / elapsed, 1),
+                    'latency': summarize(latencies),
+                    'statuses': dict(statuses),
+                    'mean_bytes': round(sum(sizes) / len(sizes)) if sizes else None,
+                }
+                if peaks:
+                    result['mean_peak_alloc_bytes'] = round(sum(peaks) / len(peaks))
+                    result['max_peak_alloc_bytes'] = max(peaks)
+                results[endpoint][f'{seconds}s'] = result
+                logging.info(f"/{endpoint} {seconds}s window: {result['latency'].get('p50_ms')}ms p50, "
+                             f"{result['latency'].get('p99_ms')}ms p99")
+    finally:
+        if args.in_process:
+            from database import close_pool
+            close_pool()
+
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test /snapshots and /discarded')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='Base URL of a running API')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Endpoints to request')
+    parser.add_argument('--windows', default=DEFAULT_WINDOWS, help='Window sizes in seconds')
+    parser.add_argument('--end', help='ISO end of every window, defaults to now')
+    parser.add_argument('--limit', type=int, help="Page size, leave out for the API's default (API_DEFAULT_LIMIT)")
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and window')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--cached', action='store_true',
+                        help='Repeat the same window so responses come from the cache')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Call the app directly, one request at a time, and trace memory per request')
+    parser.add_argument('--output', help='Result file, defaults to bench/results/')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
+    args = parse_args(argv)
+    started_at = datetime.now()
+
+    results = bench_load(args)
+
+    path = write_results('load', vars(args), results, started_at, args.output)
+    print(path)
+
+if __name__ == '__main__':
+    main()
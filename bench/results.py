@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Value at fraction q of an already sorted list, nearest rank
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    index = max(int(round(q * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+# Count, mean and percentiles of a list of durations in seconds, reported
+# in milliseconds
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+
+    def ms(value):
+        return round(value * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': ms(sum(ordered) / len(ordered)),
+        'p50_ms': ms(percentile(ordered, 0.50)),
+        'p90_ms': ms(percentile(ordered, 0.90)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1]),
+    }
+
+# Current commit and whether the tree has uncommitted changes, so results
+# can be matched to the code that produced them
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+# Writes one benchmark run as JSON and returns the path. By default files go
+# to bench/results named after the benchmark, commit and start time
+def write_results(name, params, results, started_at, path=None):
+    commit, dirty = git_revision()
+    document = {
+        'benchmark': name,
+        'commit': commit,
+        'dirty': dirty,
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = started_at.strftime('%Y%m%dT%H%M%S')
+        path = os.path.join(RESULTS_DIR, f"{name}-{(commit or 'unknown')[:8]}-{stamp}.json")
+
+    with open(path, 'w') as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+        file.write('\n')
+    return path
+
+# Numeric leaves of a nested dict as {'a.b.c': value}
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f'{prefix}.{key}' if prefix else str(key)))
+        return items
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+# Totals and breakdowns describe a run rather than measure its speed
+def informational(key):
+    parts = key.split('.')
+    return parts[-1] == 'count' or parts[-1].endswith('_count') or 'outcomes' in parts or 'statuses' in parts
+
+# Throughputs are better higher, everything else (latency, bytes, memory)
+# is better lower
+def higher_is_better(key):
+    return key.endswith('_per_s')
+
+# Compares the results of two runs of the same benchmark. Returns a list of
+# (key, old, new, percent change, regressed) for every metric in both
+def compare(old, new, threshold=10.0):
+    old_values = flatten(old['results'])
+    new_values = flatten(new['results'])
+
+    rows = []
+    for key in sorted(old_values.keys() & new_values.keys()):
+        before, after = old_values[key], new_values[key]
+        if informational(key) or before == 0:
+            change = None
+            regressed = False
+        else:
+            change = (after - before) / abs(before) * 100
+            worse = -change if higher_is_better(key) else change
+            regressed = worse > threshold
+        rows.append((key, before, after, change, regressed))
+    return rows
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('old', help='Result file from the baseline commit')
+    parser.add_argument('new', help='Result file to compare against it')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Percent change in the wrong direction counted as a regression')
+    return parser.parse_args(argv)
+
+# Prints a table of changes and exits with status 1 if anything regressed
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    if old.get('benchmark') != new.get('benchmark'):
+        sys.exit(f"Can't compare '{old.get('benchmark')}' results with '{new.get('benchmark')}' results")
+
+    print(f"{old.get('commit', '')[:8]} -> {new.get('commit', '')[:8]}")
+    regressions = 0
+    for key, before, after, change, regressed in compare(old, new, args.threshold):
+        change_text = f'{change:+.1f}%' if change is not None else ''
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{key:<60} {before:>12g} {after:>12g} {change_text:>9}{flag}')
+        regressions += regressed
+
+    if regressions:
+        print(f'{regressions} metric(s) regressed by more than {args.threshold:g}%')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
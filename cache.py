@@ -0,0 +1,146 @@
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config import CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_MAX_BYTES, CACHE_MAX_ENTRY_BYTES
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'headers', 'table', 'start', 'end', 'expires')
+
+    def __init__(self, body, headers, table, start, end, expires):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.headers = headers
+        self.table = table
+        self.start = start
+        self.end = end
+        self.expires = expires
+
+# Cached times are compared with naive snapshot times, so aware
+# datetimes are converted to local time first
+def naive(dt):
+    if dt.tzinfo is not None:
+        return dt.astimezone().replace(tzinfo=None)
+    return dt
+
+# LRU cache of serialized API responses with a TTL, bounded by both the
+# number of entries and the total size of their bodies. Entries remember the
+# table and time window they were read from so new rows landing inside
+# that window invalidate them
+class ResponseCache:
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES,
+                 max_entry_bytes=CACHE_MAX_ENTRY_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a response read before a write
+        # committed is not cached after it
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.too_large = 0
+
+    def enabled(self):
+        return self.max_entries > 0
+
+    def generation(self):
+        return self._generation
+
+    # Bytes of response bodies held
+    def size(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry.expires <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                    self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Store a response body read at 'generation', unless an invalidation
+    # has happened since or the body is over max_entry_bytes
+    def put(self, key, body, headers, table, start, end, generation):
+        entry = CacheEntry(body, headers, table, naive(start), naive(end),
+                           time.monotonic() + self.ttl)
+
+        with self._lock:
+            if not self.enabled() or generation != self._generation:
+                return entry
+
+            if len(body) > self.max_entry_bytes:
+                self.too_large += 1
+                return entry
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        return entry
+
+    # Called with the lock held
+    def _remove(self, key):
+        self._bytes -= len(self._entries.pop(key).body)
+
+    # Drop entries for 'table' whose window contains any of 'times'
+    def invalidate(self, table, times):
+        if not times:
+            return
+        times = sorted(times)
+
+        with self._lock:
+            self._generation += 1
+
+            stale = []
+            for key, entry in self._entries.items():
+                if entry.table != table:
+                    continue
+                # First new time at or after the window start
+                index = bisect.bisect_left(times, entry.start)
+                if index < len(times) and times[index] <= entry.end:
+                    stale.append(key)
+
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'too_large': self.too_large
+            }
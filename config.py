@@ -0,0 +1,197 @@
+import os
+from dotenv import load_dotenv
+
+# Retrieve environment variables from .env file
+load_dotenv()
+
+# Logging settings. Records are handed to a background thread, so writing
+# the log never blocks polling
+LOG_FILE = os.getenv('LOG_FILE', 'snapshots.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'text' for the usual one line per record, 'json' for one JSON object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+if LOG_FORMAT not in ('text', 'json'):
+    raise ValueError(f"LOG_FORMAT must be 'text' or 'json', got '{LOG_FORMAT}'")
+# Rotate LOG_FILE by 'size' (LOG_MAX_BYTES) or 'time' (LOG_ROTATE_WHEN), or 'none'
+LOG_ROTATE = os.getenv('LOG_ROTATE', 'size')
+if LOG_ROTATE not in ('size', 'time', 'none'):
+    raise ValueError(f"LOG_ROTATE must be 'size', 'time' or 'none', got '{LOG_ROTATE}'")
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+# When to rotate for LOG_ROTATE=time, as accepted by TimedRotatingFileHandler e.g. 'midnight', 'H'
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+# Rotated files kept
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '7'))
+# Records waiting for the writer thread, further records are dropped and counted
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Database connection settings
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = os.getenv('DB_PORT')
+DB_NAME = os.getenv('DB_NAME')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+# Where snapshots are stored: 'postgres' (DB_* settings above), 'sqlite'
+# (a single file at SQLITE_PATH) or 'memory' (lost on exit, one process only)
+DB_BACKEND = os.getenv('DB_BACKEND', 'postgres')
+if DB_BACKEND not in ('postgres', 'sqlite', 'memory'):
+    raise ValueError(f"DB_BACKEND must be 'postgres', 'sqlite' or 'memory', got '{DB_BACKEND}'")
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'snapshots.db')
+# Seconds a SQLite write waits for another process's write to finish
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+
+# Write-behind buffer settings used by storage.py
+# Snapshots are flushed once WRITE_BATCH_SIZE rows are queued or
+# WRITE_FLUSH_INTERVAL seconds have passed, whichever comes first
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '500'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '1.0'))
+# Max snapshots held in memory before writers are made to wait
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', '10000'))
+# Seconds a writer waits for space in a full queue before giving up
+WRITE_ENQUEUE_TIMEOUT = float(os.getenv('WRITE_ENQUEUE_TIMEOUT', '5.0'))
+# Longest wait in seconds between retries of a batch while the database is
+# unreachable, and how long shutdown keeps retrying before batches are lost
+WRITE_RETRY_MAX = float(os.getenv('WRITE_RETRY_MAX', '30'))
+WRITE_CLOSE_TIMEOUT = float(os.getenv('WRITE_CLOSE_TIMEOUT', '30'))
+
+# Keys of this many recently queued snapshots are remembered, so repeated
+# readings are dropped without a database round trip. 0 turns it off
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '10000'))
+
+# On-disk spool snapshots are written to before the database, so readings
+# survive a database outage or restart. An empty SPOOL_DIR keeps snapshots
+# in memory only
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+# Spool files are started afresh once they reach this size in bytes
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+# Most seconds between fsyncs of the spool, at most this much is lost if the host crashes
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', '0.2'))
+# Longest wait in seconds between retries while the database is unreachable
+SPOOL_RETRY_MAX = float(os.getenv('SPOOL_RETRY_MAX', '30'))
+
+# Satellite data-servers to poll, comma separated. Each entry is a URL
+# optionally followed by its own interval and timeout in seconds:
+#   http://host:28462/|0.5|2,http://other:28462/
+SATELLITE_SOURCES = os.getenv('SATELLITE_SOURCES', 'http://localhost:28462/')
+# Defaults for sources that don't set their own interval or timeout
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', '1.0'))
+POLL_TIMEOUT = float(os.getenv('POLL_TIMEOUT', '5.0'))
+# Polls that find nothing new (404 or an unchanged snapshot) back off by
+# POLL_BACKOFF each time, up to POLL_MAX_INTERVAL seconds. The next new
+# snapshot brings a source back to its own interval
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', '10.0'))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', '1.5'))
+# Ingest worker processes sources are shared between by consistent hashing.
+# 1 polls every source in the main process
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '1'))
+# Seconds a stopping ingest worker gets to save buffered snapshots before it is killed
+INGEST_STOP_TIMEOUT = float(os.getenv('INGEST_STOP_TIMEOUT', '30'))
+# Longest wait in seconds before restarting a worker that keeps crashing
+INGEST_RESTART_MAX = float(os.getenv('INGEST_RESTART_MAX', '30'))
+# Number of polls that may be in flight at once across all sources
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '16'))
+
+# HTTP client settings used when fetching from data-servers
+FETCH_CONNECT_TIMEOUT = float(os.getenv('FETCH_CONNECT_TIMEOUT', '2.0'))
+# Retries on connection errors and 5xx responses, with jittered exponential backoff
+FETCH_RETRIES = int(os.getenv('FETCH_RETRIES', '3'))
+FETCH_BACKOFF = float(os.getenv('FETCH_BACKOFF', '0.2'))
+FETCH_BACKOFF_JITTER = float(os.getenv('FETCH_BACKOFF_JITTER', '0.2'))
+FETCH_BACKOFF_MAX = float(os.getenv('FETCH_BACKOFF_MAX', '5.0'))
+# Consecutive failed polls before a data-server is left alone for CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', '30.0'))
+
+# Largest page size the API accepts for the 'limit' parameter
+API_MAX_LIMIT = int(os.getenv('API_MAX_LIMIT', '10000'))
+# Page size of /snapshots and /discarded when 'limit' isn't given, 0 returns
+# the whole window. Streamed responses are never paged
+API_DEFAULT_LIMIT = int(os.getenv('API_DEFAULT_LIMIT', str(API_MAX_LIMIT)))
+# Have Postgres build /snapshots and /discarded pages as JSON with json_agg,
+# so rows aren't decoded into Python and encoded again
+API_DATABASE_JSON = os.getenv('API_DATABASE_JSON', 'false').lower() in ('true', '1', 'yes')
+# Rows fetched per round trip when streaming responses from a server-side cursor
+STREAM_ITERSIZE = int(os.getenv('STREAM_ITERSIZE', '2000'))
+# Rows written per chunk of a streamed API response
+STREAM_CHUNK_ROWS = int(os.getenv('STREAM_CHUNK_ROWS', '500'))
+
+# API response cache, CACHE_MAX_ENTRIES=0 turns it off
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '256'))
+# Seconds a cached response is served before it is read again
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+# Most bytes of response bodies cached, least recently used are dropped first
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Bodies larger than this many bytes are never cached
+CACHE_MAX_ENTRY_BYTES = int(os.getenv('CACHE_MAX_ENTRY_BYTES', str(1024 * 1024)))
+
+# Hours of recent snapshots each API process keeps in memory to answer
+# queries without the database, 0 turns it off
+HOT_WINDOW_HOURS = float(os.getenv('HOT_WINDOW_HOURS', '1'))
+# Most snapshots of each kind kept, the oldest are dropped first
+HOT_WINDOW_MAX_ROWS = int(os.getenv('HOT_WINDOW_MAX_ROWS', '500000'))
+
+# Snapshot tables are partitioned by 'day' or 'month' on their time column
+PARTITION_INTERVAL = os.getenv('PARTITION_INTERVAL', 'day')
+if PARTITION_INTERVAL not in ('day', 'month'):
+    raise ValueError(f"PARTITION_INTERVAL must be 'day' or 'month', got '{PARTITION_INTERVAL}'")
+# Number of future partitions kept ready ahead of the current one
+PARTITION_PREMAKE = int(os.getenv('PARTITION_PREMAKE', '3'))
+# Partitions older than this many days are dropped, 0 keeps everything
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+# Seconds between partition maintenance runs
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv('PARTITION_MAINTENANCE_INTERVAL', '3600'))
+
+# Validation rules applied to each snapshot
+# Snapshots older than this many seconds are discarded
+MAX_SNAPSHOT_AGE = float(os.getenv('MAX_SNAPSHOT_AGE', '3600'))
+# Snapshots with any of these tags are discarded, checked in this order
+BLACKLISTED_TAGS = [tag.strip() for tag in os.getenv('BLACKLISTED_TAGS', 'system,suspect').split(',') if tag.strip()]
+# Optional bounds on snapshot values, snapshots outside them are discarded
+VALUE_MIN = float(os.getenv('VALUE_MIN')) if os.getenv('VALUE_MIN') else None
+VALUE_MAX = float(os.getenv('VALUE_MAX')) if os.getenv('VALUE_MAX') else None
+
+# Connection pool settings
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Connections are replaced once they are this many seconds old
+DB_POOL_MAX_AGE = float(os.getenv('DB_POOL_MAX_AGE', '1800'))
+# Connections above DB_POOL_MIN are closed after this many idle seconds
+DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300'))
+# Connections idle for more than this many seconds are checked before use
+DB_POOL_CHECK_AFTER = float(os.getenv('DB_POOL_CHECK_AFTER', '30'))
+
+# API server settings
+API_HOST = os.getenv('API_HOST', '127.0.0.1')
+API_PORT = int(os.getenv('API_PORT', '8080'))
+# Worker processes and threads per worker when serving with gunicorn
+API_WORKERS = int(os.getenv('API_WORKERS', '2'))
+API_THREADS = int(os.getenv('API_THREADS', '4'))
+# Seconds workers get to finish in-flight requests on shutdown
+API_GRACEFUL_TIMEOUT = int(os.getenv('API_GRACEFUL_TIMEOUT', '30'))
+# Port the ingest process serves its own /metrics on, 0 turns it off. With
+# ingest workers the supervisor uses it and worker N uses METRICS_PORT + 1 + N
+METRICS_HOST = os.getenv('METRICS_HOST', API_HOST)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8081'))
+# First port gunicorn API workers serve their own /metrics on, the worker in
+# slot N uses API_METRICS_PORT + N. 0 turns them off
+API_METRICS_PORT = int(os.getenv('API_METRICS_PORT', '8090'))
+
+# Bulk import settings used by backfill.py
+# Records per COPY chunk, each chunk is loaded in one transaction
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '50000'))
+# Chunks loaded at the same time, each on its own connection
+BACKFILL_JOBS = int(os.getenv('BACKFILL_JOBS', '4'))
+
+# Live snapshot feed served on /snapshots/stream
+# Events buffered per subscriber, subscribers that fall further behind are disconnected
+FEED_BUFFER_SIZE = int(os.getenv('FEED_BUFFER_SIZE', '1000'))
+# Open streams per API worker. Each one holds a thread while it is open,
+# workers get this many threads on top of API_THREADS for them
+FEED_MAX_SUBSCRIBERS = int(os.getenv('FEED_MAX_SUBSCRIBERS', '32'))
+# Seconds between keep-alive comments on an idle stream
+FEED_HEARTBEAT = float(os.getenv('FEED_HEARTBEAT', '15'))
+# Share saved snapshots between the ingest process and API workers with
+# Postgres LISTEN/NOTIFY on FEED_CHANNEL
+FEED_NOTIFY = os.getenv('FEED_NOTIFY', 'true').lower() in ('true', '1', 'yes')
+FEED_CHANNEL = os.getenv('FEED_CHANNEL', 'snapshot_feed')
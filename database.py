@@ -1,90 +1,262 @@
-import os
-from dotenv import load_dotenv
 import psycopg2
-from psycopg2 import pool
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from config import (DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_BACKEND,
+                    PARTITION_MAINTENANCE_INTERVAL)
+from rollups import create_rollup_table, subtract_rollups
+from partitions import maintain_partitions
+from metrics import Gauge, pool_wait
+from db_pool import ConnectionPool
+from backends import create_backend
 
-# Retrieve environment variables from .env file
-load_dotenv()
+connection_pool = None
 
-DB_HOST = os.getenv('DB_HOST')
-DB_PORT = os.getenv('DB_PORT')
-DB_NAME = os.getenv('DB_NAME')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
+# Storage backend chosen by DB_BACKEND, created on first use
+backend = None
 
-connection_pool = None
+# Functions run by close_pool() before the backend is closed,
+# e.g. flushing buffered writes
+close_hooks = []
+
+# Pool utilization, read when /metrics is scraped
+Gauge('db_pool_connections_in_use', 'Connections checked out of the pool',
+      lambda: connection_pool.in_use() if connection_pool else 0)
+Gauge('db_pool_connections_open', 'Connections currently open',
+      lambda: connection_pool.size() if connection_pool else 0)
+Gauge('db_pool_connections_max', 'Maximum size of the pool',
+      lambda: connection_pool.maxconn if connection_pool else 0)
+
+# Set to stop the partition maintenance thread
+maintenance_stop = threading.Event()
+
+# Opens a new database connection, used by the pool and for connections
+# that stay outside it such as the snapshot feed's LISTEN connection
+def connect():
+    return psycopg2.connect(
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT
+    )
+
+# The storage backend that storage.py reads and writes through
+def get_backend():
+    global backend
+    if backend is None:
+        backend = create_backend(DB_BACKEND)
+    return backend
+
+# Switches to another backend, e.g. for benchmarks. Call before init_db()
+def use_backend(name):
+    global backend
+    backend = create_backend(name)
+    return backend
 
-# Connects to database and creates tables when application is started
-def init_db():
+# Opens the storage backend and creates tables when application is started.
+# API worker processes pass create=False as tables are made before they fork
+def init_db(create=True):
+    get_backend().init(create)
+
+# Creates the Postgres connection pool and, unless create is False, the tables
+def open_pool(create=True):
 
     logging.info("Connecting to database...")
     global connection_pool
 
     try:
-        # Create connection pool
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
+        # Create thread-safe connection pool, sized by DB_POOL_MIN/DB_POOL_MAX
+        connection_pool = ConnectionPool(connect)
         
         logging.info("Connection pool created successfully")
 
         # Requests connection from the pool
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
+        if create:
+            with pooled_connection() as conn:
+                create_tables(conn)
 
-        try:
-            # Create table for valid_snapshots
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS valid_snapshots(
-                    id SERIAL PRIMARY KEY,
-                    time TIMESTAMP NOT NULL,
-                    value REAL NOT NULL,
-                    tags TEXT[] NOT NULL
-                )
-            """)
+    except Exception as e:
+        logging.error(f"Error connecting to database: {e}")
+        raise
 
-            # Add indexing for time queries
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_valid_time
-                ON valid_snapshots(time)
-            """)
+# Creates tables, indexes and partitions if they don't exist yet
+def create_tables(connection):
+    cursor = connection.cursor()
+
+    try:
+        # Create table for valid_snapshots, partitioned by time so old
+        # data can be dropped a partition at a time. The partition key
+        # has to be part of the primary key
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS valid_snapshots(
+                id SERIAL,
+                time TIMESTAMP NOT NULL,
+                value REAL NOT NULL,
+                tags TEXT[] NOT NULL,
+                source TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (id, time)
+            ) PARTITION BY RANGE (time)
+        """)
+
+        # Add indexing for time queries
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_valid_time
+            ON valid_snapshots(time)
+        """)
+
+        # Add indexing for tag containment (@>) and overlap (&&) queries
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_valid_tags
+            ON valid_snapshots USING GIN (tags)
+        """)
+
+        # Create table for discarded_snapshots, partitioned by time
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS discarded_snapshots(
+                id SERIAL,
+                time TIMESTAMP NOT NULL,
+                value REAL NOT NULL,
+                tags TEXT[] NOT NULL,
+                reason TEXT NOT NULL,
+                discarded_at TIMESTAMP NOT NULL,
+                source TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (id, time)
+            ) PARTITION BY RANGE (time)
+        """)
+
+        # Add indexing for time queries
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_discarded_time
+            ON discarded_snapshots(time)
+        """)
+
+        # Add indexing for queries filtered by reason
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_discarded_reason_time
+            ON discarded_snapshots(reason, time)
+        """)
+
+        # Add indexing for tag containment (@>) and overlap (&&) queries
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_discarded_tags
+            ON discarded_snapshots USING GIN (tags)
+        """)
+
+        # Create table for per-bucket aggregates of valid_snapshots
+        create_rollup_table(cursor)
+
+        # Store each reading only once
+        create_unique_keys(cursor)
+
+        # Create default partitions and those for the coming days or months
+        maintain_partitions(cursor)
+
+        connection.commit()
+        logging.info("Database tables created successfully")
 
-            # Create table for discarded_snapshots
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS discarded_snapshots(
-                    id SERIAL PRIMARY KEY,
-                    time TIMESTAMP NOT NULL,
-                    value REAL NOT NULL,
-                    tags TEXT[] NOT NULL,
-                    reason TEXT NOT NULL,
-                    discarded_at TIMESTAMP NOT NULL
-                )
+    finally:
+        # Ensure cursor closes
+        cursor.close()
+
+# Unique index on each table's natural key, so a reading returned by
+# several polls is only stored once. The source is part of it, as
+# different satellites can report the same time and tags
+UNIQUE_KEYS = {
+    'valid_snapshots': 'uq_valid_time_tags_source',
+    'discarded_snapshots': 'uq_discarded_time_tags_source'
+}
+
+# (time, tags) indexes made by earlier versions, replaced by UNIQUE_KEYS
+OLD_UNIQUE_KEYS = {
+    'valid_snapshots': 'uq_valid_time_tags',
+    'discarded_snapshots': 'uq_discarded_time_tags'
+}
+
+# Adds the source column to tables made before it existed. Rows already
+# stored get an empty source
+def add_source_column(cursor, table):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'source'
+    """, (table,))
+    if cursor.fetchone() is None:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN source TEXT NOT NULL DEFAULT ''")
+
+# Creates the (time, tags, source) unique indexes. Nothing is deleted here:
+# if snapshots were stored twice before there was a unique key, starting
+# fails until they are removed with 'python main.py --mode migrate'
+def create_unique_keys(cursor):
+    for table, index in UNIQUE_KEYS.items():
+        add_source_column(cursor, table)
+
+        cursor.execute("SELECT to_regclass(%s)", (index,))
+        if cursor.fetchone()[0] is None:
+            cursor.execute(f"""
+                SELECT count(*) FROM (
+                    SELECT 1 FROM {table} GROUP BY time, tags, source HAVING count(*) > 1
+                ) AS repeated
             """)
+            repeated = cursor.fetchone()[0]
+            if repeated:
+                raise Exception(f"{table} has {repeated} snapshots stored more than once, "
+                                "run 'python main.py --mode migrate' to remove the duplicates")
+
+            cursor.execute(f"CREATE UNIQUE INDEX {index} ON {table} (time, tags, source)")
+
+        cursor.execute(f"DROP INDEX IF EXISTS {OLD_UNIQUE_KEYS[table]}")
 
-            # Add indexing for time queries
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_discarded_time
-                ON discarded_snapshots(time)
+# Removes snapshots stored more than once before the unique keys existed,
+# keeping the first of each and taking the others back out of the rollups.
+# Only run on request, see migrate_db()
+def remove_duplicate_snapshots(connection):
+    with connection.cursor() as cursor:
+        for table in UNIQUE_KEYS:
+            cursor.execute("SELECT to_regclass(%s)", (table,))
+            if cursor.fetchone()[0] is None:
+                continue
+            add_source_column(cursor, table)
+
+            cursor.execute(f"""
+                DELETE FROM {table} a USING {table} b
+                WHERE a.time = b.time AND a.tags = b.tags AND a.source = b.source AND a.id > b.id
+                RETURNING a.time, a.value, a.tags
             """)
+            duplicates = cursor.fetchall()
+            logging.info(f"Removed {len(duplicates)} duplicate snapshots from {table}")
+
+            cursor.execute("SELECT to_regclass('snapshot_rollups')")
+            if duplicates and table == 'valid_snapshots' and cursor.fetchone()[0] is not None:
+                subtract_rollups(cursor, duplicates)
 
-            connection.commit()
-            logging.info("Database tables created successfully")
+    connection.commit()
 
-        finally:    
-            # Ensure cursor closes and connection is returned
-            cursor.close()
-            connection_pool.putconn(connection)
+# Runs partition maintenance once
+def run_partition_maintenance():
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cursor:
+                maintain_partitions(cursor)
+            conn.commit()
 
     except Exception as e:
-        logging.error(f"Error connecting to database: {e}")
-        raise
+        logging.error(f"Error maintaining partitions: {e}")
+
+# Runs the backend's maintenance every PARTITION_MAINTENANCE_INTERVAL seconds
+# in a background thread. On Postgres this creates upcoming partitions and
+# drops expired ones, other backends delete expired rows
+def start_partition_maintenance():
+    maintenance_stop.clear()
+    current = get_backend()
+
+    def run():
+        while not maintenance_stop.wait(PARTITION_MAINTENANCE_INTERVAL):
+            current.maintain()
+
+    thread = threading.Thread(target=run, name='partition-maintenance', daemon=True)
+    thread.start()
+    return thread
 
 # Request a connection from connection_pool
 def get_connection():
@@ -92,7 +264,9 @@ def get_connection():
         logging.error("Connection pool doesnt exist")
         raise Exception("Connection pool not initialized. Call init_db() first.")
 
+    started = time.perf_counter()
     connection = connection_pool.getconn()
+    pool_wait.observe(time.perf_counter() - started)
     return connection
 
 # Release connection from pool once task has been executed
@@ -104,8 +278,47 @@ def release_connection(conn):
         # If can't release then crash program to prevent connection leak
         raise
 
-# Close connection pool when server is stopped
+# Checks out a connection for the duration of a with block and always
+# returns it, rolling back anything left uncommitted
+@contextmanager
+def pooled_connection():
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+# Brings tables made by earlier versions up to date, including changes
+# that delete data. Run once with 'python main.py --mode migrate'
+def migrate_db():
+    get_backend().migrate()
+
+# True if the database answers a simple query, used by health checks
+def check_db():
+    return get_backend().check()
+
+# Register a function to run when close_pool() is called
+def register_close_hook(hook):
+    if hook not in close_hooks:
+        close_hooks.append(hook)
+
+# Close the storage backend when server is stopped
 def close_pool():
+    maintenance_stop.set()
+
+    # Run hooks first so they can still use the pool
+    for hook in close_hooks:
+        try:
+            hook()
+        except Exception as e:
+            logging.error(f'Error running close hook: {e}')
+
+    get_backend().close()
+
+# Closes every connection in the Postgres pool
+def close_connections():
+    global connection_pool
     if connection_pool:
         connection_pool.closeall()
+        connection_pool = None
         logging.info("Connection pool closed")
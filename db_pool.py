@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from collections import deque
+from psycopg2 import extensions
+from config import (DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_MAX_AGE,
+                    DB_POOL_IDLE_TIMEOUT, DB_POOL_CHECK_AFTER)
+
+# Raised when no connection frees up within the checkout timeout
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection:
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+# Thread-safe connection pool shared by the ingest threads and the API's
+# request threads. Opens connections on demand between minconn and maxconn,
+# makes callers wait up to 'timeout' seconds when all are in use, checks
+# connections that have sat idle before handing them out and replaces
+# connections older than max_age
+class ConnectionPool:
+
+    def __init__(self, connect, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, max_age=DB_POOL_MAX_AGE,
+                 idle_timeout=DB_POOL_IDLE_TIMEOUT, check_after=DB_POOL_CHECK_AFTER):
+        if not 0 <= minconn <= maxconn or maxconn < 1:
+            raise ValueError(f"Invalid pool size: min {minconn}, max {maxconn}")
+
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+
+        # Most recently returned connections are reused first, so extra
+        # connections go idle and can be closed
+        self._idle = deque()
+        self._used = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for _ in range(minconn):
+            self._idle.append(PooledConnection(self._connect()))
+            self._size += 1
+
+    def in_use(self):
+        return len(self._used)
+
+    def size(self):
+        return self._size
+
+    # Check out a connection, waiting up to 'timeout' seconds for one to free up
+    def getconn(self, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception("Connection pool is closed")
+
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+
+                # Room to grow, reserve a slot and connect outside the lock
+                if self._size < self.maxconn:
+                    self._size += 1
+                    entry = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No database connection free after {self.timeout}s "
+                                      f"({self.maxconn} in use)")
+                self._cond.wait(remaining)
+
+        if entry is None:
+            entry = self._open_reserved()
+        elif not self._usable(entry):
+            self._close_quietly(entry.connection)
+            entry = self._open_reserved()
+
+        with self._cond:
+            self._used[id(entry.connection)] = entry
+        return entry.connection
+
+    # Return a connection, ending any open transaction. Broken or expired
+    # connections are closed instead of going back in the pool
+    def putconn(self, connection, close=False):
+        with self._cond:
+            entry = self._used.pop(id(connection), None)
+        if entry is None:
+            raise Exception("Connection does not belong to this pool")
+
+        if not close and not connection.closed:
+            try:
+                if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception as e:
+                logging.warning(f"Discarding connection that failed to reset: {e}")
+                close = True
+
+        now = time.monotonic()
+        expired = now - entry.created > self.max_age
+
+        with self._cond:
+            if close or connection.closed or expired or self._closed:
+                self._size -= 1
+                discard = entry
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+                discard = None
+
+            stale = self._prune_idle(now)
+            self._cond.notify()
+
+        if discard is not None:
+            self._close_quietly(discard.connection)
+        for idle in stale:
+            self._close_quietly(idle.connection)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            used = list(self._used.values())
+            self._idle.clear()
+            self._used.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+        for entry in idle + used:
+            self._close_quietly(entry.connection)
+
+    # Connect for a slot reserved in getconn, giving the slot back on failure
+    def _open_reserved(self):
+        try:
+            return PooledConnection(self._connect())
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    # A connection is checked with a round trip only if it has sat idle
+    # for more than check_after seconds
+    def _usable(self, entry):
+        now = time.monotonic()
+        connection = entry.connection
+
+        if connection.closed or now - entry.created > self.max_age:
+            return False
+        if now - entry.last_used <= self.check_after:
+            return True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except Exception as e:
+            logging.warning(f"Discarding broken pooled connection: {e}")
+            return False
+
+    # Idle connections above minconn unused for idle_timeout seconds,
+    # removed from the pool. Called with the lock held
+    def _prune_idle(self, now):
+        stale = []
+        while (self._idle and self._size > self.minconn
+               and now - self._idle[0].last_used > self.idle_timeout):
+            stale.append(self._idle.popleft())
+            self._size -= 1
+        return stale
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
@@ -0,0 +1,104 @@
+import csv
+import io
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # CSV export still works without pyarrow
+    pa = None
+    pq = None
+
+# Export formats and their content types
+FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'csv': 'text/csv'
+}
+
+# Formats that need pyarrow
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+if pa is not None:
+    # Columns of an exported valid snapshot
+    SCHEMA = pa.schema([
+        ('id', pa.int64()),
+        ('time', pa.timestamp('us')),
+        ('value', pa.float32()),
+        ('tags', pa.list_(pa.string()))
+    ])
+
+def available(export_format):
+    return export_format not in COLUMNAR_FORMATS or pa is not None
+
+# Builds an Arrow record batch from (id, time, value, tags) rows, one
+# column at a time so no per-row dictionary is created
+def record_batch(rows):
+    ids, times, values, tags = zip(*rows)
+    return pa.record_batch([
+        pa.array(ids, pa.int64()),
+        pa.array(times, pa.timestamp('us')),
+        pa.array(values, pa.float32()),
+        pa.array(tags, pa.list_(pa.string()))
+    ], schema=SCHEMA)
+
+# Write-only file object that hands back what has been written so far,
+# so pyarrow's writers can be streamed as they go
+class ChunkSink(io.RawIOBase):
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Yields an Arrow IPC stream (arrow) or Parquet file (parquet), one record
+# batch (or row group) per batch of rows
+def generate_columnar(batches, export_format):
+    sink = ChunkSink()
+    if export_format == 'arrow':
+        writer = pa.ipc.new_stream(sink, SCHEMA)
+    else:
+        writer = pq.ParquetWriter(sink, SCHEMA)
+
+    try:
+        for rows in batches:
+            if export_format == 'arrow':
+                writer.write_batch(record_batch(rows))
+            else:
+                writer.write_table(pa.Table.from_batches([record_batch(rows)]))
+            yield sink.drain()
+    finally:
+        # Footer (parquet) or end-of-stream marker (arrow)
+        writer.close()
+    yield sink.drain()
+
+# Yields CSV with an id,time,value,tags header, tags separated by ';'
+def generate_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('id', 'time', 'value', 'tags'))
+
+    for rows in batches:
+        for id, time, value, tags in rows:
+            writer.writerow((id, time.isoformat(), value, ';'.join(tags)))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+# Encodes batches of valid snapshot rows in the given format
+def generate_export(batches, export_format):
+    if export_format == 'csv':
+        return generate_csv(batches)
+    return generate_columnar(batches, export_format)
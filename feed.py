@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import threading
+from datetime import datetime
+from psycopg2 import sql
+from database import connect, pooled_connection, register_close_hook
+from storage import VALID, DISCARDED
+from metrics import Gauge, feed_events, feed_dropped
+from config import FEED_BUFFER_SIZE, FEED_MAX_SUBSCRIBERS, FEED_CHANNEL
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+# Sent in place of a row too large for a NOTIFY payload, so listeners know
+# a snapshot was saved that they weren't told about
+MISSED = 'missed'
+
+# First item of every payload, [ORIGIN, host:pid] of the process that sent
+# it, so a listener can skip snapshots its own process has already seen
+ORIGIN = 'origin'
+
+def origin_item():
+    return json.dumps([ORIGIN, f'{socket.gethostname()}:{os.getpid()}'])
+
+# Raised when a worker already has FEED_MAX_SUBSCRIBERS open streams
+class FeedFull(Exception):
+    pass
+
+# A saved snapshot, encoded once as a Server-Sent Event and shared by
+# every subscriber it is sent to
+class FeedEvent:
+    __slots__ = ('kind', 'tags', 'message')
+
+    def __init__(self, kind, tags, message):
+        self.kind = kind
+        self.tags = tags
+        self.message = message
+
+# Builds the event for a valid (id, time, value, tags) or discarded
+# (id, time, value, tags, reason, discarded_at) row
+def snapshot_event(kind, row):
+    data = {'time': row[1].isoformat(), 'value': row[2], 'tags': row[3]}
+    if kind == DISCARDED:
+        data['reason'] = row[4]
+        data['discarded_at'] = row[5].isoformat()
+    return FeedEvent(kind, row[3], f"event: {kind}\ndata: {json.dumps(data)}\n\n")
+
+# One open stream. Events wait in a bounded queue until the client's
+# request thread sends them
+class Subscription:
+
+    def __init__(self, kinds, tags_all=None, tags_any=None, buffer_size=FEED_BUFFER_SIZE):
+        self.kinds = frozenset(kinds)
+        self.tags_all = tags_all
+        self.tags_any = tags_any
+        self.events = queue.Queue(buffer_size)
+        self.dropped = False
+
+    # Same tag rules as the tag, tags_all and tags_any query parameters
+    def wants(self, event):
+        if event.kind not in self.kinds:
+            return False
+        if self.tags_all and not all(tag in event.tags for tag in self.tags_all):
+            return False
+        if self.tags_any and not any(tag in event.tags for tag in self.tags_any):
+            return False
+        return True
+
+    # Waits up to 'timeout' seconds for an event, then takes whatever else
+    # is already queued so a burst goes out in one write. Returns [] on timeout
+    def get_batch(self, timeout, max_events=100):
+        try:
+            batch = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < max_events:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+# In-process fan-out: each published event is put on the queue of every
+# subscriber that wants it. A subscriber whose queue is full is dropped
+# rather than slowing down the publisher or the other subscribers
+class Broker:
+
+    def __init__(self, buffer_size=FEED_BUFFER_SIZE, max_subscribers=FEED_MAX_SUBSCRIBERS):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def count(self):
+        return len(self._subscribers)
+
+    def subscribe(self, kinds, tags_all=None, tags_any=None):
+        subscription = Subscription(kinds, tags_all, tags_any, self.buffer_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise FeedFull(f"Live feed already has {self.max_subscribers} subscribers")
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, events):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            for event in events:
+                if not subscription.wants(event):
+                    continue
+                try:
+                    subscription.events.put_nowait(event)
+                except queue.Full:
+                    subscription.dropped = True
+                    self.unsubscribe(subscription)
+                    feed_dropped.inc()
+                    logging.warning(f"Dropped live feed subscriber more than {self.buffer_size} events behind")
+                    break
+
+broker = Broker()
+
+# Open streams, read when /metrics is scraped
+Gauge('feed_subscribers', 'Open live feed streams in this process', broker.count)
+
+# Write listener that pushes saved snapshots to this process's subscribers.
+# Events are only encoded when someone is listening
+def publish_rows(valid_rows, discarded_rows):
+    if not broker.count():
+        return
+
+    events = [snapshot_event(VALID, row) for row in valid_rows]
+    events.extend(snapshot_event(DISCARDED, row) for row in discarded_rows)
+    broker.publish(events)
+    feed_events.inc(len(events))
+
+# Encodes rows as JSON arrays of [kind, id, time, value, tags, ...], split
+# into as few payloads as fit under the NOTIFY size limit, each starting
+# with the origin item. A row that doesn't fit in a payload of its own is
+# sent as [MISSED, id]
+def encode_rows(valid_rows, discarded_rows):
+    items = []
+    for row in valid_rows:
+        items.append((row[0], json.dumps([VALID, row[0], row[1].isoformat(), row[2], row[3]])))
+    for row in discarded_rows:
+        items.append((row[0], json.dumps([DISCARDED, row[0], row[1].isoformat(), row[2], row[3], row[4],
+                                          row[5].isoformat()])))
+
+    origin = origin_item()
+    empty_size = len(origin.encode()) + 2
+    payloads = []
+    current = [origin]
+    size = empty_size
+    for row_id, item in items:
+        if empty_size + len(item.encode()) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            logging.warning(f"Snapshot too large for the live feed, not sent: {item[:100]}")
+            item = json.dumps([MISSED, row_id])
+        if len(current) > 1 and size + len(item.encode()) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            payloads.append('[' + ','.join(current) + ']')
+            current = [origin]
+            size = empty_size
+        current.append(item)
+        size += len(item.encode()) + 1
+
+    if len(current) > 1:
+        payloads.append('[' + ','.join(current) + ']')
+    return payloads
+
+# Turns a payload back into (valid_rows, discarded_rows, missed), where
+# missed is the number of rows that were too large to send
+def decode_payload(payload):
+    valid_rows = []
+    discarded_rows = []
+    missed = 0
+    for item in json.loads(payload):
+        if item[0] == ORIGIN:
+            continue
+        if item[0] == MISSED:
+            missed += 1
+        elif item[0] == VALID:
+            valid_rows.append((item[1], datetime.fromisoformat(item[2]), item[3], item[4]))
+        else:
+            discarded_rows.append((item[1], datetime.fromisoformat(item[2]), item[3], item[4], item[5],
+                                   datetime.fromisoformat(item[6])))
+    return valid_rows, discarded_rows, missed
+
+# Write listener used by the ingest process to send saved snapshots to
+# API workers in other processes
+def notify_rows(valid_rows, discarded_rows):
+    send_payloads(encode_rows(valid_rows, discarded_rows))
+
+# Tells API workers snapshots were saved without sending them, e.g. after
+# backfilling history that isn't news to live feed subscribers. Listeners
+# treat it like a row too large to send
+def notify_missed():
+    send_payloads(['[' + origin_item() + ',' + json.dumps([MISSED, None]) + ']'])
+
+def send_payloads(payloads):
+    if not payloads:
+        return
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            for payload in payloads:
+                cursor.execute("SELECT pg_notify(%s, %s)", (FEED_CHANNEL, payload))
+        connection.commit()
+
+# Background thread in each API worker that LISTENs for snapshots saved by
+# the ingest process and passes them to on_rows(valid_rows, discarded_rows).
+# One connection per worker, however many clients are subscribed. on_connect
+# is called each time LISTEN starts and on_disconnect when the connection is
+# lost, as snapshots saved in between are never received. on_missed is
+# called after a notification that left out rows too large to send. With
+# skip_own, notifications sent by this process are ignored, for an API in
+# a process whose write listeners already see what it saves
+class FeedListener:
+
+    def __init__(self, on_rows, channel=FEED_CHANNEL, reconnect_delay=5.0,
+                 on_connect=None, on_disconnect=None, on_missed=None, skip_own=False):
+        self.on_rows = on_rows
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_missed = on_missed
+        self.skip_own = skip_own
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='feed-listener', daemon=True)
+        self._thread.start()
+        register_close_hook(self.stop)
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = connect()
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                logging.info(f"Listening for saved snapshots on '{self.channel}'")
+                if self.on_connect:
+                    self.on_connect()
+
+                while not self._stop.is_set():
+                    # Wake up every second to check for stop()
+                    if not select.select([connection], [], [], 1.0)[0]:
+                        continue
+
+                    connection.poll()
+                    while connection.notifies:
+                        self._handle(connection.notifies.pop(0).payload)
+
+            except Exception as e:
+                logging.error(f"Live feed listener error, reconnecting: {e}")
+                if self.on_disconnect:
+                    self.on_disconnect()
+                self._stop.wait(self.reconnect_delay)
+
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _handle(self, payload):
+        # The process id is read each time, the listener may have been forked
+        if self.skip_own and payload.startswith('[' + origin_item()):
+            return
+        try:
+            valid_rows, discarded_rows, missed = decode_payload(payload)
+            self.on_rows(valid_rows, discarded_rows)
+            if missed and self.on_missed:
+                self.on_missed()
+        except Exception as e:
+            logging.error(f"Error handling live feed notification: {e}")
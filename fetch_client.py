@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (FETCH_CONNECT_TIMEOUT, FETCH_RETRIES, FETCH_BACKOFF,
+                    FETCH_BACKOFF_JITTER, FETCH_BACKOFF_MAX,
+                    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, POLL_TIMEOUT)
+
+# Raised instead of making a request while a data-server's circuit is open
+class CircuitOpenError(Exception):
+    pass
+
+# Stops requests to a data-server after repeated failures. Once the cooldown
+# has passed a single trial request is let through, closing the circuit
+# again if it succeeds
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    # Check a request may be made, raising CircuitOpenError if not
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpenError(f"Circuit open, retrying in {max(remaining, 0):.0f}s")
+
+            # Cooldown over, let one request through to test the server
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info("Data-server recovered, circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # Open, or restart the cooldown after a failed trial request
+                self.opened_at = time.monotonic()
+                logging.warning("Data-server failed %d times, circuit open for %ss", self.failures, self.cooldown)
+
+# Keeps a pooled keep-alive session per data-server so each poll reuses a
+# warm connection, with timeouts, retries and a circuit breaker
+class FetchClient:
+
+    def __init__(self, connect_timeout=FETCH_CONNECT_TIMEOUT, retries=FETCH_RETRIES,
+                 breaker=None):
+        self.connect_timeout = connect_timeout
+        self.breaker = breaker or CircuitBreaker()
+
+        # Retry connection errors and 5xx responses, but not read timeouts
+        # so a stalled server costs at most one read timeout per poll
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            other=0,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods={'GET'},
+            backoff_factor=FETCH_BACKOFF,
+            backoff_jitter=FETCH_BACKOFF_JITTER,
+            backoff_max=FETCH_BACKOFF_MAX,
+            raise_on_status=False,
+            respect_retry_after_header=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=4)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, timeout=POLL_TIMEOUT):
+        self.breaker.before_request()
+
+        try:
+            response = self.session.get(url, timeout=(self.connect_timeout, timeout))
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+
+        # Still failing after retries counts against the server
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def close(self):
+        self.session.close()
+
+clients = {}
+clients_lock = threading.Lock()
+
+# Returns the shared client for the data-server a url points at
+def get_client(url):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+
+    with clients_lock:
+        client = clients.get(key)
+        if client is None:
+            client = FetchClient()
+            clients[key] = client
+        return client
+
+# Fetch a url through its data-server's shared client
+def fetch(url, timeout=POLL_TIMEOUT):
+    return get_client(url).get(url, timeout)
+
+# Close every session, used on shutdown
+def close_clients():
+    with clients_lock:
+        for client in clients.values():
+            client.close()
+        clients.clear()
@@ -0,0 +1,272 @@
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from itertools import islice
+from cache import naive
+from backends.memory import row_matcher
+from storage import VALID, DISCARDED, iter_valid_snapshots, iter_discarded_snapshots
+from metrics import Gauge, hot_window_reads
+from config import HOT_WINDOW_HOURS, HOT_WINDOW_MAX_ROWS
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Rows loaded from the database per turn of the lock
+LOAD_CHUNK_ROWS = 1000
+
+# Dropped rows are only cut out of the arrays once there are this many,
+# and they make up over half of them
+COMPACT_AFTER = 4096
+
+# Times are held as whole microseconds since EPOCH, so they fit in a
+# 64-bit integer array and compare exactly
+def to_micros(time):
+    return (naive(time) - EPOCH) // MICROSECOND
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+# Recent rows of one kind in parallel arrays sorted by (time, id). Rows
+# before 'head' have been dropped but not cut out yet, so the arrays work as
+# a ring buffer that only shifts now and then. Every stored row from 'since'
+# on is held
+class WindowTable:
+
+    def __init__(self, kind, since):
+        self.kind = kind
+        self.since = since
+        self.head = 0
+        self.times = array('q')
+        self.ids = array('q')
+        self.values = array('d')
+        self.tags = []
+        self.reasons = []
+        self.discarded_at = array('q')
+        # One list per distinct set of tags, shared by the rows that have it
+        self._tags = {}
+
+    def __len__(self):
+        return len(self.times) - self.head
+
+    # Adds a row read back from the database or passed to write listeners.
+    # Rows before 'since' and rows already held are skipped
+    def insert(self, row):
+        time = to_micros(row[1])
+        if time < self.since:
+            return
+
+        # Rows with the same time are few, so walk them to find the id's place
+        position = bisect_left(self.times, time, self.head)
+        same_time = bisect_right(self.times, time, position)
+        while position < same_time and self.ids[position] < row[0]:
+            position += 1
+        if position < same_time and self.ids[position] == row[0]:
+            return
+
+        key = tuple(row[3])
+        tags = self._tags.get(key)
+        if tags is None:
+            tags = self._tags[key] = list(key)
+
+        self.times.insert(position, time)
+        self.ids.insert(position, row[0])
+        self.values.insert(position, row[2])
+        self.tags.insert(position, tags)
+        if self.kind == DISCARDED:
+            self.reasons.insert(position, row[4])
+            self.discarded_at.insert(position, to_micros(row[5]))
+
+    # Drops rows before cutoff, then the oldest rows while there are more
+    # than max_rows. Rows sharing a time are dropped together, so 'since'
+    # stays exact
+    def evict(self, cutoff, max_rows):
+        if cutoff > self.since:
+            self.since = cutoff
+        if len(self) > max_rows:
+            self.since = max(self.since, self.times[len(self.times) - max_rows])
+        self.head = bisect_left(self.times, self.since, self.head)
+
+        if self.head >= COMPACT_AFTER and self.head * 2 > len(self.times):
+            self._compact()
+
+    def _compact(self):
+        head = self.head
+        for column in (self.times, self.ids, self.values, self.tags):
+            del column[:head]
+        if self.kind == DISCARDED:
+            del self.reasons[:head]
+            del self.discarded_at[:head]
+        self.head = 0
+        self._tags = {tuple(tags): tags for tags in self.tags}
+
+    # The row at 'index' as the database returns it
+    def row(self, index):
+        if self.kind == VALID:
+            return (self.ids[index], from_micros(self.times[index]), self.values[index], self.tags[index])
+        return (self.ids[index], from_micros(self.times[index]), self.values[index], self.tags[index],
+                self.reasons[index], from_micros(self.discarded_at[index]))
+
+    # Rows from start to end inclusive, after the (time, id) cursor, that
+    # pass 'match', up to 'limit' of them. Found by binary search on the times
+    def select(self, start, end, after=None, match=None, limit=None):
+        low = bisect_left(self.times, max(start, self.since), self.head)
+        high = bisect_right(self.times, end, low)
+
+        if after:
+            after_time = to_micros(after[0])
+            first = bisect_left(self.times, after_time, self.head)
+            while first < len(self.times) and self.times[first] == after_time and self.ids[first] <= after[1]:
+                first += 1
+            low = max(low, first)
+
+        rows = []
+        for index in range(low, high):
+            row = self.row(index)
+            if match is None or match(row):
+                rows.append(row)
+                if limit and len(rows) >= limit:
+                    break
+        return rows
+
+# The last HOT_WINDOW_HOURS of valid and discarded snapshots, held by an
+# API process so recent pages are read without a database round trip. It is
+# filled from the database by start() and then kept up to date from write
+# listeners, so it is only started in processes that are told about every
+# saved snapshot
+class HotWindow:
+
+    def __init__(self, hours=HOT_WINDOW_HOURS, max_rows=HOT_WINDOW_MAX_ROWS):
+        self.hours = hours
+        self.max_rows = max_rows
+        self.ready = False
+        self._accepting = False
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def rows(self):
+        with self._lock:
+            return sum(len(table) for table in self._tables.values())
+
+    def _cutoff(self):
+        return to_micros(datetime.now() - timedelta(hours=self.hours))
+
+    # Empties the window and loads the last 'hours' of snapshots. Snapshots
+    # saved meanwhile are taken from add() as well, rows already held are
+    # recognized by their (time, id) and skipped
+    def start(self):
+        if self.hours <= 0:
+            return
+
+        since = self._cutoff()
+        with self._lock:
+            self.ready = False
+            self._tables = {VALID: WindowTable(VALID, since), DISCARDED: WindowTable(DISCARDED, since)}
+            self._accepting = True
+
+        start = from_micros(since)
+        try:
+            self._load(VALID, iter_valid_snapshots(start, datetime.max))
+            self._load(DISCARDED, iter_discarded_snapshots(start, datetime.max, None))
+        except Exception as e:
+            logging.error("Error loading the hot window, reading from the database instead: %s", e)
+            self.stop()
+            return
+
+        with self._lock:
+            self.ready = True
+        logging.info("Hot window loaded with %d snapshots from the last %g hours", self.rows(), self.hours)
+
+    def _load(self, kind, rows):
+        while True:
+            chunk = list(islice(rows, LOAD_CHUNK_ROWS))
+            if not chunk:
+                break
+            with self._lock:
+                table = self._tables[kind]
+                for row in chunk:
+                    table.insert(row)
+
+    # Stops answering from the window, e.g. while saved snapshots can't be received
+    def stop(self):
+        with self._lock:
+            self.ready = False
+            self._accepting = False
+            self._tables = {}
+
+    # Write listener, called with the rows of each committed batch
+    def add(self, valid_rows, discarded_rows):
+        if not self._accepting:
+            return
+
+        cutoff = self._cutoff()
+        with self._lock:
+            if not self._tables:
+                return
+            for kind, rows in ((VALID, valid_rows), (DISCARDED, discarded_rows)):
+                table = self._tables[kind]
+                for row in rows:
+                    table.insert(row)
+                table.evict(cutoff, self.max_rows)
+
+    # Time from which every 'kind' row is held, or None when the window isn't ready
+    def since(self, kind):
+        with self._lock:
+            if not self.ready:
+                return None
+            table = self._tables[kind]
+            table.evict(self._cutoff(), self.max_rows)
+            return from_micros(table.since)
+
+    # True if the window holds rows for part of a window ending at 'end'
+    def holds(self, kind, end):
+        since = self.since(kind)
+        return since is not None and naive(end) >= since
+
+    # Reads a page of 'kind' rows ordered by (time, id). The part of the
+    # range the window holds is read from it, anything older comes from
+    # read_db(start, end, limit, after) and goes first. 'filters' is
+    # (reason, tags_all, tags_any)
+    def read(self, kind, start, end, limit, after, filters, read_db):
+        since = self.since(kind)
+        if since is None:
+            return read_db(start, end, limit, after)
+
+        if naive(end) < since:
+            hot_window_reads.labels('database').inc()
+            return read_db(start, end, limit, after)
+
+        match = row_matcher(*filters)
+        if naive(start) >= since or (after and naive(after[0]) >= since):
+            rows = self._select(kind, since, start, end, after, match, limit)
+            if rows is not None:
+                hot_window_reads.labels('window').inc()
+                return rows
+            return read_db(start, end, limit, after)
+
+        # Straddles the edge of the window, older rows come from the database
+        rows = read_db(start, since - MICROSECOND, limit, after)
+        if limit and len(rows) >= limit:
+            hot_window_reads.labels('database').inc()
+            return rows
+
+        recent = self._select(kind, since, since, end, after, match, limit and limit - len(rows))
+        if recent is None:
+            return read_db(start, end, limit, after)
+        hot_window_reads.labels('both').inc()
+        return rows + recent
+
+    # Reads from the window, or returns None if rows after 'since' have been
+    # dropped since it was checked
+    def _select(self, kind, since, start, end, after, match, limit):
+        with self._lock:
+            table = self._tables.get(kind)
+            if not self.ready or table is None or table.since > to_micros(since):
+                return None
+            return table.select(to_micros(start), to_micros(end), after, match, limit)
+
+hot_window = HotWindow()
+
+# Rows held, read when /metrics is scraped
+Gauge('hot_window_rows', 'Snapshots held in the hot window', hot_window.rows)
@@ -0,0 +1,151 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from datetime import datetime, date
+from metrics import log_records_dropped
+from config import (LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_ROTATE, LOG_MAX_BYTES,
+                    LOG_ROTATE_WHEN, LOG_BACKUP_COUNT, LOG_QUEUE_SIZE)
+
+TEXT_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Argument types that can't change after the call, so formatting them can
+# wait for the writer thread
+IMMUTABLE_TYPES = (str, int, float, bool, type(None), datetime, date)
+
+# One JSON object per line with the time, level, logger, thread and message,
+# plus any fields passed with extra=
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+# Puts records on a bounded queue for the writer thread. The message is
+# only formatted here when an argument could change before the writer gets
+# to it, and a full queue drops the record rather than blocking the caller
+class LogQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        if record.exc_info or not all(isinstance(arg, IMMUTABLE_TYPES) for arg in self._args(record)):
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+    @staticmethod
+    def _args(record):
+        if isinstance(record.args, dict):
+            return record.args.values()
+        return record.args or ()
+
+listener = None
+queue_handler = None
+
+def build_formatter(log_format=LOG_FORMAT):
+    return JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+
+# File handler for LOG_FILE. With rotate=False the file is reopened when
+# another process rotates it, for processes sharing the ingest process's log
+def build_file_handler(path=LOG_FILE, rotate=True):
+    if not rotate:
+        return logging.handlers.WatchedFileHandler(path, delay=True)
+    if LOG_ROTATE == 'size':
+        return logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES,
+                                                    backupCount=LOG_BACKUP_COUNT, delay=True)
+    if LOG_ROTATE == 'time':
+        return logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN,
+                                                         backupCount=LOG_BACKUP_COUNT, delay=True)
+    return logging.FileHandler(path, delay=True)
+
+# Sends every log record through a queue to a background thread that writes
+# them to LOG_FILE and the console, so slow disks don't hold up callers.
+# Safe to call again, the previous pipeline is stopped first
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT, path=LOG_FILE, rotate=True, console=True):
+    global listener, queue_handler
+    stop_logging()
+
+    formatter = build_formatter(log_format)
+    handlers = []
+    if path:
+        handlers.append(build_file_handler(path, rotate))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener.start()
+    return listener
+
+# Writes anything still queued and closes the log files
+def stop_logging():
+    global listener, queue_handler
+    if listener is None:
+        return
+
+    logging.getLogger().removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
+    queue_handler = None
+
+# Handler a forked child writes to instead of 'handler'. Only the process
+# that opened a log file rotates it, children reopen it when it is rotated
+def child_handler(handler):
+    if not isinstance(handler, logging.FileHandler):
+        return handler
+    if isinstance(handler, logging.handlers.WatchedFileHandler):
+        return handler
+    watched = logging.handlers.WatchedFileHandler(handler.baseFilename, delay=True)
+    watched.setFormatter(handler.formatter)
+    watched.setLevel(handler.level)
+    return watched
+
+# The writer thread doesn't survive fork, so a forked child (e.g. a
+# gunicorn worker) starts its own with a fresh queue and handlers that
+# leave rotation to the parent
+def _restart_in_child():
+    global listener
+    if listener is None:
+        return
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    handlers = [child_handler(handler) for handler in listener.handlers]
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
+
+atexit.register(stop_logging)
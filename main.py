@@ -1,39 +1,219 @@
-from satellite import get_snapshots
-from api import start_api
-from database import init_db, close_pool
-import time
+from poller import Poller, parse_sources
+from api import start_api, on_remote_write, on_remote_missed
+from hot_window import hot_window
+from database import init_db, migrate_db, close_pool, start_partition_maintenance, get_backend
+from fetch_client import close_clients
+from feed import FeedListener, notify_rows
+from storage import add_write_listener
+from server import serve_api, BaseApplication
+from logs import setup_logging, stop_logging
+from supervisor import IngestSupervisor
+from metrics import start_metrics_server
+from config import (API_HOST, API_PORT, API_WORKERS, API_THREADS, FEED_NOTIFY, INGEST_WORKERS,
+                    METRICS_HOST, METRICS_PORT)
+import argparse
+import signal
+import subprocess
+import sys
 import threading
 import logging
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s | %(levelname)s | %(message)s',
-    handlers=[
-        logging.FileHandler('snapshots.log'),
-        logging.StreamHandler()
-    ]
-)
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Satellite snapshot ingest and API')
+    parser.add_argument('--mode', choices=['ingest', 'api', 'all', 'migrate'], default='all',
+                        help="'ingest' polls satellites, 'api' serves the API, 'all' runs both (default), "
+                             "'migrate' updates tables made by earlier versions and exits")
+    parser.add_argument('--host', default=API_HOST, help='API bind address')
+    parser.add_argument('--port', type=int, default=API_PORT, help='API port')
+    parser.add_argument('--workers', type=int, default=API_WORKERS, help='API worker processes')
+    parser.add_argument('--threads', type=int, default=API_THREADS, help='Threads per API worker')
+    parser.add_argument('--dev-server', action='store_true',
+                        help="Serve the API with Flask's development server in a thread")
+    parser.add_argument('--ingest-workers', type=int, default=INGEST_WORKERS,
+                        help='Ingest processes to share satellite sources between')
+    # Set on the processes started by the ingest supervisor
+    parser.add_argument('--ingest-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--no-log-rotation', action='store_true',
+                        help='Leave rotating the log file to another process and reopen it when rotated. '
+                             "Always the case in '--mode api' and '--mode migrate'")
+    return parser.parse_args(argv)
+
+# Serves this process's metrics on METRICS_PORT unless it is 0. Ingest
+# counters live in the ingest process, which doesn't serve the API
+def serve_metrics():
+    return start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+# Polls every configured source until interrupted or sent SIGTERM,
+# then writes anything buffered and closes connections. on_ready is
+# called once the database is set up. A worker started by the ingest
+# supervisor leaves creating tables and partition maintenance to it
+def run_ingest(on_ready=None, worker=False):
+    poller = None
+    metrics_server = serve_metrics()
     try:
-        init_db()
+        init_db(create=not worker)
+        if on_ready:
+            on_ready()
 
-        # Run Flask server in background thread
-        api_thread = threading.Thread(target=start_api, daemon=True)
-        api_thread.start()
+        # Keep future partitions created and apply the retention policy
+        if not worker:
+            start_partition_maintenance()
 
-        # Fetch and validate snapshots once per second
-        while True:
-            get_snapshots()
-            time.sleep(1)
+        # Tell API processes about saved snapshots
+        if FEED_NOTIFY and get_backend().notifies:
+            add_write_listener(notify_rows)
+
+        # Fetch and validate snapshots from every configured source
+        poller = Poller(parse_sources())
+        signal.signal(signal.SIGTERM, lambda signum, frame: poller.stop())
+        poller.run()
+        logging.info("Shutting down servers...")
 
     except KeyboardInterrupt:
         logging.info("Shutting down servers...")
-        close_pool()
 
     except Exception as e:
         logging.error(f"Application error: {e}")
-        close_pool()
         raise
 
+    finally:
+        if poller:
+            poller.stop()
+        close_clients()
+        close_pool()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+# Shares the configured sources between 'workers' ingest processes and keeps
+# them running until interrupted or sent SIGTERM. Tables, partitions and
+# spools left by removed workers are managed here, each worker opens its
+# own connection pool
+def run_supervisor(workers, on_ready=None):
+    metrics_server = serve_metrics()
+    try:
+        init_db()
+        if on_ready:
+            on_ready()
+
+        start_partition_maintenance()
+
+        # Snapshots the supervisor saves from orphaned spools
+        if FEED_NOTIFY and get_backend().notifies:
+            add_write_listener(notify_rows)
+
+        supervisor = IngestSupervisor(parse_sources(), workers, [
+            sys.executable, __file__, '--mode', 'ingest', '--ingest-worker', '--no-log-rotation'
+        ])
+        supervisor.install_signal_handlers()
+        supervisor.run()
+        logging.info("Shutting down servers...")
+
+    except KeyboardInterrupt:
+        logging.info("Shutting down servers...")
+
+    finally:
+        close_pool()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+# Serves the API in the foreground. Tables are created here, before
+# gunicorn forks its workers. Workers couldn't share a 'memory' backend,
+# so it is served from this process
+def run_api(args):
+    init_db()
+
+    if args.dev_server or BaseApplication is None or not get_backend().shared:
+        if not args.dev_server:
+            logging.warning("gunicorn not available, using Flask's development server")
+        if FEED_NOTIFY and get_backend().notifies:
+            FeedListener(on_remote_write, on_connect=hot_window.start,
+                         on_disconnect=hot_window.stop, on_missed=on_remote_missed).start()
+        try:
+            start_api()
+        finally:
+            close_pool()
+        return
+
+    close_pool()
+    serve_api(args.host, args.port, args.workers, args.threads)
+
+# Starts the API as its own process so requests don't compete with
+# ingest for the GIL, returns the process or None if run in a thread.
+# A backend other processes can't see, like 'memory', keeps it in a thread
+def start_api_process(args):
+    backend = get_backend()
+    if args.dev_server or BaseApplication is None or not backend.shared:
+        # Run Flask server in background thread. Snapshots saved by this
+        # process reach the cache, live feed and hot window through write
+        # listeners. A shared backend can also be written by other processes,
+        # such as ingest workers or backfill, so the window is only used if
+        # they are announced with NOTIFY, and their notifications go through
+        # the same steps. Notifications this process sent are skipped
+        api_thread = threading.Thread(target=start_api, kwargs={'hot': not backend.shared},
+                                      daemon=True)
+        api_thread.start()
+        if backend.shared and FEED_NOTIFY and backend.notifies:
+            FeedListener(on_remote_write, on_connect=hot_window.start, on_disconnect=hot_window.stop,
+                         on_missed=on_remote_missed, skip_own=True).start()
+        return None
+
+    # The ingest process rotates the shared log file
+    return subprocess.Popen([
+        sys.executable, __file__, '--mode', 'api',
+        '--host', args.host, '--port', str(args.port),
+        '--workers', str(args.workers), '--threads', str(args.threads),
+        '--no-log-rotation'
+    ])
+
+# Only the ingest process rotates the log file. API processes and migrate
+# share it with an ingest process that may be running separately, so they
+# reopen it after it is rotated instead
+def rotates_log(args):
+    return args.mode in ('ingest', 'all') and not args.no_log_rotation
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(rotate=rotates_log(args))
+
+    try:
+        run(args)
+    finally:
+        stop_logging()
+
+def run(args):
+    if args.ingest_workers > 1 and not get_backend().shared:
+        logging.warning(f"The {get_backend().name} backend can't be shared between processes, "
+                        "ingesting in one process")
+        args.ingest_workers = 1
+
+    if args.ingest_worker:
+        ingest = lambda on_ready=None: run_ingest(on_ready, worker=True)
+    elif args.ingest_workers > 1:
+        ingest = lambda on_ready=None: run_supervisor(args.ingest_workers, on_ready)
+    else:
+        ingest = run_ingest
+
+    if args.mode == 'migrate':
+        try:
+            migrate_db()
+        finally:
+            close_pool()
+    elif args.mode == 'ingest':
+        ingest()
+    elif args.mode == 'api':
+        run_api(args)
+    else:
+        api_processes = []
+        try:
+            ingest(on_ready=lambda: api_processes.append(start_api_process(args)))
+        finally:
+            # SIGTERM lets the API finish in-flight requests
+            for api_process in api_processes:
+                if api_process is not None:
+                    api_process.terminate()
+                    api_process.wait()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
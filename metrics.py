@@ -0,0 +1,235 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Default response size buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Every metric, in the order they are shown on /metrics
+registry = []
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+# Base for metrics with optional labels. Children are created once per label
+# value and cached, so hot paths can keep a reference and only pay for the
+# increment
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, *values):
+        key = values[0] if len(values) == 1 else values
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def _label_values(self, key):
+        return key if isinstance(key, tuple) else (key,)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for key, child in list(self._children.items()):
+            labels = self._label_values(key) if self.label_names else ()
+            lines.extend(child.render(self.name, self.label_names, labels))
+        return lines
+
+class CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, label_names, label_values):
+        return [f'{name}{format_labels(label_names, label_values)} {self.value}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        # Unlabelled counters have a single child used directly
+        if not self.label_names:
+            self._default = self.labels(())
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket plus +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, label_names, label_values):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            labels = format_labels(label_names + ('le',), label_values + (bound,))
+            lines.append(f'{name}_bucket{labels} {total}')
+
+        labels = format_labels(label_names, label_values)
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {total}')
+        return lines
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, description, labels)
+        if not self.label_names:
+            self._default = self.labels(())
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    # Context manager that observes how long its block took
+    def time(self):
+        return Timer(self._default)
+
+class Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+# Gauge whose value is read from a function when /metrics is scraped
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, read):
+        super().__init__(name, description)
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge',
+                f'{self.name} {value}']
+
+# Text exposition format served on /metrics
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Answers GET /metrics with render_metrics() and anything else with 404
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes aren't logged
+    def log_message(self, format, *args):
+        pass
+
+# Serves /metrics on host:port from a background thread, for processes that
+# don't serve the API such as ingest. Returns the server, or None if the
+# port couldn't be bound
+def start_metrics_server(host, port):
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error("Couldn't serve metrics on %s:%d: %s", host, port, e)
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info("Serving metrics on %s:%d", host, server.server_address[1])
+    return server
+
+# Ingest metrics
+snapshots_fetched = Counter('snapshots_fetched_total', 'Snapshots fetched from data-servers')
+snapshots_valid = Counter('snapshots_valid_total', 'Snapshots that passed validation')
+snapshots_discarded = Counter('snapshots_discarded_total', 'Snapshots discarded, by reason', ['reason'])
+fetch_latency = Histogram('snapshot_fetch_seconds', 'Time to fetch a snapshot from a data-server')
+insert_latency = Histogram('snapshot_insert_seconds', 'Time to write a batch of snapshots to the database')
+insert_batch_size = Histogram('snapshot_insert_batch_rows', 'Rows written per batch',
+                              buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+snapshots_lost = Counter('snapshots_lost_total',
+                         'Snapshots dropped without being saved, by why: buffer_full or shutdown',
+                         ['reason'])
+snapshots_deduplicated = Counter('snapshots_deduplicated_total',
+                                 "Repeated snapshots that weren't stored again, by where they were caught",
+                                 ['stage'])
+
+# Logging metrics
+log_records_dropped = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+# Connection pool metrics
+pool_wait = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection')
+
+# API metrics
+request_latency = Histogram('http_request_duration_seconds', 'API request latency, by route', ['route'])
+response_size = Histogram('http_response_size_bytes', 'API response size, by route', ['route'],
+                          buckets=SIZE_BUCKETS)
+
+# Live feed metrics
+feed_events = Counter('feed_events_total', 'Snapshots published to the live feed')
+feed_dropped = Counter('feed_subscribers_dropped_total', 'Live feed subscribers disconnected for falling behind')
+
+# Hot window metrics
+hot_window_reads = Counter('hot_window_reads_total',
+                           'Snapshot pages read, by where they came from: window, database or both',
+                           ['source'])
@@ -0,0 +1,185 @@
+import logging
+from datetime import datetime, timedelta
+from psycopg2 import sql
+from config import PARTITION_INTERVAL, PARTITION_PREMAKE, RETENTION_DAYS
+
+# Tables partitioned by range on their time column
+PARTITIONED_TABLES = ('valid_snapshots', 'discarded_snapshots')
+
+# Start of the partition a time falls into
+def partition_start(time, interval=PARTITION_INTERVAL):
+    start = datetime(time.year, time.month, time.day)
+    if interval == 'month':
+        start = start.replace(day=1)
+    return start
+
+# Start of the partition after the one starting at 'start'
+def next_partition_start(start, interval=PARTITION_INTERVAL):
+    if interval == 'month':
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + timedelta(days=1)
+
+# Partition tables are named after the table and the start of their range,
+# e.g. valid_snapshots_p20260118 or valid_snapshots_p202601
+def partition_name(table, start, interval=PARTITION_INTERVAL):
+    suffix = start.strftime('%Y%m') if interval == 'month' else start.strftime('%Y%m%d')
+    return f'{table}_p{suffix}'
+
+# Reads the start of a partition's range back from its name
+def parse_partition_name(table, name):
+    prefix = f'{table}_p'
+    if not name.startswith(prefix):
+        return None
+
+    # Day partitions have 8 digit suffixes, month partitions 6
+    suffix = name[len(prefix):]
+    formats = {8: ('%Y%m%d', 'day'), 6: ('%Y%m', 'month')}
+    if not suffix.isdigit() or len(suffix) not in formats:
+        return None
+
+    fmt, interval = formats[len(suffix)]
+    try:
+        return datetime.strptime(suffix, fmt), interval
+    except ValueError:
+        return None
+
+# True if 'table' exists and is a partitioned table
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table,))
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+# Default partition catches rows outside every other partition's range,
+# e.g. old snapshots discarded for their age
+def create_default_partition(cursor, table):
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT
+    """).format(sql.Identifier(f'{table}_default'), sql.Identifier(table)))
+
+# Creates the partition for the current period and the next PARTITION_PREMAKE
+# periods, so inserts never have to wait for one to be made
+def create_partitions(cursor, table, now=None, premake=PARTITION_PREMAKE):
+    start = partition_start(now or datetime.now())
+
+    for _ in range(premake + 1):
+        end = next_partition_start(start)
+        name = partition_name(table, start)
+
+        # Savepoint so one failed partition doesn't abort the others
+        cursor.execute("SAVEPOINT create_partition")
+        try:
+            cursor.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+                FOR VALUES FROM (%s) TO (%s)
+            """).format(sql.Identifier(name), sql.Identifier(table)), (start, end))
+            cursor.execute("RELEASE SAVEPOINT create_partition")
+        except Exception as e:
+            # Usually rows for this range already sit in the default partition
+            cursor.execute("ROLLBACK TO SAVEPOINT create_partition")
+            logging.warning(f"Could not create partition {name}: {e}")
+
+        start = end
+
+# Time before which snapshots are expired, None when everything is kept
+def retention_cutoff(now=None, retention_days=RETENTION_DAYS):
+    if retention_days <= 0:
+        return None
+    return (now or datetime.now()) - timedelta(days=retention_days)
+
+# Deletes rows older than the retention cutoff from the default partition,
+# which holds rows outside every range partition and is never dropped
+def delete_expired_default_rows(cursor, table, now=None, retention_days=RETENTION_DAYS):
+    cutoff = retention_cutoff(now, retention_days)
+    if cutoff is None:
+        return 0
+
+    cursor.execute(sql.SQL("DELETE FROM {} WHERE time < %s").format(
+        sql.Identifier(f'{table}_default')), (cutoff,))
+    if cursor.rowcount:
+        logging.info(f"Deleted {cursor.rowcount} expired rows from {table}_default")
+    return cursor.rowcount
+
+# Gives rows in the default partition, such as backfilled history or late
+# readings, range partitions of their own so retention and partition
+# pruning apply to them. A range can't be created while the default
+# partition holds rows inside it, so each period's rows are moved out to a
+# temporary table first and inserted again once the partition exists
+def split_default_partition(cursor, table, interval=PARTITION_INTERVAL):
+    default = sql.Identifier(f'{table}_default')
+    cursor.execute(sql.SQL("SELECT DISTINCT date_trunc(%s, time) FROM {} ORDER BY 1").format(default),
+                   (interval,))
+
+    created = []
+    for (start,) in cursor.fetchall():
+        end = next_partition_start(start, interval)
+        name = partition_name(table, start, interval)
+
+        # Savepoint so one failed period doesn't abort the others
+        cursor.execute("SAVEPOINT split_default")
+        try:
+            cursor.execute(sql.SQL("CREATE TEMP TABLE moved_snapshots (LIKE {}) ON COMMIT DROP").format(default))
+            cursor.execute(sql.SQL("""
+                WITH moved AS (DELETE FROM {} WHERE time >= %s AND time < %s RETURNING *)
+                INSERT INTO moved_snapshots SELECT * FROM moved
+            """).format(default), (start, end))
+            cursor.execute(sql.SQL("""
+                CREATE TABLE {} PARTITION OF {}
+                FOR VALUES FROM (%s) TO (%s)
+            """).format(sql.Identifier(name), sql.Identifier(table)), (start, end))
+            cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM moved_snapshots").format(sql.Identifier(name)))
+            cursor.execute("DROP TABLE moved_snapshots")
+            cursor.execute("RELEASE SAVEPOINT split_default")
+            created.append(name)
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT split_default")
+            logging.warning(f"Could not move rows from {table}_default to {name}: {e}")
+
+    if created:
+        logging.info(f"Moved rows from {table}_default to new partitions: {', '.join(created)}")
+    return created
+
+# Drops whole partitions whose range ended before the retention cutoff
+def drop_expired_partitions(cursor, table, now=None, retention_days=RETENTION_DAYS):
+    cutoff = retention_cutoff(now, retention_days)
+    if cutoff is None:
+        return []
+
+    cursor.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+    """, (table,))
+
+    dropped = []
+    for (name,) in cursor.fetchall():
+        parsed = parse_partition_name(table, name)
+        if parsed is None:
+            continue
+
+        start, interval = parsed
+        if next_partition_start(start, interval) <= cutoff:
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            dropped.append(name)
+
+    if dropped:
+        logging.info(f"Dropped expired partitions: {', '.join(dropped)}")
+    return dropped
+
+# Creates upcoming partitions, moves rows out of the default partition and
+# applies the retention policy for every partitioned table. Tables created
+# before partitioning was added are skipped
+def maintain_partitions(cursor, now=None):
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cursor, table):
+            logging.warning(f"{table} is not partitioned, see README to migrate it")
+            continue
+
+        create_default_partition(cursor, table)
+        create_partitions(cursor, table, now)
+        delete_expired_default_rows(cursor, table, now)
+        split_default_partition(cursor, table)
+        drop_expired_partitions(cursor, table, now)
@@ -0,0 +1,144 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from satellite import get_snapshots, NEW, SKIPPED
+from config import (SATELLITE_SOURCES, POLL_INTERVAL, POLL_TIMEOUT, POLL_WORKERS,
+                    POLL_MAX_INTERVAL, POLL_BACKOFF)
+
+@dataclass
+class Source:
+    url: str
+    interval: float = POLL_INTERVAL
+    timeout: float = POLL_TIMEOUT
+
+# Turns the SATELLITE_SOURCES setting into a list of sources,
+# each entry is 'url' or 'url|interval|timeout'
+def parse_sources(value=SATELLITE_SOURCES):
+    sources = []
+
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        parts = [part.strip() for part in entry.split('|')]
+        source = Source(parts[0])
+        if len(parts) > 1 and parts[1]:
+            source.interval = float(parts[1])
+        if len(parts) > 2 and parts[2]:
+            source.timeout = float(parts[2])
+
+        if source.interval <= 0:
+            raise ValueError(f"Poll interval must be positive: {entry}")
+        sources.append(source)
+
+    if not sources:
+        raise ValueError("No satellite sources configured")
+    return sources
+
+# Turns sources back into a SATELLITE_SOURCES value, for passing to a worker process
+def format_sources(sources):
+    return ','.join(f'{source.url}|{source.interval:g}|{source.timeout:g}' for source in sources)
+
+# Delay between polls of one source. Starts at the source's interval and
+# grows by 'backoff' each time a poll finds nothing new, up to 'maximum'.
+# Drops straight back to the source's interval when a new snapshot arrives
+class AdaptiveInterval:
+
+    def __init__(self, minimum, maximum=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.backoff = backoff
+        self.current = minimum
+
+    # Returns the delay before the next poll, given the last poll's result.
+    # A Retry-After from the server is honoured in full, 'maximum' only
+    # limits the backoff
+    def update(self, result):
+        if result is None or result.outcome == SKIPPED:
+            return self.current
+
+        if result.outcome == NEW:
+            self.current = self.minimum
+        else:
+            self.current = min(self.current * self.backoff, self.maximum)
+
+        if result.retry_after:
+            return max(self.current, result.retry_after)
+        return self.current
+
+# Polls every source on its own schedule, handing the fetches to a thread
+# pool so a slow source doesn't delay the others. A source's next poll is
+# scheduled when its current one finishes, using the delay its
+# AdaptiveInterval gives for the result
+class Poller:
+
+    def __init__(self, sources, max_workers=POLL_WORKERS):
+        self.sources = sources
+        self.max_workers = max_workers
+        self.intervals = [AdaptiveInterval(source.interval) for source in sources]
+        self._stop = threading.Event()
+        self._schedule = []
+        self._cond = threading.Condition()
+
+    # Runs until stop() is called
+    def run(self):
+        logging.info("Polling %d satellite source(s)", len(self.sources))
+
+        # Heap of (next run time, source index). Each source is on the heap
+        # only while it isn't being polled, so polls of a source never overlap
+        start = time.monotonic()
+        with self._cond:
+            self._schedule = [(start, i) for i in range(len(self.sources))]
+            heapq.heapify(self._schedule)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='poller') as executor:
+            while not self._stop.is_set():
+                with self._cond:
+                    if not self._schedule:
+                        # Every source is being polled
+                        self._cond.wait(1.0)
+                        continue
+
+                    # Wait for the next poll, waking early if stopped or if
+                    # a finished poll schedules an earlier one
+                    due, index = self._schedule[0]
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._schedule)
+
+                executor.submit(self._poll, index, due)
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _poll(self, index, due):
+        source = self.sources[index]
+        result = None
+        try:
+            result = get_snapshots(source.url, source.timeout)
+        finally:
+            interval = self.intervals[index].update(result)
+            with self._cond:
+                heapq.heappush(self._schedule, (self._next_run(due, interval), index))
+                self._cond.notify()
+
+    # Next slot 'interval' after the last one was due, skipping any slots
+    # already missed so a slow poll doesn't shift the schedule
+    @staticmethod
+    def _next_run(due, interval):
+        next_run = due + interval
+        now = time.monotonic()
+        if next_run < now:
+            missed = math.ceil((now - next_run) / interval)
+            next_run += missed * interval
+        return next_run
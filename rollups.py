@@ -0,0 +1,111 @@
+from psycopg2.extras import execute_values
+
+# Rollup bucket sizes and the Postgres date_trunc unit for each
+BUCKETS = {
+    '1m': 'minute',
+    '1h': 'hour',
+    '1d': 'day'
+}
+
+# Tag used for the rollup row that covers every snapshot in a bucket,
+# so snapshots with several tags are only counted once
+ALL_TAGS = '*'
+
+# Rollup table keeps count, sum, min and max per bucket and tag so
+# aggregate queries don't need to read the raw snapshots
+def create_rollup_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_rollups(
+            bucket TEXT NOT NULL,
+            bucket_start TIMESTAMP NOT NULL,
+            tag TEXT NOT NULL,
+            count BIGINT NOT NULL,
+            sum DOUBLE PRECISION NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            PRIMARY KEY (bucket, tag, bucket_start)
+        )
+    """)
+
+    # Fill the rollups from existing snapshots the first time the table is used
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM snapshot_rollups)")
+    if cursor.fetchone()[0]:
+        return
+
+    for bucket, unit in BUCKETS.items():
+        cursor.execute("""
+            INSERT INTO snapshot_rollups (bucket, bucket_start, tag, count, sum, min, max)
+            SELECT %s, date_trunc(%s, time), tag, count(*), sum(value), min(value), max(value)
+            FROM (
+                SELECT time, value, unnest(tags) AS tag FROM valid_snapshots
+                UNION ALL
+                SELECT time, value, %s FROM valid_snapshots
+            ) AS tagged
+            GROUP BY 2, 3
+        """, (bucket, unit, ALL_TAGS))
+
+# Start of the bucket a time falls into
+def bucket_start(time, bucket):
+    time = time.replace(second=0, microsecond=0)
+    if bucket in ('1h', '1d'):
+        time = time.replace(minute=0)
+    if bucket == '1d':
+        time = time.replace(hour=0)
+    return time
+
+# Pre-aggregates a batch of (time, value, tags) rows into one rollup row
+# per bucket and tag, as (bucket, bucket_start, tag, count, sum, min, max)
+def rollup_rows(valid_rows):
+    totals = {}
+
+    for time, value, tags in valid_rows:
+        for bucket in BUCKETS:
+            start = bucket_start(time, bucket)
+
+            for tag in set(tags) | {ALL_TAGS}:
+                key = (bucket, start, tag)
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = [1, value, value, value]
+                else:
+                    total[0] += 1
+                    total[1] += value
+                    total[2] = min(total[2], value)
+                    total[3] = max(total[3], value)
+
+    return [key + tuple(total) for key, total in totals.items()]
+
+# Adds a batch of valid rows to the rollups, inside the caller's transaction.
+# Rows are upserted in key order so concurrent writers lock them in the same
+# order and can't deadlock
+def update_rollups(cursor, valid_rows):
+    rows = sorted(rollup_rows(valid_rows))
+    if not rows:
+        return
+
+    execute_values(cursor, """
+        INSERT INTO snapshot_rollups (bucket, bucket_start, tag, count, sum, min, max)
+        VALUES %s
+        ON CONFLICT (bucket, tag, bucket_start) DO UPDATE SET
+            count = snapshot_rollups.count + EXCLUDED.count,
+            sum = snapshot_rollups.sum + EXCLUDED.sum,
+            min = LEAST(snapshot_rollups.min, EXCLUDED.min),
+            max = GREATEST(snapshot_rollups.max, EXCLUDED.max)
+    """, rows, page_size=len(rows))
+
+# Takes rows deleted from valid_snapshots back out of the rollups, inside the
+# caller's transaction. min and max are left as they are, buckets left empty
+# are removed
+def subtract_rollups(cursor, valid_rows):
+    rows = sorted(rollup_rows(valid_rows))
+    if not rows:
+        return
+
+    execute_values(cursor, """
+        UPDATE snapshot_rollups AS r
+        SET count = r.count - d.count, sum = r.sum - d.sum
+        FROM (VALUES %s) AS d(bucket, bucket_start, tag, count, sum, min, max)
+        WHERE r.bucket = d.bucket AND r.tag = d.tag AND r.bucket_start = d.bucket_start
+    """, rows, template="(%s, %s::timestamp, %s, %s::bigint, %s::double precision, %s, %s)",
+        page_size=len(rows))
+    cursor.execute("DELETE FROM snapshot_rollups WHERE count <= 0")
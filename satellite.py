@@ -1,76 +1,104 @@
-import requests
-import time
-from datetime import datetime
 import logging
-from storage import add_valid_snapshot, add_discarded_snapshot
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from storage import save_snapshot
+from validation import Snapshot, build_pipeline
+from fetch_client import fetch, CircuitOpenError
+from config import POLL_TIMEOUT
+from metrics import fetch_latency, snapshots_fetched, snapshots_valid, snapshots_discarded
 
+DEFAULT_SOURCE = 'http://localhost:28462/'
 
-def get_snapshots():
+# Age, tag and value rules applied to every snapshot
+pipeline = build_pipeline()
+
+# What a poll found, used by the poller to adapt how often it polls
+NEW = 'new'              # a snapshot not seen before from this source
+UNCHANGED = 'unchanged'  # the same snapshot as the last poll
+NO_DATA = 'no_data'      # 404, the satellite has nothing to send
+FAILED = 'failed'        # error response, bad data or no response
+SKIPPED = 'skipped'      # not fetched, the source's circuit is open
+
+class PollResult:
+    __slots__ = ('outcome', 'retry_after')
+
+    def __init__(self, outcome, retry_after=None):
+        self.outcome = outcome
+        self.retry_after = retry_after
+
+# Timestamp of the last snapshot saved from each source, and the sources
+# currently answering 404
+last_timestamps = {}
+no_data_sources = set()
+
+# Seconds from a Retry-After header, given as seconds or an HTTP date
+def parse_retry_after(value):
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+def get_snapshots(url=DEFAULT_SOURCE, timeout=POLL_TIMEOUT):
     try:
         # Fetch snapshot data
-        response = requests.get('http://localhost:28462/')
+        with fetch_latency.time():
+            response = fetch(url, timeout)
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
 
         # Early return if bad status code
         if response.status_code == 404:
-            logging.info("No data currently available from satellite: 404")
-            return
+            # Logged once when the satellite goes quiet, not on every poll
+            if url not in no_data_sources:
+                no_data_sources.add(url)
+                logging.info("No data currently available from satellite: 404")
+            else:
+                logging.debug("Still no data available from %s", url)
+            return PollResult(NO_DATA, retry_after)
         
         if response.status_code != 200:
-            logging.error(f"Unexpected status code: {response.status_code}")
-            return
-
-        snapshot = response.json()
-
-        # Calculate snapshots age
-        current_time = time.time()
-        snapshot_age = current_time - snapshot['time']
-
-        # Convert timestamp to datetime object
-        snapshot_time = datetime.fromtimestamp(snapshot['time'])
-
-        time_now = datetime.now()
-
-        # Validate snapshot age, save to discarded_snapshots if fails
-        if snapshot_age > 3600:
-            logging.warning(f'Snapshot over 1hr old, disregard: {snapshot}')
-            add_discarded_snapshot( 
-                snapshot_time, 
-                snapshot['value'], 
-                snapshot['tags'], 
-                'age',
-                time_now
-                )
-            return
-
-        # Validate snapshot tags, save to discarded_snapshots if fails
-        elif 'system' in snapshot['tags']:
-            logging.warning(f'Invalid system tag: {snapshot}')
-            add_discarded_snapshot( 
-                snapshot_time, 
-                snapshot['value'], 
-                snapshot['tags'], 
-                'system',
-                time_now
-                )
-            return
-        elif 'suspect' in snapshot['tags']: 
-            logging.warning(f'Invalid suspect tag: {snapshot}')
-            add_discarded_snapshot( 
-                snapshot_time, 
-                snapshot['value'], 
-                snapshot['tags'], 
-                'suspect',
-                time_now
-                )
-            return
-
-        # Log valid snapshots and save to database
-        tag = snapshot['tags'][0]
-        temp = snapshot['value']
-        time_str = datetime.fromtimestamp(snapshot['time'])
-                                          
-        logging.info(f"Valid {tag} snapshot measuring {temp}°C at {time_str.strftime('%H:%M:%S')}")
-        add_valid_snapshot(snapshot_time, snapshot['value'], snapshot['tags'])
+            logging.error("Unexpected status code: %s", response.status_code)
+            return PollResult(FAILED, retry_after)
+
+        no_data_sources.discard(url)
+
+        # Parse fields once, then run every validation rule in order
+        snapshot = Snapshot.from_json(response.json(), url)
+
+        # The data-server repeats its latest snapshot until a new one arrives
+        if last_timestamps.get(url) == snapshot.timestamp:
+            logging.debug("Snapshot from %s unchanged since last poll", url)
+            return PollResult(UNCHANGED, retry_after)
+
+        snapshot, verdict = pipeline.validate(snapshot)
+        snapshots_fetched.inc()
+
+        if verdict.valid:
+            snapshots_valid.inc()
+            # Skip building the message if INFO logging is disabled
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info("Valid %s snapshot measuring %s°C at %s",
+                             snapshot.tags[0] if snapshot.tags else 'untagged',
+                             snapshot.value, snapshot.time.strftime('%H:%M:%S'))
+        else:
+            snapshots_discarded.labels(verdict.reason).inc()
+            logging.warning("%s: %s", verdict.message, snapshot)
+
+        # Save to valid_snapshots or discarded_snapshots
+        save_snapshot(snapshot, verdict)
+        last_timestamps[url] = snapshot.timestamp
+        return PollResult(NEW, retry_after)
+
+    except CircuitOpenError as e:
+        logging.debug("Skipping poll of %s: %s", url, e)
+        return PollResult(SKIPPED)
 
     except Exception as e:
-        logging.error(f"Fetch error: {e}")
\ No newline at end of file
+        logging.error("Fetch error: %s", e)
+        return PollResult(FAILED)
@@ -0,0 +1,107 @@
+import json
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+from storage import VALID
+
+try:
+    import orjson
+except ImportError:
+    # Falls back to the stdlib encoder, same output but slower
+    orjson = None
+
+# One object per row, keys in the same sorted order jsonify uses
+VALID_ROW = '{"id":%d,"tags":%s,"time":"%s","value":%s}'
+DISCARDED_ROW = '{"discarded_at":"%s","id":%d,"reason":%s,"tags":%s,"time":"%s","value":%s}'
+
+def available():
+    return orjson is not None
+
+# Dates are written in ISO format by both encoders, so responses don't
+# change with what is installed
+def default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+# Flask JSON provider that encodes with orjson when it is installed and
+# with the stdlib json module otherwise
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs):
+        # Indented output and other stdlib options are left to json.dumps
+        if orjson is None or kwargs.keys() - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        return self._orjson_dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._orjson_dumps(obj) + b'\n', mimetype=self.mimetype)
+
+    def _orjson_dumps(self, obj):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+# Formats a column of datetimes, numbers or strings as JSON in one call and
+# splits the result back into one string per row. None of these ever
+# contain the separator, so splitting is safe
+def _encode_times(times):
+    if not times:
+        return []
+    if orjson is not None:
+        return orjson.dumps(times)[2:-2].decode().split('","')
+    return list(map(datetime.isoformat, times))
+
+def _encode_numbers(numbers):
+    if not numbers:
+        return []
+    if orjson is not None:
+        return orjson.dumps(numbers)[1:-1].decode().split(',')
+    return json.dumps(numbers, separators=(',', ':'))[1:-1].split(',')
+
+# Encodes each distinct value once, tags and reasons repeat from row to row
+def _encode_repeated(values):
+    dumps = json.dumps if orjson is None else lambda value: orjson.dumps(value).decode()
+    encoded = {}
+    result = []
+    for value in values:
+        key = tuple(value) if isinstance(value, list) else value
+        text = encoded.get(key)
+        if text is None:
+            text = encoded[key] = dumps(value)
+        result.append(text)
+    return result
+
+# Encodes valid (id, time, value, tags) or discarded (id, time, value, tags,
+# reason, discarded_at) rows as one JSON object string per row. Columns are
+# formatted together, so no dictionary is built for each row
+def encode_rows(kind, rows):
+    if not rows:
+        return []
+
+    columns = list(zip(*rows))
+    ids = columns[0]
+    times = _encode_times(columns[1])
+    values = _encode_numbers(columns[2])
+    tags = _encode_repeated(columns[3])
+
+    if kind == VALID:
+        return list(map(VALID_ROW.__mod__, zip(ids, tags, times, values)))
+
+    reasons = _encode_repeated(columns[4])
+    discarded_at = _encode_times(columns[5])
+    return list(map(DISCARDED_ROW.__mod__, zip(discarded_at, ids, reasons, tags, times, values)))
+
+# A whole JSON array of rows as bytes, ready to send
+def encode_array(kind, rows):
+    return ('[' + ','.join(encode_rows(kind, rows)) + ']').encode()
@@ -0,0 +1,78 @@
+import logging
+from database import init_db, close_pool, get_backend
+from api import app, on_remote_write, on_remote_missed
+from feed import FeedListener
+from hot_window import hot_window
+from metrics import start_metrics_server
+from config import (API_HOST, API_PORT, API_WORKERS, API_THREADS, API_GRACEFUL_TIMEOUT,
+                    FEED_NOTIFY, FEED_MAX_SUBSCRIBERS, METRICS_HOST, API_METRICS_PORT)
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # gunicorn doesn't run on Windows, start_api() is used there instead
+    BaseApplication = None
+
+# Runs in the master before each worker is forked. Gives the worker the
+# lowest slot no running worker has, so a replacement worker takes over the
+# metrics port of the one it replaces
+def pre_fork(server, worker):
+    taken = {getattr(other, 'metrics_slot', None) for other in server.WORKERS.values()}
+    worker.metrics_slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+
+# Each worker process opens its own connection pool once it has forked,
+# tables are created by the parent before workers start. Workers listen for
+# snapshots saved by the ingest process to feed /snapshots/stream and keep
+# their response cache and hot window fresh
+def post_worker_init(worker):
+    init_db(create=False)
+    # Counters are per process, so each worker is scraped on its own port
+    # rather than through the API port, where any worker could answer
+    if API_METRICS_PORT:
+        start_metrics_server(METRICS_HOST, API_METRICS_PORT + worker.metrics_slot)
+    if FEED_NOTIFY and get_backend().notifies:
+        FeedListener(on_remote_write, on_connect=hot_window.start,
+                     on_disconnect=hot_window.stop, on_missed=on_remote_missed).start()
+
+def worker_exit(server, worker):
+    close_pool()
+
+if BaseApplication is not None:
+
+    # Serves the existing Flask app with gunicorn worker processes and threads
+    class APIServer(BaseApplication):
+
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+# Runs the API in 'workers' processes with 'threads' threads each until the
+# server receives SIGTERM or SIGINT, which lets in-flight requests finish
+# for up to API_GRACEFUL_TIMEOUT seconds. Each worker has FEED_MAX_SUBSCRIBERS
+# more threads, so open live feed streams never take the 'threads' that
+# serve other requests
+def serve_api(host=API_HOST, port=API_PORT, workers=API_WORKERS, threads=API_THREADS):
+    if BaseApplication is None:
+        raise RuntimeError("gunicorn is not installed, run the API with start_api() instead")
+
+    logging.info(f"Serving API on {host}:{port} with {workers} worker(s), {threads} thread(s) each "
+                 f"and up to {FEED_MAX_SUBSCRIBERS} live feed stream(s) each")
+    options = {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads + FEED_MAX_SUBSCRIBERS,
+        'worker_class': 'gthread',
+        'graceful_timeout': API_GRACEFUL_TIMEOUT,
+        'pre_fork': pre_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit
+    }
+    APIServer(app, options).run()
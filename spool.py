@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on Windows, only one ingest process may use a spool there
+    fcntl = None
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+OFFSET_FILE = 'offset.json'
+LOCK_FILE = 'spool.lock'
+
+# Numbers of the segment files in 'directory', in order
+def segment_numbers(directory):
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+    return sorted(segments)
+
+# Append-only log of records kept on disk until they have been saved to the
+# database. Records are lines in numbered segment files. Appends are fsynced
+# in groups, at most fsync_interval seconds apart. A background thread syncs
+# what is left after a burst, whatever the reader is doing. The position of
+# the last record saved is kept in offset.json so a restart carries on from there
+class Spool:
+
+    def __init__(self, directory, segment_bytes, fsync_interval):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise Exception(f"Spool directory {directory} is in use by another process")
+
+        segments = self._segments()
+        self._read_seq, self._read_pos = self._load_offset(segments)
+
+        # Always write to a new segment, so a line torn by a crash is left
+        # at the end of a finished segment where the reader can skip it
+        self._write_seq = max(segments[-1] + 1 if segments else 1, self._read_seq)
+        self._file = open(self._path(self._write_seq), 'ab')
+        self._written = 0
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+        self._closed = threading.Event()
+        self._sync_thread = None
+        if fsync_interval > 0:
+            self._sync_thread = threading.Thread(target=self._sync_periodically, name='spool-fsync',
+                                                 daemon=True)
+            self._sync_thread.start()
+
+    # Adds a record, given as bytes without a trailing newline
+    def append(self, record):
+        with self._lock:
+            self._file.write(record + b'\n')
+            self._file.flush()
+            self._written += len(record) + 1
+            self._dirty = True
+
+            if self._written >= self.segment_bytes:
+                self._rotate()
+            elif time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    # Forces appended records to disk
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._sync()
+
+    # Reads up to max_records records after the last committed position.
+    # Returns (records, position), pass position to commit() once the
+    # records are saved
+    def read(self, max_records):
+        records = []
+        seq, pos = self._read_seq, self._read_pos
+
+        while len(records) < max_records:
+            # Checked before reading, so a finished segment is read to its end
+            with self._lock:
+                finished = seq < self._write_seq
+
+            path = self._path(seq)
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    file.seek(pos)
+                    while len(records) < max_records:
+                        line = file.readline()
+                        # Stop at a line that is still being written
+                        if not line.endswith(b'\n'):
+                            break
+                        records.append(line[:-1])
+                        pos += len(line)
+
+                    if len(records) >= max_records or not finished:
+                        break
+                    if file.read(1):
+                        logging.warning("Skipping incomplete record at the end of %s", path)
+
+            elif not finished:
+                break
+
+            seq += 1
+            pos = 0
+
+        return records, (seq, pos)
+
+    # Marks everything before position as saved and deletes finished segments
+    def commit(self, position):
+        self._read_seq, self._read_pos = position
+
+        # Write then rename so a crash never leaves a half-written offset
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'segment': self._read_seq, 'position': self._read_pos}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+        for seq in self._segments():
+            if seq >= self._read_seq:
+                break
+            os.remove(self._path(seq))
+
+    # Bytes written but not yet committed
+    def pending_bytes(self):
+        total = 0
+        for seq in self._segments():
+            if seq < self._read_seq:
+                continue
+            try:
+                total += os.path.getsize(self._path(seq))
+            except OSError:
+                continue
+            if seq == self._read_seq:
+                total -= self._read_pos
+        return total
+
+    def close(self):
+        self._closed.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+        with self._lock:
+            if self._dirty:
+                self._sync()
+            self._file.close()
+        self._lock_file.close()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}')
+
+    def _segments(self):
+        return segment_numbers(self.directory)
+
+    def _load_offset(self, segments):
+        path = os.path.join(self.directory, OFFSET_FILE)
+        if os.path.exists(path):
+            with open(path) as file:
+                offset = json.load(file)
+            return offset['segment'], offset['position']
+        return (segments[0] if segments else 1), 0
+
+    # Syncs appends that no later append has synced, every fsync_interval
+    def _sync_periodically(self):
+        while not self._closed.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except (OSError, ValueError) as e:
+                logging.error("Error syncing spool %s: %s", self.directory, e)
+
+    # Called with the lock held
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    # Called with the lock held
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._write_seq += 1
+        self._file = open(self._path(self._write_seq), 'ab')
+        self._written = 0
@@ -1,134 +1,425 @@
+import json
 import logging
-from database import get_connection, release_connection
+import queue
+import threading
+import time as clock
+from collections import OrderedDict
+from datetime import datetime
+from database import get_backend, register_close_hook
+from backends.base import VALID, DISCARDED
+from spool import Spool, segment_numbers
+from metrics import Gauge, insert_latency, insert_batch_size, snapshots_deduplicated, snapshots_lost
+from config import (WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL,
+                    WRITE_QUEUE_SIZE, WRITE_ENQUEUE_TIMEOUT, WRITE_RETRY_MAX, WRITE_CLOSE_TIMEOUT,
+                    SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_FSYNC_INTERVAL, SPOOL_RETRY_MAX,
+                    DEDUP_CACHE_SIZE)
 
-# Saves valid snapshots to database
-def add_valid_snapshot(time, value, tags):
+# Functions called with (valid_rows, discarded_rows) after each batch is
+# committed. Rows are the ones inserted, with their id in front as they are
+# read back: (id, time, value, tags) and (id, time, value, tags, reason, discarded_at)
+write_listeners = []
 
-    # Gets connection from pool and create cursor
-    connection = get_connection()
-    cursor = connection.cursor()
+# Register a function to be told about every committed batch of snapshots
+def add_write_listener(listener):
+    if listener not in write_listeners:
+        write_listeners.append(listener)
 
-    try:
-        cursor.execute("""
-            INSERT INTO valid_snapshots (time, value, tags)
-            VALUES (%s, %s, %s)
-        """, (time, value, tags))
+def notify_write_listeners(valid_rows, discarded_rows):
+    for listener in write_listeners:
+        try:
+            listener(valid_rows, discarded_rows)
+        except Exception as e:
+            logging.error("Error in snapshot write listener: %s", e)
 
-        # Save changes 
-        connection.commit()
+# Write-behind buffer: collects snapshots in a bounded queue and a background
+# thread writes them in multi-row batches, so each reading doesn't cost its
+# own round trip and commit. A batch the database doesn't take is retried
+# with backoff. Snapshots are only lost if the queue stays full or the
+# database is still down close_timeout seconds into shutdown, both counted
+# in snapshots_lost_total
+class SnapshotBuffer:
 
-    except Exception as e:
-        logging.error(f"Error inserting valid snapshot into database: {e}")
-        raise
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL,
+                 max_queue=WRITE_QUEUE_SIZE, enqueue_timeout=WRITE_ENQUEUE_TIMEOUT,
+                 retry_max=WRITE_RETRY_MAX, close_timeout=WRITE_CLOSE_TIMEOUT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_max = retry_max
+        self.close_timeout = close_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._close_deadline = None
 
-    finally:
-        # Close cursor release connection from pool
-        cursor.close()
-        release_connection(connection)
+    # Queue a row for the next batch. Blocks while the queue is full so a slow
+    # database pushes back on ingest instead of growing memory without limit
+    def put(self, kind, row):
+        self._ensure_started()
+        try:
+            self._queue.put((kind, row), timeout=self.enqueue_timeout)
+        except queue.Full:
+            snapshots_lost.labels('buffer_full').inc()
+            raise Exception(f"Snapshot write buffer full, {kind} snapshot not saved")
 
-def get_valid_snapshots(start, end):
-    
-    # Gets connection from pool and create cursor
-    connection = get_connection()
-    cursor = connection.cursor()
+    # Number of rows waiting to be written
+    def pending(self):
+        return self._queue.qsize()
 
-    try:
-        # Query valid_snapshots table
-        cursor.execute("""
-            SELECT time, value, tags 
-            FROM valid_snapshots
-            WHERE time >= %s AND time <= %s
-        """, (start, end))
-
-        # rows is returned as list of tuples
-        rows = cursor.fetchall()
-
-        snapshots = []
-        # Map rows into list of dictionaries
-        for row in rows:
-            snapshots.append({
-                'time': row[0].isoformat(),
-                'value': row[1],
-                'tags': row[2]
-            })
-
-        return snapshots
-
-    except Exception as e:
-        logging.error(f"Error reading valid snapshot in database: {e}")
-        raise
+    # Stop the writer thread once everything queued has been written
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._close_deadline = clock.monotonic() + self.close_timeout
+            self._stop.set()
+            thread.join()
+            self._thread = None
+            self._stop.clear()
+        logging.info("Snapshot write buffer flushed")
 
-    finally:
-        # Close cursor release connection from pool
-        cursor.close()
-        release_connection(connection)
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+                self._thread.start()
 
-# Saves discarded snapshots to database
-def add_discarded_snapshot(time, value, tags, reason, discarded_at):
+    def _run(self):
+        # Keep going after stop is requested until the queue is drained
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
 
-    # Gets connection from pool and create cursor
-    connection = get_connection()
-    cursor = connection.cursor()
+    # Collect rows until the batch is full or the flush interval has passed
+    def _next_batch(self):
+        batch = []
+        deadline = clock.monotonic() + self.flush_interval
 
-    try:
-        cursor.execute("""
-            INSERT INTO discarded_snapshots (time, value, tags, reason, discarded_at)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (time, value, tags, reason, discarded_at))
+        while len(batch) < self.batch_size:
+            if self._stop.is_set():
+                # Shutting down, take whatever is left without waiting
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
 
-        # Save changes 
-        connection.commit()
+            remaining = deadline - clock.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                continue
 
-    except Exception as e:
-        logging.error(f"Error inserting discarded snapshot into database: {e}")
-        raise
+        return batch
+
+    # Writes a batch, retrying while the database is unreachable. Rows
+    # already stored by a failed attempt are skipped by the unique key
+    def _write(self, batch):
+        valid_rows = [row for kind, row in batch if kind == VALID]
+        discarded_rows = [row for kind, row in batch if kind == DISCARDED]
+        delay = max(self.flush_interval, 0.1)
+
+        while True:
+            try:
+                write_snapshots(valid_rows, discarded_rows)
+                return
+            except Exception as e:
+                if not self._stop.is_set():
+                    logging.error("Error flushing snapshot batch, retrying in %gs: %s", delay, e)
+                    self._stop.wait(delay)
+                else:
+                    remaining = self._close_deadline - clock.monotonic()
+                    if remaining <= 0:
+                        logging.error("Database unavailable at shutdown, %d snapshots lost: %s",
+                                      len(batch), e)
+                        snapshots_lost.labels('shutdown').inc(len(batch))
+                        return
+                    logging.error("Error flushing snapshot batch at shutdown, retrying in %gs: %s",
+                                  min(delay, remaining), e)
+                    clock.sleep(min(delay, remaining))
+                delay = min(delay * 2, self.retry_max)
+
+# Writes a batch of valid and discarded rows in a single transaction.
+# Rows already stored with the same (time, tags, source) are skipped, so repeated
+# readings and replayed batches are only saved once. Rollups and write
+# listeners only see the rows that were inserted
+def write_snapshots(valid_rows, discarded_rows):
+
+    insert_batch_size.observe(len(valid_rows) + len(discarded_rows))
+    started = clock.perf_counter()
+    received = len(valid_rows) + len(discarded_rows)
+
+    # The backend skips rows already stored and returns the ones it inserted, with their ids
+    valid_rows, discarded_rows = get_backend().insert_snapshots(valid_rows, discarded_rows)
+    insert_latency.observe(clock.perf_counter() - started)
+
+    duplicates = received - len(valid_rows) - len(discarded_rows)
+    if duplicates:
+        snapshots_deduplicated.labels('database').inc(duplicates)
+
+    notify_write_listeners(valid_rows, discarded_rows)
+
+# Encodes a queued row as a spool record, [kind, time, value, tags, source]
+# for valid rows and [kind, time, value, tags, reason, discarded_at, source]
+# for discarded ones, with times in ISO format
+def encode_record(kind, row):
+    fields = [kind, row[0].isoformat(), *row[1:]]
+    if kind == DISCARDED:
+        fields[5] = row[4].isoformat()
+    return json.dumps(fields).encode()
+
+# Fields in a record before the source was added to it
+UNSOURCED_FIELDS = {VALID: 4, DISCARDED: 6}
+
+def decode_record(record):
+    fields = json.loads(record)
+    row = [datetime.fromisoformat(fields[1]), *fields[2:]]
+    if fields[0] == DISCARDED:
+        row[4] = datetime.fromisoformat(row[4])
+    # Records spooled by an older version don't say where they came from
+    if len(fields) == UNSOURCED_FIELDS[fields[0]]:
+        row.append('')
+    return fields[0], tuple(row)
+
+# Write-ahead buffer: snapshots are appended to an on-disk spool and a
+# background thread drains the spool into the database in batches. While
+# the database is unreachable snapshots stay in the spool, and the drainer
+# retries with backoff. Batches that were saved before a crash but not
+# committed in the spool are skipped by the (time, tags, source) unique key
+class SpooledBuffer:
+
+    def __init__(self, directory=SPOOL_DIR, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL, retry_max=SPOOL_RETRY_MAX,
+                 segment_bytes=SPOOL_SEGMENT_BYTES, fsync_interval=SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_max = retry_max
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._spool = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Append a row to the spool. Returns once the row is in the operating
+    # system's buffers, the database isn't touched
+    def put(self, kind, row):
+        self._ensure_started()
+        self._spool.append(encode_record(kind, row))
+
+    # Bytes of snapshots waiting to be saved
+    def pending_bytes(self):
+        return self._spool.pending_bytes() if self._spool else 0
+
+    # Save what can be saved and stop the drainer. Anything the database
+    # doesn't take stays in the spool for the next start
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stop.set()
+            thread.join()
+            self._spool.close()
+            self._thread = None
+            self._spool = None
+            self._stop.clear()
+        logging.info("Snapshot spool flushed")
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._spool = Spool(self.directory, self.segment_bytes, self.fsync_interval)
+                self._thread = threading.Thread(target=self._run, name='spool-drainer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        delay = self.flush_interval
+
+        while True:
+            self._spool.sync()
+            records, position = self._spool.read(self.batch_size)
+            if not records:
+                if self._stop.is_set():
+                    break
+                self._stop.wait(self.flush_interval)
+                continue
+
+            valid_rows, discarded_rows = self._decode(records)
+            try:
+                write_snapshots(valid_rows, discarded_rows)
+            except Exception as e:
+                if self._stop.is_set():
+                    logging.error("Database unavailable at shutdown, snapshots kept in spool: %s", e)
+                    break
+                logging.error("Error saving spooled snapshots, retrying in %gs: %s", delay, e)
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.retry_max)
+                continue
 
+            self._spool.commit(position)
+            delay = self.flush_interval
+
+            # Let a partial batch fill up before reading again
+            if len(records) < self.batch_size:
+                self._stop.wait(self.flush_interval)
+
+    @staticmethod
+    def _decode(records):
+        valid_rows = []
+        discarded_rows = []
+        for record in records:
+            try:
+                kind, row = decode_record(record)
+            except (ValueError, IndexError, TypeError) as e:
+                logging.error("Skipping unreadable spool record %r: %s", record[:100], e)
+                continue
+            (valid_rows if kind == VALID else discarded_rows).append(row)
+        return valid_rows, discarded_rows
+
+# Saves what is left in the spool at 'directory' by a process that no
+# longer uses it, such as a removed ingest worker. Returns the number of
+# records saved. Raises if the spool is in use or the database fails,
+# unsaved records stay in the spool
+def drain_spool(directory):
+    if not segment_numbers(directory):
+        return 0
+
+    spool = Spool(directory, SPOOL_SEGMENT_BYTES, SPOOL_FSYNC_INTERVAL)
+    saved = 0
+    try:
+        while True:
+            records, position = spool.read(WRITE_BATCH_SIZE)
+            if not records:
+                return saved
+            write_snapshots(*SpooledBuffer._decode(records))
+            spool.commit(position)
+            saved += len(records)
     finally:
-        # Close cursor release connection from pool
-        cursor.close()
-        release_connection(connection)
+        spool.close()
+
+# Snapshots go through the spool unless SPOOL_DIR is empty
+write_buffer = SpooledBuffer() if SPOOL_DIR else SnapshotBuffer()
+
+# Spool backlog, read when /metrics is scraped
+Gauge('spool_pending_bytes', 'Bytes of snapshots in the spool not yet saved to the database',
+      lambda: write_buffer.pending_bytes() if SPOOL_DIR else 0)
+
+# Writes anything still buffered, called before the pool is closed
+def flush_buffer():
+    write_buffer.close()
+
+register_close_hook(flush_buffer)
+
+# Bounded LRU of the keys of recently queued snapshots. Only hashes are
+# kept, so memory stays small whatever the size of the tags
+class RecentKeys:
+
+    def __init__(self, max_entries=DEDUP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    # True if the key was seen recently, otherwise it is remembered
+    def seen(self, key):
+        if not self.max_entries:
+            return False
+
+        digest = hash(key)
+        with self._lock:
+            if digest in self._keys:
+                self._keys.move_to_end(digest)
+                return True
+            self._keys[digest] = None
+            if len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+        return False
 
-def get_discarded_snapshots(start, end, reason):
-    
-    # Gets connection from pool and create cursor
-    connection = get_connection()
-    cursor = connection.cursor()
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(hash(key), None)
+
+recent_keys = RecentKeys()
+
+# Queues a row unless the same (time, tags, source) was queued recently.
+# Anything the cache misses is caught by the unique key when the batch is
+# inserted. The source is always the row's last field
+def queue_snapshot(kind, row):
+    key = (kind, row[0], tuple(row[2]), row[-1])
+    if recent_keys.seen(key):
+        snapshots_deduplicated.labels('memory').inc()
+        return
 
     try:
-        # Query discarded_snapshots table
-        cursor.execute("""
-            SELECT time, value, tags, reason, discarded_at
-            FROM discarded_snapshots
-            WHERE time >= %s AND time <= %s
-        """, (start, end))
-
-        # rows is returned as list of tuples
-        rows = cursor.fetchall()
-
-        # Filter by reason if provided
-        if reason:
-            filtered_rows = [row for row in rows if row[3] == reason]
-        else: 
-            filtered_rows = rows
-        snapshots = []
-
-        # Map rows into list of dictionaries
-        for row in filtered_rows:
-            snapshots.append({
-                'time': row[0].isoformat(),
-                'value': row[1],
-                'tags': row[2],
-                'reason': row[3],
-                'discarded_at': row[4]
-            })
-
-        return snapshots
-
-    except Exception as e:
-        logging.error(f"Error reading discarded snapshot in database: {e}")
+        write_buffer.put(kind, row)
+    except Exception:
+        # Not queued, so a later poll of the same reading can still save it
+        recent_keys.forget(key)
         raise
 
-    finally:
-        # Close cursor release connection from pool
-        cursor.close()
-        release_connection(connection)
+# Queues valid snapshots to be saved to database
+def add_valid_snapshot(time, value, tags, source=''):
+    queue_snapshot(VALID, (time, value, tags, source))
+
+# Queues a validated snapshot, taking the (snapshot, verdict) pair
+# returned by ValidationPipeline.validate
+def save_snapshot(snapshot, verdict, discarded_at=None):
+    if verdict.valid:
+        queue_snapshot(VALID, snapshot.as_row())
+    else:
+        queue_snapshot(DISCARDED, (snapshot.time, snapshot.value, snapshot.tags,
+                                   verdict.reason, discarded_at or datetime.now(), snapshot.source))
+
+# Reads go to the backend chosen by DB_BACKEND, see backends/base.py.
+# Valid rows are (id, time, value, tags) tuples
+def get_valid_snapshots(start, end, limit=None, after=None, tags_all=None, tags_any=None):
+    return get_backend().get_valid_snapshots(start, end, limit, after, tags_all, tags_any)
+
+# Yields valid snapshots one at a time, streamed from the database where
+# the backend can, so the whole window isn't held in memory
+def iter_valid_snapshots(start, end, limit=None, after=None, tags_all=None, tags_any=None):
+    yield from get_backend().iter_valid_snapshots(start, end, limit, after, tags_all, tags_any)
+
+# Yields valid rows in lists of up to STREAM_ITERSIZE (id, time, value, tags)
+# tuples, for building columnar batches without a dictionary per row
+def iter_valid_batches(start, end):
+    yield from get_backend().iter_valid_batches(start, end)
+
+# Reads min/max/avg per bucket, for one tag or for all snapshots when tag
+# is not given
+def get_aggregated_snapshots(bucket, start, end, tag=None):
+    return get_backend().get_aggregated_snapshots(bucket, start, end, tag)
+
+# Queues discarded snapshots to be saved to database
+def add_discarded_snapshot(time, value, tags, reason, discarded_at, source=''):
+    queue_snapshot(DISCARDED, (time, value, tags, reason, discarded_at, source))
+
+# Discarded rows are (id, time, value, tags, reason, discarded_at) tuples
+def get_discarded_snapshots(start, end, reason, limit=None, after=None, tags_all=None, tags_any=None):
+    return get_backend().get_discarded_snapshots(start, end, reason, limit, after, tags_all, tags_any)
+
+# Yields discarded snapshots one at a time
+def iter_discarded_snapshots(start, end, reason, limit=None, after=None, tags_all=None, tags_any=None):
+    yield from get_backend().iter_discarded_snapshots(start, end, reason, limit, after,
+                                                      tags_all, tags_any)
+
+# True if the backend can build JSON pages for get_snapshots_json
+def builds_json():
+    return get_backend().builds_json
+
+# Reads a page of valid or discarded snapshots as a JSON array built by
+# the database. Returns (body, row count, (time, id) of the last row)
+def get_snapshots_json(kind, start, end, limit=None, after=None, reason=None,
+                       tags_all=None, tags_any=None):
+    return get_backend().get_snapshots_json(kind, start, end, limit, after, reason,
+                                            tags_all, tags_any)
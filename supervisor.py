@@ -0,0 +1,215 @@
+import bisect
+import hashlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from poller import format_sources
+from storage import drain_spool
+from config import SPOOL_DIR, INGEST_STOP_TIMEOUT, INGEST_RESTART_MAX, METRICS_PORT
+
+# Points each worker has on the hash ring, more spreads sources more evenly
+RING_REPLICAS = 100
+# A worker that has run this long without crashing is restarted straight away next time
+STABLE_AFTER = 60.0
+# Seconds between attempts to save spools left by removed workers, while the database is down
+ORPHAN_RETRY = 60.0
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+# Consistent hash ring of worker numbers. Adding or removing a worker only
+# moves the sources that hash to its part of the ring
+class HashRing:
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        self._ring = sorted((ring_hash(f'worker-{worker}#{replica}'), worker)
+                            for worker in workers for replica in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    def worker_for(self, key):
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+# Shares sources between 'workers' workers by URL, returns one list per worker
+def assign_sources(sources, workers):
+    ring = HashRing(range(workers))
+    assignments = [[] for _ in range(workers)]
+    for source in sources:
+        assignments[ring.worker_for(source.url)].append(source)
+    return assignments
+
+# One ingest worker process and the sources it polls
+class Worker:
+
+    def __init__(self, index, sources):
+        self.index = index
+        self.sources = sources
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.restart_at = None
+
+# Runs ingest in several worker processes so validation and writes for
+# different sources don't share one GIL. Sources are assigned by consistent
+# hashing, each worker has its own connection pool and spool directory, and
+# workers that exit are restarted with backoff. SIGTTIN adds a worker and
+# SIGTTOU removes one, only workers whose sources change are restarted
+class IngestSupervisor:
+
+    def __init__(self, sources, workers, command, stop_timeout=INGEST_STOP_TIMEOUT,
+                 restart_max=INGEST_RESTART_MAX):
+        self.sources = sources
+        self.command = command
+        self.stop_timeout = stop_timeout
+        self.restart_max = restart_max
+        self.workers = {}
+        self._count = max(workers, 1)
+        self._stop = threading.Event()
+        self._resize = threading.Event()
+        # When to try again to save orphaned spools, None when there are none left
+        self._drain_at = None
+
+    def count(self):
+        return self._count
+
+    # Changes the number of workers, applied by the supervisor loop
+    def resize(self, count):
+        self._count = max(count, 1)
+        self._resize.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        # Not available on Windows
+        if hasattr(signal, 'SIGTTIN'):
+            signal.signal(signal.SIGTTIN, lambda signum, frame: self.resize(self._count + 1))
+            signal.signal(signal.SIGTTOU, lambda signum, frame: self.resize(self._count - 1))
+
+    # Runs until stop() is called, then stops every worker
+    def run(self):
+        self._rebalance()
+        try:
+            while not self._stop.is_set():
+                if self._resize.is_set():
+                    self._resize.clear()
+                    self._rebalance()
+                elif self._drain_at is not None and time.monotonic() >= self._drain_at:
+                    self._drain_orphaned_spools()
+                self._check_workers()
+                self._stop.wait(1.0)
+        finally:
+            self._stop_workers(self.workers.values())
+            self.workers.clear()
+
+    # Moves sources to match the current worker count. Workers keep their
+    # number, so a worker whose sources are unchanged keeps running
+    def _rebalance(self):
+        assignments = assign_sources(self.sources, self._count)
+        logging.info("Sharing %d source(s) between %d ingest worker(s)", len(self.sources), self._count)
+
+        moved = [worker for index, worker in self.workers.items()
+                 if index >= self._count or worker.sources != assignments[index]]
+        self._stop_workers(moved)
+        for worker in moved:
+            del self.workers[worker.index]
+
+        for index, sources in enumerate(assignments):
+            if index in self.workers:
+                continue
+            if not sources:
+                logging.info("Ingest worker %d has no sources, not started", index)
+                continue
+            worker = Worker(index, sources)
+            self.workers[index] = worker
+            self._start_worker(worker)
+
+        self._drain_orphaned_spools()
+
+    # Spool directories no worker will replay: the root SPOOL_DIR, written
+    # when ingest ran in one process, and those of workers that were
+    # removed or have no sources
+    def _orphaned_spools(self):
+        if not SPOOL_DIR or not os.path.isdir(SPOOL_DIR):
+            return []
+
+        directories = [SPOOL_DIR]
+        for name in sorted(os.listdir(SPOOL_DIR)):
+            index = name[len('worker-'):]
+            if name.startswith('worker-') and index.isdigit() and int(index) not in self.workers:
+                directories.append(os.path.join(SPOOL_DIR, name))
+        return directories
+
+    # Saves the snapshots left in orphaned spools. Runs in the supervisor
+    # loop, so a worker can't be started on a directory while it is drained.
+    # Spools the database doesn't take are tried again after ORPHAN_RETRY
+    def _drain_orphaned_spools(self):
+        self._drain_at = None
+        for directory in self._orphaned_spools():
+            try:
+                saved = drain_spool(directory)
+            except Exception as e:
+                logging.error("Couldn't save snapshots left in %s, retrying in %gs: %s",
+                              directory, ORPHAN_RETRY, e)
+                self._drain_at = time.monotonic() + ORPHAN_RETRY
+                continue
+            if saved:
+                logging.info("Saved %d snapshot(s) left in %s", saved, directory)
+
+    def _start_worker(self, worker):
+        environment = dict(os.environ)
+        environment['SATELLITE_SOURCES'] = format_sources(worker.sources)
+        # A spool directory can only be open in one process
+        environment['SPOOL_DIR'] = os.path.join(SPOOL_DIR, f'worker-{worker.index}') if SPOOL_DIR else ''
+        # A port can only be bound by one process too, the supervisor has METRICS_PORT
+        environment['METRICS_PORT'] = str(METRICS_PORT + 1 + worker.index) if METRICS_PORT else '0'
+
+        worker.process = subprocess.Popen(self.command, env=environment)
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logging.info("Started ingest worker %d (pid %d) for %d source(s)",
+                     worker.index, worker.process.pid, len(worker.sources))
+
+    # SIGTERM lets workers save what they have buffered. All are signalled
+    # first so they shut down at the same time
+    def _stop_workers(self, workers):
+        running = [worker for worker in workers
+                   if worker.process is not None and worker.process.poll() is None]
+        for worker in running:
+            worker.process.terminate()
+
+        deadline = time.monotonic() + self.stop_timeout
+        for worker in running:
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                logging.warning("Ingest worker %d didn't stop in %gs, killing it",
+                                worker.index, self.stop_timeout)
+                worker.process.kill()
+                worker.process.wait()
+
+    # Restarts workers that have exited, waiting longer each time a worker
+    # exits again soon after being started
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start_worker(worker)
+                continue
+
+            code = worker.process.poll()
+            if code is None:
+                continue
+
+            if now - worker.started_at >= STABLE_AFTER:
+                worker.restarts = 0
+            delay = min(2 ** worker.restarts - 1, self.restart_max)
+            worker.restarts += 1
+            worker.restart_at = now + delay
+            logging.error("Ingest worker %d exited with code %s, restarting in %gs",
+                          worker.index, code, delay)
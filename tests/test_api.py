@@ -3,15 +3,18 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import json
 from datetime import datetime
 
-from api import datetime_valid, set_times, app
+from storage import VALID
+from api import datetime_valid, set_times, decode_cursor, invalidate_cache, response_cache, app
 
 @pytest.fixture
 # Mock Flask server
 def client():
     """Create a test client for the Flask app"""
     app.config['TESTING'] = True
+    response_cache.clear()
     with app.test_client() as client:
         yield client
 
@@ -53,11 +56,9 @@ def test_valid_snapshots_request(mocker, client):
     """Test that valid requests return query list"""
     
     # Mock the database query
-    mocker.patch('api.get_valid_snapshots', return_value=[{
-        "time": "2026-01-01T01:30:00",
-        "value": 12.37,
-        "tags": ["night"]
-    }])
+    mocker.patch('api.get_valid_snapshots', return_value=[
+        (1, datetime(2026, 1, 1, 1, 30), 12.37, ["night"])
+    ])
     
     response = client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
     
@@ -117,13 +118,9 @@ def test_discarded_snapshots_request(mocker, client):
     """Test that valid requests for discarded snapshots return query list"""
     
     # Mock the database query
-    mocker.patch('api.get_discarded_snapshots', return_value=[{
-        "time": "2026-01-01T01:00:00",
-        "value": 12.37,
-        "tags": ["night"],
-        "reason": "age",
-        "discarded_at": "2026-01-01T02:30:00"
-    }])
+    mocker.patch('api.get_discarded_snapshots', return_value=[
+        (1, datetime(2026, 1, 1, 1, 0), 12.37, ["night"], "age", datetime(2026, 1, 1, 2, 30))
+    ])
     
     response = client.get('/discarded?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
     
@@ -149,4 +146,377 @@ def test_invalid_reason_parameter(client, caplog):
     # Check response and log are correct
     assert response.status_code == 400
     assert 'Invalid reason value:' in caplog.text
-    assert b"Invalid 'reason' value. Only 'age', 'suspect' or 'system' accepted" in response.data
\ No newline at end of file
+    assert b"Invalid 'reason' value. Only 'age', 'range', 'suspect' or 'system' accepted" in response.data
+# Pagination tests
+def test_full_page_returns_next_cursor(mocker, client):
+    """Test a full page returns a cursor that decodes to its last row"""
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[
+        (1, datetime(2026, 1, 1, 1, 30), 12.37, ["night"]),
+        (2, datetime(2026, 1, 1, 1, 31), 12.40, ["night"])
+    ])
+
+    response = client.get('/snapshots?limit=2')
+
+    assert response.status_code == 200
+    assert mock_query.call_args.args[2] == 2
+    cursor = response.headers['X-Next-Cursor']
+    assert decode_cursor(cursor) == (datetime.fromisoformat("2026-01-01T01:31:00"), 2)
+
+    # Passing the cursor back queries rows after it
+    client.get(f'/snapshots?limit=2&cursor={cursor}')
+    assert mock_query.call_args.args[3] == (datetime.fromisoformat("2026-01-01T01:31:00"), 2)
+
+def test_last_page_has_no_cursor(mocker, client):
+    """Test a page shorter than the limit has no next cursor"""
+    mocker.patch('api.get_discarded_snapshots', return_value=[])
+
+    response = client.get('/discarded?reason=age&limit=50')
+
+    assert response.status_code == 200
+    assert 'X-Next-Cursor' not in response.headers
+
+def test_invalid_limit_and_cursor(client):
+    """Test out of range limits and malformed cursors return 400 errors"""
+    assert client.get('/snapshots?limit=0').status_code == 400
+    assert client.get('/snapshots?limit=abc').status_code == 400
+    assert client.get('/discarded?limit=99999999').status_code == 400
+    assert client.get('/discarded?cursor=not-a-cursor').status_code == 400
+
+# Tag filter tests
+def test_tag_filters_passed_to_query(mocker, client):
+    """Test tag, tags_all and tags_any are parsed and passed to the query"""
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[])
+
+    response = client.get('/snapshots?tag=night&tags_all=sun-glint&tags_any=day,%20night,day')
+
+    assert response.status_code == 200
+    assert mock_query.call_args.args[4:] == (('night', 'sun-glint'), ('day', 'night'))
+
+def test_tag_filters_are_part_of_cache_key(mocker, client):
+    """Test differently filtered requests are not served each other's responses"""
+    mock_query = mocker.patch('api.get_discarded_snapshots', return_value=[])
+
+    client.get('/discarded?tag=night')
+    client.get('/discarded?tag=day')
+
+    assert mock_query.call_count == 2
+
+def test_invalid_tag_filters(client):
+    """Test empty tag lists are rejected"""
+    assert client.get('/snapshots?tags_any=,').status_code == 400
+    assert client.get('/discarded?tags_all=').status_code == 400
+    assert client.get('/snapshots?tag=').status_code == 400
+
+# Streaming tests
+def test_stream_returns_json_array(mocker, client):
+    """Test stream=true streams rows as a JSON array"""
+    rows = [(i, datetime(2026, 1, 1, 1, 30), 1.5, ["day"]) for i in range(3)]
+    mock_iter = mocker.patch('api.iter_valid_snapshots', return_value=iter(rows))
+    mock_get = mocker.patch('api.get_valid_snapshots')
+
+    response = client.get('/snapshots?stream=true')
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.get_json() == [{"id": i, "time": "2026-01-01T01:30:00", "value": 1.5, "tags": ["day"]}
+                                   for i in range(3)]
+    mock_iter.assert_called_once()
+    mock_get.assert_not_called()
+
+def test_stream_returns_ndjson(mocker, client):
+    """Test NDJSON clients get one snapshot per line"""
+    rows = [(i, datetime(2026, 1, 1, 1, 0), 2.0, ["night"], "age", datetime(2026, 1, 1, 2, 0))
+            for i in range(2)]
+    mocker.patch('api.iter_discarded_snapshots', return_value=iter(rows))
+
+    response = client.get('/discarded?reason=age', headers={'Accept': 'application/x-ndjson'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": i, "time": "2026-01-01T01:00:00", "value": 2.0, "tags": ["night"],
+         "reason": "age", "discarded_at": "2026-01-01T02:00:00"} for i in range(2)]
+
+def test_stream_sends_rows_in_chunks(mocker, client):
+    """Test rows are encoded a chunk at a time and still form one JSON array"""
+    rows = [(i, datetime(2026, 1, 1, 1, 30), 1.5, ["day"]) for i in range(5)]
+    mocker.patch('api.iter_valid_snapshots', return_value=iter(rows))
+    mocker.patch('api.STREAM_CHUNK_ROWS', 2)
+
+    response = client.get('/snapshots?stream=true')
+
+    assert [row["id"] for row in response.get_json()] == [0, 1, 2, 3, 4]
+
+def test_empty_stream_is_valid_json(mocker, client):
+    """Test an empty streamed window is still a JSON array"""
+    mocker.patch('api.iter_valid_snapshots', return_value=iter([]))
+
+    response = client.get('/snapshots?stream=1')
+
+    assert response.get_json() == []
+
+# GET /snapshots/export tests
+EXPORT_ROWS = [[(1, datetime(2026, 1, 1, 1, 30), 1.5, ["day", "sun-glint"]),
+                (2, datetime(2026, 1, 1, 1, 31), 2.5, [])]]
+
+def test_export_csv(mocker, client):
+    """Test CSV export streams a header and one line per snapshot"""
+    mock_batches = mocker.patch('api.iter_valid_batches', return_value=iter(EXPORT_ROWS))
+
+    response = client.get('/snapshots/export?format=csv&start=2026-01-01T00:00:00')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert 'snapshots.csv' in response.headers['Content-Disposition']
+    assert response.get_data(as_text=True).splitlines() == [
+        'id,time,value,tags',
+        '1,2026-01-01T01:30:00,1.5,day;sun-glint',
+        '2,2026-01-01T01:31:00,2.5,'
+    ]
+    assert mock_batches.call_args[0][0] == datetime(2026, 1, 1)
+
+def test_export_arrow(mocker, client):
+    """Test Arrow export can be read back with the expected column types"""
+    pa = pytest.importorskip('pyarrow')
+    mocker.patch('api.iter_valid_batches', return_value=iter(EXPORT_ROWS))
+
+    response = client.get('/snapshots/export?format=arrow')
+    table = pa.ipc.open_stream(response.get_data()).read_all()
+
+    assert table.column('value').type == pa.float32()
+    assert table.column('tags').to_pylist() == [["day", "sun-glint"], []]
+
+def test_export_invalid_format(client, caplog):
+    """Test unknown export formats are rejected"""
+    response = client.get('/snapshots/export?format=xml')
+
+    assert response.status_code == 400
+    assert 'Invalid format value: xml' in caplog.text
+
+def test_export_columnar_needs_pyarrow(mocker, client):
+    """Test Parquet export reports 501 when pyarrow isn't installed"""
+    mocker.patch('api.available', return_value=False)
+
+    response = client.get('/snapshots/export?format=parquet')
+
+    assert response.status_code == 501
+
+def test_export_invalid_start_time(client):
+    """Test export validates start/end like the other routes"""
+    response = client.get('/snapshots/export?format=csv&start=yesterday')
+
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid ISO start format'
+
+# GET /snapshots/stream tests
+def test_live_stream_sends_saved_snapshots(client):
+    """Test snapshots saved after subscribing are pushed as events"""
+    from api import broker, publish_rows
+
+    response = client.get('/snapshots/stream?tag=night', buffered=False)
+    body = iter(response.response)
+
+    assert response.mimetype == 'text/event-stream'
+    assert next(body) == b': connected\n\n'
+
+    publish_rows([(1, datetime(2026, 1, 1, 1, 30), 1.5, ["night"]),
+                  (2, datetime(2026, 1, 1, 1, 31), 2.5, ["day"])], [])
+
+    message = next(body).decode()
+    assert message.startswith('event: valid\n')
+    assert '"value": 1.5' in message and '"value": 2.5' not in message
+
+    # Disconnecting removes the subscriber
+    response.close()
+    assert broker.count() == 0
+
+def test_live_stream_invalid_kind(client):
+    """Test unknown feed kinds are rejected"""
+    response = client.get('/snapshots/stream?kind=everything')
+
+    assert response.status_code == 400
+
+def test_live_stream_full(mocker, client):
+    """Test 503 when the worker has no room for another stream"""
+    from feed import FeedFull
+    mocker.patch('api.broker.subscribe', side_effect=FeedFull('full'))
+
+    response = client.get('/snapshots/stream')
+
+    assert response.status_code == 503
+
+# GET /snapshots/aggregate tests
+def test_aggregate_request(mocker, client):
+    """Test aggregate requests are passed the bucket, window and tag"""
+    mock_query = mocker.patch('api.get_aggregated_snapshots', return_value=[{
+        "time": "2026-01-01T01:00:00", "count": 60, "avg": 12.5, "min": 10.0, "max": 15.0
+    }])
+
+    response = client.get('/snapshots/aggregate?bucket=1h&start=2026-01-01T00:00:00&tag=night')
+
+    assert response.status_code == 200
+    assert response.get_json()[0]["count"] == 60
+    mock_query.assert_called_once_with('1h', datetime.fromisoformat("2026-01-01T00:00:00"), datetime.max, 'night')
+
+def test_aggregate_invalid_bucket(client, caplog):
+    """Test missing or unknown buckets return 400 errors"""
+    assert client.get('/snapshots/aggregate').status_code == 400
+
+    response = client.get('/snapshots/aggregate?bucket=5m')
+    assert response.status_code == 400
+    assert 'Invalid bucket value:' in caplog.text
+
+# Response cache tests
+def test_repeated_request_is_served_from_cache(mocker, client):
+    """Test identical windows only query the database once"""
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[
+        (1, datetime(2026, 1, 1, 1, 30), 12.37, ["night"])
+    ])
+
+    first = client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+    second = client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+
+    assert mock_query.call_count == 1
+    assert first.get_data() == second.get_data()
+    assert response_cache.stats()['hits'] == 1
+
+def test_unchanged_window_returns_304(mocker, client):
+    """Test If-None-Match with the current ETag returns 304"""
+    mocker.patch('api.get_discarded_snapshots', return_value=[])
+
+    first = client.get('/discarded?reason=age')
+    etag = first.headers['ETag']
+    second = client.get('/discarded?reason=age', headers={'If-None-Match': etag})
+
+    assert second.status_code == 304
+    assert second.get_data() == b''
+
+def test_write_inside_window_invalidates_cache(mocker, client):
+    """Test saving a snapshot inside a cached window drops that entry only"""
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[])
+
+    client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+    client.get('/snapshots?start=2026-01-02T01:00:00&end=2026-01-02T02:00:00')
+
+    # New row in the first window only
+    invalidate_cache([(1, datetime(2026, 1, 1, 1, 30), 12.0, ["night"])], [])
+
+    client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+    client.get('/snapshots?start=2026-01-02T01:00:00&end=2026-01-02T02:00:00')
+
+    assert mock_query.call_count == 3
+    assert response_cache.stats()['invalidations'] == 1
+
+def test_missed_snapshots_drop_cache_and_reload_window(mocker, client):
+    """Test a notification without its rows drops every cached page"""
+    from api import on_remote_missed
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[])
+    mock_start = mocker.patch('api.hot_window.start')
+
+    client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+    on_remote_missed()
+    client.get('/snapshots?start=2026-01-01T01:00:00&end=2026-01-01T02:00:00')
+
+    assert mock_query.call_count == 2
+    mock_start.assert_called_once_with()
+
+def test_cache_keeps_to_its_byte_budget():
+    """Test large bodies aren't cached and the oldest are dropped to stay under max_bytes"""
+    from cache import ResponseCache
+    cache = ResponseCache(max_entries=10, max_bytes=250, max_entry_bytes=100)
+    start, end = datetime(2026, 1, 1), datetime(2026, 1, 2)
+
+    cache.put('large', b'x' * 101, {}, VALID, start, end, 0)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, b'x' * 100, {}, VALID, start, end, 0)
+
+    stats = cache.stats()
+    assert stats['too_large'] == 1
+    assert stats['entries'] == 2 and stats['bytes'] == 200
+    assert cache.get('large') is None and cache.get('a') is None
+    assert cache.get('c') is not None
+
+def test_pages_default_to_api_default_limit(mocker, client):
+    """Test a page without 'limit' is capped and streams are not"""
+    mocker.patch('api.API_DEFAULT_LIMIT', 2)
+    mock_query = mocker.patch('api.get_valid_snapshots', return_value=[
+        (1, datetime(2026, 1, 1, 1, 30), 12.37, ["night"]),
+        (2, datetime(2026, 1, 1, 1, 31), 12.4, ["night"])
+    ])
+    mock_stream = mocker.patch('api.iter_valid_snapshots', return_value=iter([]))
+
+    response = client.get('/snapshots')
+    client.get('/snapshots?stream=true')
+
+    assert mock_query.call_args.args[2] == 2
+    assert 'X-Next-Cursor' in response.headers
+    assert mock_stream.call_args.args[2] is None
+
+def test_database_json_is_passed_through(mocker, client):
+    """Test API_DATABASE_JSON sends the body Postgres built untouched"""
+    mocker.patch('api.API_DATABASE_JSON', True)
+    body = '[{"id": 2, "tags": ["night"], "time": "2026-01-01T01:31:00", "value": 12.4}]'
+    mock_query = mocker.patch('api.get_snapshots_json',
+                              return_value=(body, 1, (datetime(2026, 1, 1, 1, 31), 2)))
+    mock_get = mocker.patch('api.get_valid_snapshots')
+
+    response = client.get('/snapshots?limit=1&tag=night')
+
+    assert response.get_data(as_text=True) == body
+    assert mock_query.call_args.args == (VALID, datetime.min, datetime.max, 1, None, None, ('night',), None)
+    assert decode_cursor(response.headers['X-Next-Cursor']) == (datetime(2026, 1, 1, 1, 31), 2)
+    mock_get.assert_not_called()
+
+def test_recent_window_is_served_from_hot_window(mocker, client):
+    """Test a page of recent snapshots is read from the hot window, not the database"""
+    from datetime import timedelta
+    from hot_window import HotWindow
+
+    now = datetime.now().replace(microsecond=0)
+    row = (7, now - timedelta(minutes=5), 12.37, ["night"])
+    mocker.patch('hot_window.iter_valid_snapshots', return_value=iter([row]))
+    mocker.patch('hot_window.iter_discarded_snapshots', return_value=iter([]))
+    window = HotWindow(hours=1)
+    window.start()
+    mocker.patch('api.hot_window', window)
+    mock_get = mocker.patch('api.get_valid_snapshots')
+
+    response = client.get(f'/snapshots?start={(now - timedelta(minutes=10)).isoformat()}')
+
+    assert response.get_json() == [{'id': 7, 'tags': ['night'], 'time': row[1].isoformat(), 'value': 12.37}]
+    mock_get.assert_not_called()
+
+# GET /metrics tests
+def test_metrics_endpoint_records_requests(mocker, client):
+    """Test request latency and size are exposed per route"""
+    mocker.patch('api.get_valid_snapshots', return_value=[])
+    client.get('/snapshots')
+
+    response = client.get('/metrics')
+    text = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'http_request_duration_seconds_count{route="/snapshots"}' in text
+    assert 'http_response_size_bytes_count{route="/snapshots"}' in text
+    assert 'api_cache_misses' in text
+
+# GET /health tests
+def test_health_ok(mocker, client):
+    """Test health returns 200 when the database answers"""
+    mocker.patch('api.check_db', return_value=True)
+
+    response = client.get('/health')
+
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
+
+def test_health_database_down(mocker, client):
+    """Test health returns 503 when the database is unreachable"""
+    mocker.patch('api.check_db', return_value=False)
+
+    response = client.get('/health')
+
+    assert response.status_code == 503
+    assert response.get_json()['database'] == 'unreachable'
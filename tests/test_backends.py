@@ -0,0 +1,175 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta, timezone
+
+from backends import create_backend
+from backends.memory import MemoryBackend
+from backends.sqlite import SQLiteBackend
+
+T0 = datetime(2026, 1, 18, 14, 35, 1)
+
+SOURCE = "http://localhost:28462/"
+
+VALID_ROWS = [
+    (T0, 12.37, ["night"], SOURCE),
+    (T0 + timedelta(seconds=1), 12.5, ["night", "eclipse"], SOURCE),
+    (T0 + timedelta(seconds=2), 13.0, ["day"], SOURCE),
+    (T0 + timedelta(minutes=1), 14.0, ["day"], SOURCE),
+]
+
+DISCARDED_ROWS = [
+    (T0, 99.0, ["system"], "system", T0, SOURCE),
+    (T0 + timedelta(seconds=1), 98.0, ["suspect"], "suspect", T0, SOURCE),
+]
+
+# A written row as it is read back, without its source
+def stored(row):
+    return row[:-1]
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    backend = MemoryBackend() if request.param == "memory" else SQLiteBackend(str(tmp_path / "snapshots.db"))
+    backend.init()
+    yield backend
+    backend.close()
+
+def test_insert_skips_stored_time_and_tags(backend):
+    """Test each (time, tags, source) is stored once and only new rows are returned, with ids"""
+    valid, discarded = backend.insert_snapshots(VALID_ROWS[:2], DISCARDED_ROWS[:1])
+    assert valid == [(1, *stored(VALID_ROWS[0])), (2, *stored(VALID_ROWS[1]))]
+    assert discarded == [(1, *stored(DISCARDED_ROWS[0]))]
+
+    valid, discarded = backend.insert_snapshots(VALID_ROWS, DISCARDED_ROWS)
+
+    assert [row[1:] for row in valid] == list(map(stored, VALID_ROWS[2:]))
+    assert [row[1:] for row in discarded] == list(map(stored, DISCARDED_ROWS[1:]))
+    assert len(backend.get_valid_snapshots(datetime.min, datetime.max)) == 4
+
+def test_same_reading_from_another_source_is_stored(backend):
+    """Test two satellites reporting the same time and tags are both kept"""
+    other = (*VALID_ROWS[0][:3], "http://localhost:28463/")
+    backend.insert_snapshots(VALID_ROWS[:1], [(*DISCARDED_ROWS[0][:5], "http://localhost:28463/")])
+
+    valid, discarded = backend.insert_snapshots([other, VALID_ROWS[0]], DISCARDED_ROWS[:1])
+
+    assert [row[1:] for row in valid] == [stored(other)]
+    assert len(discarded) == 1
+    assert len(backend.get_valid_snapshots(T0, T0)) == 2
+
+def test_range_query_returns_ordered_tuples(backend):
+    """Test range queries return (id, time, value, tags) tuples in time order"""
+    backend.insert_snapshots(list(reversed(VALID_ROWS)), [])
+
+    rows = backend.get_valid_snapshots(T0, T0 + timedelta(seconds=2))
+
+    assert [row[1:] for row in rows] == list(map(stored, VALID_ROWS[:3]))
+
+def test_range_query_pages_with_cursor(backend):
+    """Test limit and the (time, id) cursor walk through every row once"""
+    backend.insert_snapshots(VALID_ROWS, [])
+
+    first = backend.get_valid_snapshots(datetime.min, datetime.max, limit=3)
+    rest = backend.get_valid_snapshots(datetime.min, datetime.max, limit=3, after=(first[-1][1], first[-1][0]))
+
+    assert [row[2] for row in first + rest] == [12.37, 12.5, 13.0, 14.0]
+
+def test_tag_filters(backend):
+    """Test tags_all needs every tag and tags_any needs one of them"""
+    backend.insert_snapshots(VALID_ROWS, [])
+
+    both = backend.get_valid_snapshots(datetime.min, datetime.max, tags_all=("night", "eclipse"))
+    either = backend.get_valid_snapshots(datetime.min, datetime.max, tags_any=("eclipse", "day"))
+
+    assert [row[2] for row in both] == [12.5]
+    assert [row[2] for row in either] == [12.5, 13.0, 14.0]
+
+def test_reason_query(backend):
+    """Test discarded rows can be read for one reason or all of them"""
+    backend.insert_snapshots([], DISCARDED_ROWS)
+
+    suspect = backend.get_discarded_snapshots(datetime.min, datetime.max, "suspect")
+    every = backend.get_discarded_snapshots(datetime.min, datetime.max, None)
+
+    assert [row[1:] for row in suspect] == [stored(DISCARDED_ROWS[1])]
+    assert len(every) == 2
+
+def test_aware_bounds_are_compared_as_local_time(backend):
+    """Test timezone-aware bounds match the naive times that are stored"""
+    backend.insert_snapshots(VALID_ROWS, [])
+    end = (T0 + timedelta(seconds=1)).astimezone(timezone.utc)
+
+    assert len(backend.get_valid_snapshots(datetime.min, end)) == 2
+
+def test_iter_queries_stream_the_same_rows(backend):
+    """Test streamed reads and export batches return what a plain read does"""
+    backend.insert_snapshots(VALID_ROWS, DISCARDED_ROWS)
+    rows = backend.get_valid_snapshots(datetime.min, datetime.max)
+
+    assert list(backend.iter_valid_snapshots(datetime.min, datetime.max)) == rows
+    assert [row for batch in backend.iter_valid_batches(datetime.min, datetime.max) for row in batch] == rows
+    assert len(list(backend.iter_discarded_snapshots(datetime.min, datetime.max, "system"))) == 1
+
+def test_aggregates_per_bucket(backend):
+    """Test aggregates are computed per minute bucket and per tag"""
+    backend.insert_snapshots(VALID_ROWS, [])
+
+    buckets = backend.get_aggregated_snapshots('1m', T0, datetime.max)
+    day = backend.get_aggregated_snapshots('1m', T0, datetime.max, tag="day")
+
+    assert buckets[0] == {'time': '2026-01-18T14:35:00', 'count': 3,
+                          'avg': pytest.approx((12.37 + 12.5 + 13.0) / 3),
+                          'min': pytest.approx(12.37), 'max': 13.0}
+    assert buckets[1]['count'] == 1
+    assert [bucket['count'] for bucket in day] == [1, 1]
+
+def test_maintain_deletes_expired_rows(backend, mocker):
+    """Test rows older than the retention period are deleted"""
+    old = (datetime.now() - timedelta(days=10), 1.0, ["night"], SOURCE)
+    recent = (datetime.now(), 2.0, ["night"], SOURCE)
+    backend.insert_snapshots([old, recent], [])
+
+    mocker.patch(f"backends.{backend.name}.retention_cutoff", return_value=datetime.now() - timedelta(days=7))
+    backend.maintain()
+
+    assert [row[2] for row in backend.get_valid_snapshots(datetime.min, datetime.max)] == [2.0]
+
+    # An expired reading can be saved again
+    assert [row[1:] for row in backend.insert_snapshots([old], [])[0]] == [stored(old)]
+
+def test_sqlite_file_uses_wal_and_is_shared(tmp_path):
+    """Test the SQLite backend runs in WAL mode and another instance sees its rows"""
+    path = str(tmp_path / "snapshots.db")
+    writer = SQLiteBackend(path)
+    writer.init()
+    reader = SQLiteBackend(path)
+    reader.init(create=False)
+
+    writer.insert_snapshots(VALID_ROWS, [])
+
+    assert writer.connection().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert len(reader.get_valid_snapshots(datetime.min, datetime.max)) == 4
+    writer.close()
+    reader.close()
+
+def test_create_backend_rejects_unknown_name():
+    """Test an unknown backend name is reported"""
+    assert create_backend("memory").name == "memory"
+    with pytest.raises(ValueError):
+        create_backend("oracle")
+
+def test_write_snapshots_goes_through_selected_backend(mocker):
+    """Test storage writes and reads use the backend chosen in config"""
+    import storage
+
+    mocker.patch("database.backend", MemoryBackend())
+    mock_listener = mocker.patch("storage.notify_write_listeners")
+
+    storage.write_snapshots(VALID_ROWS, [])
+    storage.write_snapshots(VALID_ROWS[:1], [])
+
+    assert mock_listener.call_args.args == ([], [])
+    assert len(storage.get_valid_snapshots(datetime.min, datetime.max)) == 4
+    assert not storage.builds_json()
@@ -0,0 +1,181 @@
+import pytest
+import io
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from unittest.mock import patch, MagicMock
+
+import backfill
+from backfill import (read_csv, read_chunks, array_literal, copy_rows, split_records,
+                      Checkpoint, import_file)
+from validation import ValidationPipeline, TagBlacklistRule
+
+def test_read_csv_splits_tags():
+    """Test CSV rows are parsed with ';' separated tags"""
+    file = io.StringIO("time,value,tags\n1736900000,12.5,night;sun-glint\n1736900001,3,\n")
+
+    records = list(read_csv(file))
+
+    assert records[0] == {'time': '1736900000', 'value': '12.5', 'tags': ['night', 'sun-glint']}
+    assert records[1]['tags'] == []
+
+def test_read_chunks_skips_checkpointed_records():
+    """Test chunking resumes after the records already loaded"""
+    chunks = list(read_chunks(iter(range(10)), 4, 3))
+
+    assert chunks == [[3, 4, 5, 6], [7, 8, 9]]
+
+def test_array_literal_quotes_tags():
+    """Test tags are quoted for a Postgres array literal"""
+    assert array_literal([]) == '{}'
+    assert array_literal(['night', 'say "hi"']) == '{"night","say \\"hi\\""}'
+
+def test_copy_rows_encodes_csv():
+    """Test rows are sent to COPY as CSV with array literals"""
+    cursor = MagicMock()
+
+    copy_rows(cursor, 'valid_snapshots', ('time', 'value', 'tags'), [('2026-01-18', 1.5, ['a', 'b'])])
+
+    sql, buffer = cursor.copy_expert.call_args[0]
+    assert sql == "COPY valid_snapshots (time, value, tags) FROM STDIN WITH (FORMAT csv)"
+    assert buffer.getvalue() == '2026-01-18,1.5,"{""a"",""b""}"\r\n'
+
+def test_copy_rows_skips_empty_batch():
+    """Test nothing is sent when there are no rows"""
+    cursor = MagicMock()
+
+    copy_rows(cursor, 'valid_snapshots', ('time', 'value', 'tags'), [])
+
+    cursor.copy_expert.assert_not_called()
+
+def test_split_records():
+    """Test records are validated and malformed ones skipped"""
+    pipeline = ValidationPipeline([TagBlacklistRule(['system'])])
+    records = [
+        {'time': 1736900000, 'value': 1, 'tags': ['night']},
+        {'time': 1736900001, 'value': 2, 'tags': ['system'], 'source': 'sat-2'},
+        {'time': 1736900002, 'tags': []},
+    ]
+
+    valid_rows, discarded_rows = split_records(records, pipeline, 1736900010, 'sat-1')
+
+    assert [row[1:] for row in valid_rows] == [(1.0, ['night'], 'sat-1')]
+    assert [row[1:4] + row[5:] for row in discarded_rows] == [(2.0, ['system'], 'system', 'sat-2')]
+
+def test_checkpoint_round_trip(tmp_path):
+    """Test progress is saved and read back"""
+    path = str(tmp_path / 'checkpoint.json')
+
+    Checkpoint(path).save('/data/a.csv', 100)
+
+    assert Checkpoint(path).loaded('/data/a.csv') == 100
+    assert Checkpoint(path).loaded('/data/b.csv') == 0
+
+def test_import_file_resumes_and_checkpoints(tmp_path):
+    """Test a resumed import only loads the remaining records"""
+    path = tmp_path / 'snapshots.ndjson'
+    path.write_text(''.join(f'{{"time": {1736900000 + i}, "value": {i}, "tags": []}}\n' for i in range(5)))
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.save(str(path), 2)
+
+    with patch('backfill.load_chunk') as mock_load:
+        totals = import_file(str(path), ValidationPipeline([]), checkpoint, chunk_size=2, jobs=2)
+
+    assert totals == {'records': 3, 'valid': 3, 'discarded': 0}
+    assert mock_load.call_count == 2
+    assert checkpoint.loaded(str(path)) == 5
+
+def test_import_file_stops_checkpoint_at_failed_chunk(tmp_path):
+    """Test the checkpoint doesn't move past a chunk that failed to load"""
+    path = tmp_path / 'snapshots.ndjson'
+    path.write_text(''.join(f'{{"time": {1736900000 + i}, "value": {i}, "tags": []}}\n' for i in range(4)))
+    checkpoint = Checkpoint(None)
+
+    with patch('backfill.load_chunk', side_effect=[None, Exception("copy failed")]):
+        with pytest.raises(Exception):
+            import_file(str(path), ValidationPipeline([]), checkpoint, chunk_size=2, jobs=1)
+
+    assert checkpoint.loaded(str(path)) == 2
+
+def test_import_file_skips_malformed_lines(tmp_path):
+    """Test a line that isn't JSON is skipped but still counted by the checkpoint"""
+    path = tmp_path / 'snapshots.ndjson'
+    path.write_text('{"time": 1736900000, "value": 1, "tags": []}\n{"time": 17369\n'
+                    '{"time": 1736900002, "value": 2, "tags": []}\n')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+
+    with patch('backfill.load_chunk') as mock_load:
+        totals = import_file(str(path), ValidationPipeline([]), checkpoint, chunk_size=2, jobs=1)
+
+    assert totals == {'records': 3, 'valid': 2, 'discarded': 0}
+    assert sum(len(call.args[0]) for call in mock_load.call_args_list) == 2
+    assert Checkpoint(str(tmp_path / 'checkpoint.json')).loaded(str(path)) == 3
+
+def test_import_file_checkpoints_submitted_chunks_when_reading_fails(tmp_path, mocker):
+    """Test chunks already loading are still checkpointed if the import stops early"""
+    path = tmp_path / 'snapshots.ndjson'
+    path.write_text('')
+    checkpoint = Checkpoint(None)
+    record = {'time': 1736900000, 'value': 1, 'tags': []}
+
+    def records(file):
+        yield from [record] * 4
+        raise OSError("disk error")
+
+    mocker.patch.dict(backfill.READERS, {'.ndjson': records})
+    with patch('backfill.load_chunk'):
+        with pytest.raises(OSError):
+            import_file(str(path), ValidationPipeline([]), checkpoint, chunk_size=2, jobs=4)
+
+    assert checkpoint.loaded(str(path)) == 4
+
+def test_import_file_rejects_unknown_format(tmp_path):
+    """Test unsupported file types are refused"""
+    with pytest.raises(ValueError):
+        import_file(str(tmp_path / 'snapshots.xml'), ValidationPipeline([]), Checkpoint(None))
+
+def test_copy_new_rows_skips_existing_snapshots():
+    """Test rows are staged with COPY and moved across with ON CONFLICT"""
+    cursor = MagicMock()
+    cursor.fetchall.return_value = [('2026-01-18', 1.5, ['a'])]
+
+    inserted = backfill.copy_new_rows(cursor, 'valid_snapshots', backfill.VALID_COLUMNS,
+                                      'time TIMESTAMP, value REAL, tags TEXT[], source TEXT',
+                                      [('2026-01-18', 1.5, ['a'], ''), ('2026-01-18', 1.5, ['a'], '')])
+
+    assert 'COPY backfill_valid_snapshots' in cursor.copy_expert.call_args[0][0]
+    assert 'ON CONFLICT (time, tags, source) DO NOTHING' in cursor.execute.call_args[0][0]
+    assert inserted == [('2026-01-18', 1.5, ['a'])]
+
+def test_loaded_chunk_reaches_hot_window(mocker):
+    """Test snapshots loaded by backfill are added to a running hot window"""
+    from datetime import datetime, timedelta
+    from backends.memory import MemoryBackend
+    from hot_window import HotWindow
+    from storage import VALID
+
+    window = HotWindow(hours=1)
+    mocker.patch("database.backend", MemoryBackend())
+    mocker.patch("storage.write_listeners", [window.add])
+    window.start()
+    now = datetime.now()
+
+    backfill.load_chunk([(now, 1.5, ['night'], 'sat-1')], [])
+
+    rows = window.read(VALID, now - timedelta(minutes=1), now, None, None, (None, None, None), MagicMock())
+    assert rows == [(1, now, 1.5, ['night'])]
+
+def test_copied_chunk_is_announced(mocker):
+    """Test rows inserted with COPY go to the write listeners after commit"""
+    valid = [(7, '2026-01-18', 1.5, ['a'])]
+    mocker.patch("backfill.get_backend").return_value.name = 'postgres'
+    mocker.patch("backfill.pooled_connection")
+    mocker.patch("backfill.copy_new_rows", side_effect=[valid, []])
+    mock_rollups = mocker.patch("backfill.update_rollups")
+    mock_notify = mocker.patch("backfill.notify_write_listeners")
+
+    backfill.load_chunk([('2026-01-18', 1.5, ['a'], '')], [])
+
+    assert mock_rollups.call_args.args[1] == [('2026-01-18', 1.5, ['a'])]
+    mock_notify.assert_called_once_with(valid, [])
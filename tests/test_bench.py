@@ -0,0 +1,107 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+from datetime import datetime
+
+from bench.data_server import FakeDataServer, parse_tag_mix
+from bench.results import summarize, compare, write_results
+
+def test_fake_data_server_repeats_latest_snapshot():
+    """Test the fake data-server returns the same snapshot until the next is due"""
+    import requests
+
+    server = FakeDataServer(rate=0.001).start()
+    try:
+        first = requests.get(server.source_url(1), timeout=5)
+        second = requests.get(server.source_url(1), timeout=5)
+        other = requests.get(server.source_url(2), timeout=5)
+    finally:
+        server.stop()
+
+    assert first.status_code == 200
+    assert first.json() == second.json()
+    assert set(first.json()) == {"time", "value", "tags"}
+    # Satellites report at the same times, their readings are told apart by source
+    assert other.json()["time"] == first.json()["time"]
+
+def test_fake_data_server_no_data():
+    """Test every snapshot can be answered with 404"""
+    server = FakeDataServer(no_data=1.0)
+    server._server.server_close()
+
+    assert server.snapshot("/") is None
+
+def test_parse_tag_mix():
+    """Test tag mixes are read as tags and weights"""
+    assert parse_tag_mix("night=3, day") == (["night", "day"], [3.0, 1.0])
+    with pytest.raises(ValueError):
+        parse_tag_mix("")
+
+def test_summarize_reports_percentiles_in_ms():
+    """Test latency samples are summarised with nearest-rank percentiles"""
+    summary = summarize([i / 1000 for i in range(1, 101)])
+
+    assert summary["count"] == 100
+    assert summary["p50_ms"] == 50
+    assert summary["p99_ms"] == 99
+    assert summary["max_ms"] == 100
+    assert summarize([]) == {"count": 0}
+
+def test_compare_flags_regressions_by_direction():
+    """Test slower latency and lower throughput count as regressions"""
+    old = {"results": {"latency": {"count": 10, "p99_ms": 10.0}, "requests_per_s": 100.0}}
+    new = {"results": {"latency": {"count": 20, "p99_ms": 12.0}, "requests_per_s": 120.0}}
+
+    rows = {key: regressed for key, _, _, _, regressed in compare(old, new, threshold=10)}
+
+    assert rows == {"latency.count": False, "latency.p99_ms": True, "requests_per_s": False}
+
+def test_write_results_records_commit_and_params(tmp_path):
+    """Test results are written as JSON with the run's parameters"""
+    path = write_results("ingest", {"sources": 4}, {"polls_per_s": 12.5},
+                         datetime(2026, 1, 18, 14, 35, 1), str(tmp_path / "result.json"))
+
+    with open(path) as file:
+        document = json.load(file)
+
+    assert document["benchmark"] == "ingest"
+    assert document["params"] == {"sources": 4}
+    assert document["results"] == {"polls_per_s": 12.5}
+    assert document["started_at"] == "2026-01-18T14:35:01"
+    assert "commit" in document
+
+def test_memory_backend_skips_repeated_keys(mocker):
+    """Test the in-memory benchmark backend stores each (time, tags, source) once"""
+    import database
+    from bench.ingest import use_backend
+
+    mocker.patch("database.backend", None)
+    mock_notify = mocker.patch("storage.notify_write_listeners")
+    write = use_backend("memory")
+    row = (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], "sat-1")
+
+    write([row], [])
+    write([row, (row[0], 12.37, ["day"], "sat-1"), (row[0], 12.37, ["night"], "sat-2")], [])
+
+    assert database.backend.name == "memory"
+    assert len(database.backend.valid.rows) == 3
+    assert mock_notify.call_args.args == ([(2, row[0], 12.37, ["day"]), (3, row[0], 12.37, ["night"])], [])
+
+def test_in_process_load_traces_memory(mocker):
+    """Test in-process requests report latency and peak allocations"""
+    from bench.load import run_in_process, window_params
+    from api import response_cache
+
+    response_cache.clear()
+    mocker.patch("api.get_valid_snapshots", return_value=[])
+    end = datetime(2026, 1, 18, 14, 35, 1)
+
+    latencies, statuses, sizes, peaks = run_in_process(
+        "/snapshots", lambda n: window_params(60, end, n, cached=False), 3)
+
+    assert len(latencies) == 3
+    assert statuses == {"200": 3}
+    assert all(peak > 0 for peak in peaks)
@@ -0,0 +1,53 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from database import create_unique_keys, remove_duplicate_snapshots
+
+def test_unique_keys_include_source():
+    """Test the unique indexes cover (time, tags, source) and replace the old ones"""
+    cursor = MagicMock()
+    # Source column exists, indexes don't, no duplicates
+    cursor.fetchone.side_effect = [(1,), (None,), (0,)] * 2
+
+    create_unique_keys(cursor)
+
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert any("ON valid_snapshots (time, tags, source)" in sql for sql in statements)
+    assert "DROP INDEX IF EXISTS uq_discarded_time_tags" in statements
+    assert not any("DELETE" in sql for sql in statements)
+
+def test_duplicates_stop_startup_instead_of_being_deleted():
+    """Test rows stored twice are left for the migrate step to remove"""
+    cursor = MagicMock()
+    # Source column missing, index missing, 3 duplicated readings
+    cursor.fetchone.side_effect = [None, (None,), (3,)]
+
+    with pytest.raises(Exception, match="--mode migrate"):
+        create_unique_keys(cursor)
+
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert any("ADD COLUMN source" in sql for sql in statements)
+    assert not any("DELETE" in sql or "CREATE UNIQUE INDEX" in sql for sql in statements)
+
+def test_migrate_removes_duplicates_from_rollups(mocker):
+    """Test the migrate step deletes repeated readings per source and fixes the rollups"""
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    duplicate = (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"])
+    # Table exists, source column exists, rollup table exists, for each table
+    cursor.fetchone.side_effect = [("valid_snapshots",), (1,), ("snapshot_rollups",),
+                                   ("discarded_snapshots",), (1,), ("snapshot_rollups",)]
+    cursor.fetchall.side_effect = [[duplicate], []]
+    mock_subtract = mocker.patch("database.subtract_rollups")
+
+    remove_duplicate_snapshots(connection)
+
+    deletes = [call.args[0] for call in cursor.execute.call_args_list if "DELETE" in call.args[0]]
+    assert len(deletes) == 2 and all("a.source = b.source" in sql for sql in deletes)
+    mock_subtract.assert_called_once_with(cursor, [duplicate])
+    connection.commit.assert_called_once()
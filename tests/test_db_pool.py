@@ -0,0 +1,81 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import threading
+import time
+from unittest.mock import MagicMock
+
+from psycopg2 import extensions
+
+from db_pool import ConnectionPool, PoolTimeout
+
+def fake_connect():
+    """Create a mock connection that looks idle and open"""
+    connection = MagicMock()
+    connection.closed = 0
+    connection.get_transaction_status.return_value = extensions.TRANSACTION_STATUS_IDLE
+    return connection
+
+def test_pool_grows_to_max_then_waits():
+    """Test the pool opens connections on demand and times out when full"""
+    pool = ConnectionPool(fake_connect, minconn=1, maxconn=2, timeout=0.05)
+
+    first = pool.getconn()
+    second = pool.getconn()
+    assert first is not second
+    assert pool.size() == 2
+
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+def test_waiting_caller_gets_returned_connection():
+    """Test a caller blocked on a full pool gets the next returned connection"""
+    pool = ConnectionPool(fake_connect, minconn=0, maxconn=1, timeout=2)
+    held = pool.getconn()
+    result = {}
+
+    waiter = threading.Thread(target=lambda: result.setdefault('conn', pool.getconn()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.putconn(held)
+    waiter.join()
+
+    assert result['conn'] is held
+
+def test_open_transaction_is_rolled_back_on_return():
+    """Test connections go back to the pool without an open transaction"""
+    pool = ConnectionPool(fake_connect, minconn=1, maxconn=1)
+    connection = pool.getconn()
+    connection.get_transaction_status.return_value = extensions.TRANSACTION_STATUS_INTRANS
+
+    pool.putconn(connection)
+
+    connection.rollback.assert_called_once()
+    assert pool.getconn() is connection
+
+def test_old_and_broken_connections_are_replaced():
+    """Test expired or failed idle connections are not handed out"""
+    pool = ConnectionPool(fake_connect, minconn=1, maxconn=1, max_age=3600, check_after=0)
+    connection = pool.getconn()
+    pool.putconn(connection)
+
+    # Health check fails, so a new connection is opened in its place
+    connection.cursor.return_value.__enter__.return_value.execute.side_effect = Exception("gone")
+    replacement = pool.getconn()
+
+    assert replacement is not connection
+    connection.close.assert_called_once()
+    assert pool.size() == 1
+
+def test_closeall_closes_every_connection():
+    """Test closing the pool closes idle and checked out connections"""
+    pool = ConnectionPool(fake_connect, minconn=2, maxconn=2)
+    used = pool.getconn()
+
+    pool.closeall()
+
+    used.close.assert_called_once()
+    with pytest.raises(Exception, match="closed"):
+        pool.getconn()
@@ -0,0 +1,124 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+from datetime import datetime
+
+from feed import (Broker, FeedFull, snapshot_event, encode_rows, decode_payload,
+                  NOTIFY_PAYLOAD_LIMIT)
+from storage import VALID, DISCARDED
+
+VALID_ROW = (1, datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"])
+DISCARDED_ROW = (2, datetime(2026, 1, 18, 14, 35, 2), 3.5, ["system"], "system",
+                 datetime(2026, 1, 18, 14, 35, 3))
+
+def test_snapshot_event_is_server_sent_event():
+    """Test events are encoded once as SSE messages"""
+    event = snapshot_event(DISCARDED, DISCARDED_ROW)
+
+    lines = event.message.split('\n')
+    assert lines[0] == 'event: discarded'
+    assert json.loads(lines[1][len('data: '):]) == {
+        'time': '2026-01-18T14:35:02', 'value': 3.5, 'tags': ['system'],
+        'reason': 'system', 'discarded_at': '2026-01-18T14:35:03'
+    }
+    assert event.message.endswith('\n\n')
+
+def test_broker_fans_out_to_matching_subscribers():
+    """Test each subscriber only gets the kinds and tags it asked for"""
+    broker = Broker(buffer_size=10, max_subscribers=5)
+    everything = broker.subscribe((VALID, DISCARDED))
+    night = broker.subscribe((VALID,), tags_all=("night",))
+    day = broker.subscribe((VALID,), tags_any=("day", "dusk"))
+
+    broker.publish([snapshot_event(VALID, VALID_ROW), snapshot_event(DISCARDED, DISCARDED_ROW)])
+
+    assert len(everything.get_batch(0.1)) == 2
+    assert [event.kind for event in night.get_batch(0.1)] == [VALID]
+    assert day.get_batch(0.01) == []
+
+def test_slow_subscriber_is_dropped():
+    """Test a full subscriber is dropped without affecting the others"""
+    broker = Broker(buffer_size=2, max_subscribers=5)
+    slow = broker.subscribe((VALID,))
+    fast = broker.subscribe((VALID,))
+
+    for _ in range(3):
+        broker.publish([snapshot_event(VALID, VALID_ROW)])
+        fast.get_batch(0.1)
+
+    assert slow.dropped
+    assert not fast.dropped
+    assert broker.count() == 1
+
+def test_subscriber_limit():
+    """Test subscriptions are refused over the limit"""
+    broker = Broker(buffer_size=2, max_subscribers=1)
+    subscription = broker.subscribe((VALID,))
+
+    with pytest.raises(FeedFull):
+        broker.subscribe((VALID,))
+
+    broker.unsubscribe(subscription)
+    broker.subscribe((VALID,))
+
+def test_notify_payload_round_trip():
+    """Test rows survive encoding for NOTIFY"""
+    payloads = encode_rows([VALID_ROW], [DISCARDED_ROW])
+
+    assert len(payloads) == 1
+    assert decode_payload(payloads[0]) == ([VALID_ROW], [DISCARDED_ROW], 0)
+
+def test_oversized_row_is_announced_as_missed(mocker):
+    """Test a row too large for NOTIFY is replaced by a marker that calls on_missed"""
+    from feed import FeedListener
+
+    huge = (VALID_ROW[0] + 1, VALID_ROW[1], VALID_ROW[2], ["x" * NOTIFY_PAYLOAD_LIMIT])
+    payloads = encode_rows([VALID_ROW, huge], [])
+    on_rows = mocker.Mock()
+    on_missed = mocker.Mock()
+
+    assert decode_payload(payloads[0]) == ([VALID_ROW], [], 1)
+    FeedListener(on_rows, on_missed=on_missed)._handle(payloads[0])
+
+    on_rows.assert_called_once_with([VALID_ROW], [])
+    on_missed.assert_called_once_with()
+
+def test_backfill_is_announced_without_its_rows(mocker):
+    """Test notify_missed sends a single marker instead of the rows"""
+    from feed import notify_missed
+
+    mock_send = mocker.patch("feed.send_payloads")
+    notify_missed()
+
+    payloads = mock_send.call_args.args[0]
+    assert len(payloads) == 1
+    assert decode_payload(payloads[0]) == ([], [], 1)
+
+def test_listener_can_skip_its_own_notifications(mocker):
+    """Test a listener in the process that saved the rows doesn't handle them twice"""
+    from feed import FeedListener
+
+    payload = encode_rows([VALID_ROW], [])[0]
+    own = mocker.Mock()
+    other = mocker.Mock()
+
+    FeedListener(own, skip_own=True)._handle(payload)
+    FeedListener(other)._handle(payload)
+    mocker.patch("feed.os.getpid", return_value=-1)
+    FeedListener(own, skip_own=True)._handle(payload)
+
+    own.assert_called_once_with([VALID_ROW], [])
+    other.assert_called_once_with([VALID_ROW], [])
+
+def test_notify_payloads_are_split_under_limit():
+    """Test large batches are split into payloads Postgres accepts"""
+    rows = [VALID_ROW] * 1000
+
+    payloads = encode_rows(rows, [])
+
+    assert len(payloads) > 1
+    assert all(len(payload.encode()) <= NOTIFY_PAYLOAD_LIMIT for payload in payloads)
+    assert sum(len(decode_payload(payload)[0]) for payload in payloads) == 1000
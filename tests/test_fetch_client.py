@@ -0,0 +1,68 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import requests
+
+from fetch_client import CircuitBreaker, CircuitOpenError, FetchClient, get_client
+
+def test_circuit_opens_after_repeated_failures():
+    """Test the circuit opens once the failure threshold is reached"""
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+
+    for _ in range(3):
+        breaker.before_request()
+        breaker.record_failure()
+
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+def test_circuit_allows_trial_after_cooldown(mocker):
+    """Test one trial request is allowed after the cooldown and closes the circuit"""
+    mock_time = mocker.patch("fetch_client.time.monotonic", return_value=100.0)
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    breaker.record_failure()
+
+    # Cooldown passed, first caller gets the trial, second is still refused
+    mock_time.return_value = 131.0
+    breaker.before_request()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    breaker.record_success()
+    assert not breaker.is_open()
+    breaker.before_request()
+
+def test_client_counts_errors_and_5xx_as_failures(mocker):
+    """Test connection errors and 5xx responses count against the server"""
+    client = FetchClient(breaker=CircuitBreaker(failure_threshold=2, cooldown=60))
+    mock_get = mocker.patch.object(client.session, "get")
+
+    mock_get.return_value.status_code = 503
+    client.get("http://localhost:28462/", timeout=1)
+
+    mock_get.side_effect = requests.ConnectionError("refused")
+    with pytest.raises(requests.ConnectionError):
+        client.get("http://localhost:28462/", timeout=1)
+
+    # Circuit is now open so no further request is made
+    with pytest.raises(CircuitOpenError):
+        client.get("http://localhost:28462/", timeout=1)
+    assert mock_get.call_count == 2
+
+def test_client_uses_connect_and_read_timeouts(mocker):
+    """Test requests are made with both a connect and a read timeout"""
+    client = FetchClient(connect_timeout=2)
+    mock_get = mocker.patch.object(client.session, "get")
+    mock_get.return_value.status_code = 200
+
+    client.get("http://localhost:28462/", timeout=5)
+
+    mock_get.assert_called_once_with("http://localhost:28462/", timeout=(2, 5))
+
+def test_clients_are_shared_per_server():
+    """Test urls on the same data-server share one client"""
+    assert get_client("http://localhost:28462/") is get_client("http://localhost:28462/?x=1")
+    assert get_client("http://localhost:28462/") is not get_client("http://localhost:28463/")
@@ -0,0 +1,121 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta
+
+from hot_window import HotWindow, to_micros, from_micros
+from storage import VALID, DISCARDED
+
+NOW = datetime.now().replace(microsecond=0)
+
+def valid_row(id, minutes_ago, value=12.37, tags=("night",)):
+    return (id, NOW - timedelta(minutes=minutes_ago), value, list(tags))
+
+def discarded_row(id, minutes_ago, reason="system"):
+    return (id, NOW - timedelta(minutes=minutes_ago), 99.0, [reason], reason, NOW)
+
+@pytest.fixture
+def window(mocker):
+    mocker.patch("hot_window.iter_valid_snapshots", return_value=iter([valid_row(1, 30), valid_row(2, 20)]))
+    mocker.patch("hot_window.iter_discarded_snapshots", return_value=iter([discarded_row(1, 25)]))
+    window = HotWindow(hours=1, max_rows=100)
+    window.start()
+    return window
+
+def test_micros_round_trip():
+    """Test times survive conversion to integer microseconds"""
+    time = datetime(2026, 1, 18, 14, 35, 1, 123456)
+    assert from_micros(to_micros(time)) == time
+
+def test_recent_page_is_read_without_database(window, mocker):
+    """Test a page inside the window doesn't touch the database"""
+    read_db = mocker.Mock()
+
+    rows = window.read(VALID, NOW - timedelta(minutes=40), NOW, None, None, (None, None, None), read_db)
+
+    assert rows == [valid_row(1, 30), valid_row(2, 20)]
+    read_db.assert_not_called()
+
+def test_saved_rows_are_added_in_time_order(window, mocker):
+    """Test rows from write listeners are merged by (time, id) and held once"""
+    window.add([valid_row(4, 10), valid_row(3, 25), valid_row(2, 20)], [])
+
+    rows = window.read(VALID, NOW - timedelta(minutes=40), NOW, None, None, (None, None, None), mocker.Mock())
+
+    assert [row[0] for row in rows] == [1, 3, 2, 4]
+
+def test_straddling_page_is_merged_with_database(window, mocker):
+    """Test older rows come from the database and recent ones from the window"""
+    older = valid_row(0, 120)
+    read_db = mocker.Mock(return_value=[older])
+
+    rows = window.read(VALID, NOW - timedelta(hours=3), NOW, 2, None, (None, None, None), read_db)
+
+    assert rows == [older, valid_row(1, 30)]
+    start, end, limit, after = read_db.call_args.args
+    assert end < window.since(VALID) and limit == 2
+
+def test_full_page_from_database_skips_window(window, mocker):
+    """Test a page filled by older rows isn't extended from the window"""
+    older = [valid_row(0, 120), valid_row(-1, 110)]
+    read_db = mocker.Mock(return_value=older)
+
+    assert window.read(VALID, NOW - timedelta(hours=3), NOW, 2, None, (None, None, None), read_db) == older
+
+def test_cursor_and_filters_apply_in_window(window, mocker):
+    """Test the (time, id) cursor and tag and reason filters work on held rows"""
+    window.add([valid_row(3, 10, tags=("day",))], [discarded_row(2, 5, "suspect")])
+    first = valid_row(1, 30)
+    read_db = mocker.Mock()
+
+    after = window.read(VALID, NOW - timedelta(minutes=40), NOW, None, (first[1], first[0]),
+                        (None, None, None), read_db)
+    day = window.read(VALID, NOW - timedelta(minutes=40), NOW, None, None, (None, None, ("day", "dusk")), read_db)
+    suspect = window.read(DISCARDED, NOW - timedelta(minutes=40), NOW, None, None, ("suspect", None, None), read_db)
+
+    assert [row[0] for row in after] == [2, 3]
+    assert [row[0] for row in day] == [3]
+    assert suspect == [discarded_row(2, 5, "suspect")]
+    read_db.assert_not_called()
+
+def test_old_pages_go_to_database(window, mocker):
+    """Test a page ending before the window is read from the database"""
+    read_db = mocker.Mock(return_value=[])
+    start, end = NOW - timedelta(hours=5), NOW - timedelta(hours=4)
+
+    window.read(VALID, start, end, 10, None, (None, None, None), read_db)
+
+    read_db.assert_called_once_with(start, end, 10, None)
+
+def test_max_rows_drops_oldest_and_moves_edge(window, mocker):
+    """Test the window keeps at most max_rows and older pages go to the database"""
+    window.max_rows = 2
+    window.add([valid_row(3, 10)], [])
+
+    assert window.since(VALID) == NOW - timedelta(minutes=20)
+    read_db = mocker.Mock(return_value=[valid_row(1, 30)])
+    rows = window.read(VALID, NOW - timedelta(minutes=40), NOW, None, None, (None, None, None), read_db)
+
+    assert [row[0] for row in rows] == [1, 2, 3]
+
+def test_stopped_window_passes_reads_through(mocker):
+    """Test reads go straight to the database until the window is loaded"""
+    window = HotWindow(hours=1)
+    read_db = mocker.Mock(return_value=[])
+    window.add([valid_row(1, 5)], [])
+
+    window.read(VALID, datetime.min, datetime.max, None, None, (None, None, None), read_db)
+
+    read_db.assert_called_once_with(datetime.min, datetime.max, None, None)
+    assert window.rows() == 0
+
+def test_failed_load_leaves_window_off(mocker):
+    """Test a database error while loading leaves reads to the database"""
+    mocker.patch("hot_window.iter_valid_snapshots", side_effect=Exception("down"))
+    window = HotWindow(hours=1)
+
+    window.start()
+
+    assert window.since(VALID) is None
@@ -0,0 +1,106 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import logging
+import logging.handlers
+import queue
+
+import logs
+from logs import setup_logging, stop_logging, LogQueueHandler
+
+@pytest.fixture
+def root_logger():
+    """Restore the root logger's handlers and level after the test"""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    stop_logging()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+def test_records_are_written_by_background_thread(root_logger, tmp_path):
+    """Test records reach the log file once the pipeline is stopped"""
+    path = tmp_path / "snapshots.log"
+    setup_logging("INFO", "text", str(path), console=False)
+
+    logging.info("Valid %s snapshot measuring %s°C", "night", 12.37)
+    logging.debug("Not written %s", "at INFO")
+    stop_logging()
+
+    text = path.read_text(encoding="utf-8")
+    assert "| INFO | Valid night snapshot measuring 12.37°C" in text
+    assert "Not written" not in text
+
+def test_json_format_includes_extra_fields(root_logger, tmp_path):
+    """Test the JSON format writes one object per line with extra= fields"""
+    path = tmp_path / "snapshots.log"
+    setup_logging("INFO", "json", str(path), console=False)
+
+    logging.warning("Invalid %s tag", "system", extra={"reason": "system"})
+    stop_logging()
+
+    record = json.loads(path.read_text(encoding="utf-8").splitlines()[0])
+    assert record["level"] == "WARNING"
+    assert record["message"] == "Invalid system tag"
+    assert record["reason"] == "system"
+
+def test_formatting_is_deferred_for_immutable_args():
+    """Test messages with only immutable args are formatted by the writer thread"""
+    handler = LogQueueHandler(queue.Queue())
+
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "Valid %s at %s", ("night", 12.37), None)
+    assert handler.prepare(record).args == ("night", 12.37)
+
+    # A list could change before the writer formats it
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "Tags %s", (["night"],), None)
+    prepared = handler.prepare(record)
+    assert prepared.args is None
+    assert prepared.msg == "Tags ['night']"
+
+def test_full_queue_drops_record():
+    """Test logging never blocks on a full queue"""
+    handler = LogQueueHandler(queue.Queue(1))
+    before = logs.log_records_dropped._default.value
+
+    for _ in range(3):
+        handler.handle(logging.LogRecord("root", logging.INFO, __file__, 1, "message", (), None))
+
+    assert handler.queue.qsize() == 1
+    assert logs.log_records_dropped._default.value == before + 2
+
+def test_file_handler_rotation(mocker, tmp_path):
+    """Test the log is rotated by size or time, or reopened when rotated elsewhere"""
+    path = str(tmp_path / "snapshots.log")
+
+    mocker.patch("logs.LOG_ROTATE", "size")
+    assert isinstance(logs.build_file_handler(path), logging.handlers.RotatingFileHandler)
+    mocker.patch("logs.LOG_ROTATE", "time")
+    assert isinstance(logs.build_file_handler(path), logging.handlers.TimedRotatingFileHandler)
+    assert isinstance(logs.build_file_handler(path, rotate=False), logging.handlers.WatchedFileHandler)
+
+def test_forked_child_leaves_rotation_to_parent(mocker, tmp_path):
+    """Test a forked worker reopens the log file instead of rotating it too"""
+    path = str(tmp_path / "snapshots.log")
+    mocker.patch("logs.LOG_ROTATE", "size")
+    rotating = logs.build_file_handler(path)
+    console = logging.StreamHandler()
+
+    watched = logs.child_handler(rotating)
+
+    assert isinstance(watched, logging.handlers.WatchedFileHandler)
+    assert watched.baseFilename == rotating.baseFilename
+    assert logs.child_handler(console) is console
+    assert logs.child_handler(watched) is watched
+
+def test_only_ingest_rotates_log():
+    """Test API and migrate processes never rotate the shared log file"""
+    from main import parse_args, rotates_log
+
+    assert rotates_log(parse_args(["--mode", "all"]))
+    assert rotates_log(parse_args(["--mode", "ingest"]))
+    assert not rotates_log(parse_args(["--mode", "ingest", "--ingest-worker", "--no-log-rotation"]))
+    assert not rotates_log(parse_args(["--mode", "api"]))
+    assert not rotates_log(parse_args(["--mode", "migrate"]))
@@ -0,0 +1,85 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import Counter, Histogram, registry, start_metrics_server
+
+@pytest.fixture
+def metrics():
+    """Remove metrics created by a test from the registry afterwards"""
+    created = []
+    yield created
+    for metric in created:
+        registry.remove(metric)
+
+def test_counter_with_labels(metrics):
+    """Test labelled counters render one line per label value"""
+    counter = Counter('test_discarded_total', 'Test counter', ['reason'])
+    metrics.append(counter)
+
+    counter.labels('age').inc()
+    counter.labels('age').inc()
+    counter.labels('system').inc(3)
+
+    lines = counter.render()
+    assert '# TYPE test_discarded_total counter' in lines
+    assert 'test_discarded_total{reason="age"} 2' in lines
+    assert 'test_discarded_total{reason="system"} 3' in lines
+
+    # Children are cached so hot paths can reuse them
+    assert counter.labels('age') is counter.labels('age')
+
+def test_histogram_buckets_are_cumulative(metrics):
+    """Test histogram buckets count every value at or below their bound"""
+    histogram = Histogram('test_latency_seconds', 'Test histogram', buckets=(0.1, 1.0))
+    metrics.append(histogram)
+
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    lines = histogram.render()
+    assert 'test_latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count 4' in lines
+    assert 'test_latency_seconds_sum 2.65' in lines
+
+def test_metrics_server_serves_registry(metrics):
+    """Test a process without the API can still be scraped on /metrics"""
+    import requests
+
+    counter = Counter('test_fetched_total', 'Test counter')
+    metrics.append(counter)
+    counter.inc(5)
+
+    server = start_metrics_server('127.0.0.1', 0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        response = requests.get(f'{url}/metrics', timeout=5)
+        missing = requests.get(f'{url}/other', timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status_code == 200
+    assert 'test_fetched_total 5' in response.text.splitlines()
+    assert missing.status_code == 404
+
+def test_api_workers_get_lowest_free_metrics_slot():
+    """Test a replacement gunicorn worker reuses the metrics port of the one it replaces"""
+    from types import SimpleNamespace
+    from server import pre_fork
+
+    server = SimpleNamespace(WORKERS={})
+    for pid in (1, 2, 3):
+        worker = SimpleNamespace()
+        pre_fork(server, worker)
+        server.WORKERS[pid] = worker
+
+    assert [worker.metrics_slot for worker in server.WORKERS.values()] == [0, 1, 2]
+
+    del server.WORKERS[2]
+    replacement = SimpleNamespace()
+    pre_fork(server, replacement)
+    assert replacement.metrics_slot == 1
@@ -0,0 +1,90 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime
+
+from partitions import (partition_start, next_partition_start, partition_name,
+                        parse_partition_name, create_partitions, drop_expired_partitions,
+                        delete_expired_default_rows, split_default_partition)
+
+def test_partition_ranges():
+    """Test day and month partition boundaries"""
+    time = datetime(2026, 12, 31, 14, 35)
+
+    assert partition_start(time, 'day') == datetime(2026, 12, 31)
+    assert next_partition_start(datetime(2026, 12, 31), 'day') == datetime(2027, 1, 1)
+    assert partition_start(time, 'month') == datetime(2026, 12, 1)
+    assert next_partition_start(datetime(2026, 12, 1), 'month') == datetime(2027, 1, 1)
+
+def test_partition_names_round_trip():
+    """Test partition names can be parsed back into their range start"""
+    day = partition_name('valid_snapshots', datetime(2026, 1, 18), 'day')
+    month = partition_name('valid_snapshots', datetime(2026, 1, 1), 'month')
+
+    assert day == 'valid_snapshots_p20260118'
+    assert parse_partition_name('valid_snapshots', day) == (datetime(2026, 1, 18), 'day')
+    assert parse_partition_name('valid_snapshots', month) == (datetime(2026, 1, 1), 'month')
+    assert parse_partition_name('valid_snapshots', 'valid_snapshots_default') is None
+
+def test_create_partitions_makes_future_ranges(mocker):
+    """Test the current and upcoming partitions are created"""
+    cursor = mocker.MagicMock()
+
+    create_partitions(cursor, 'valid_snapshots', now=datetime(2026, 1, 18, 9), premake=2)
+
+    ranges = [call.args[1] for call in cursor.execute.call_args_list if len(call.args) > 1]
+    assert ranges == [
+        (datetime(2026, 1, 18), datetime(2026, 1, 19)),
+        (datetime(2026, 1, 19), datetime(2026, 1, 20)),
+        (datetime(2026, 1, 20), datetime(2026, 1, 21)),
+    ]
+
+def test_drop_expired_partitions(mocker):
+    """Test only partitions that ended before the cutoff are dropped"""
+    cursor = mocker.MagicMock()
+    cursor.fetchall.return_value = [
+        ('valid_snapshots_p20260101',),
+        ('valid_snapshots_p20260110',),
+        ('valid_snapshots_p20260118',),
+        ('valid_snapshots_default',),
+    ]
+
+    dropped = drop_expired_partitions(cursor, 'valid_snapshots',
+                                      now=datetime(2026, 1, 18, 12), retention_days=7)
+
+    assert dropped == ['valid_snapshots_p20260101', 'valid_snapshots_p20260110']
+
+def test_retention_disabled_keeps_everything(mocker):
+    """Test a retention of 0 days never drops partitions"""
+    cursor = mocker.MagicMock()
+
+    assert drop_expired_partitions(cursor, 'valid_snapshots', retention_days=0) == []
+    cursor.execute.assert_not_called()
+
+def test_expired_rows_are_deleted_from_default_partition(mocker):
+    """Test retention removes old rows from the default partition, which is never dropped"""
+    cursor = mocker.MagicMock()
+    cursor.rowcount = 3
+
+    deleted = delete_expired_default_rows(cursor, 'valid_snapshots',
+                                          now=datetime(2026, 1, 18, 12), retention_days=7)
+
+    assert deleted == 3
+    query, params = cursor.execute.call_args.args
+    assert 'DELETE FROM' in repr(query) and 'valid_snapshots_default' in repr(query)
+    assert params == (datetime(2026, 1, 11, 12),)
+    cursor.reset_mock()
+    assert delete_expired_default_rows(cursor, 'valid_snapshots', retention_days=0) == 0
+    cursor.execute.assert_not_called()
+
+def test_default_partition_rows_get_their_own_partitions(mocker):
+    """Test rows in the default partition are moved into a partition for their period"""
+    cursor = mocker.MagicMock()
+    cursor.fetchall.return_value = [(datetime(2025, 6, 3),)]
+
+    created = split_default_partition(cursor, 'valid_snapshots', 'day')
+
+    assert created == ['valid_snapshots_p20250603']
+    ranges = [call.args[1] for call in cursor.execute.call_args_list if len(call.args) > 1][1:]
+    assert ranges == [(datetime(2025, 6, 3), datetime(2025, 6, 4))] * 2
@@ -0,0 +1,102 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import threading
+import time
+
+from poller import Poller, Source, parse_sources
+
+def test_parse_sources():
+    """Test sources are read with optional interval and timeout"""
+    sources = parse_sources("http://a:28462/, http://b:28462/|0.5|2")
+
+    assert len(sources) == 2
+    assert sources[0].url == "http://a:28462/"
+    assert sources[1].url == "http://b:28462/"
+    assert sources[1].interval == 0.5
+    assert sources[1].timeout == 2
+
+def test_parse_sources_rejects_empty():
+    """Test an empty source list raises"""
+    with pytest.raises(ValueError, match="No satellite sources configured"):
+        parse_sources(" , ")
+
+def test_next_run_skips_missed_slots(mocker):
+    """Test the schedule stays on its grid after falling behind"""
+    mocker.patch("poller.time.monotonic", return_value=13.5)
+
+    # Due at 10 with a 1s interval, polls at 11, 12 and 13 were missed
+    assert Poller._next_run(10.0, 1.0) == 14.0
+
+def test_sources_are_polled_concurrently(mocker):
+    """Test a slow source doesn't hold up polls of another source"""
+    calls = {"slow": 0, "fast": 0}
+
+    def fake_get_snapshots(url, timeout):
+        calls[url] += 1
+        if url == "slow":
+            time.sleep(0.3)
+
+    mocker.patch("poller.get_snapshots", side_effect=fake_get_snapshots)
+
+    poller = Poller([Source("slow", 0.05, 1), Source("fast", 0.05, 1)])
+    thread = threading.Thread(target=poller.run)
+    thread.start()
+    time.sleep(0.25)
+    poller.stop()
+    thread.join()
+
+    # Fast source keeps its rate, slow source is not polled again while busy
+    assert calls["fast"] >= 3
+    assert calls["slow"] == 1
+
+def test_interval_backs_off_until_new_snapshot():
+    """Test quiet sources are polled less often and speed up on new data"""
+    from poller import AdaptiveInterval
+    from satellite import PollResult, NEW, UNCHANGED, NO_DATA, SKIPPED
+
+    interval = AdaptiveInterval(1.0, maximum=3.0, backoff=2.0)
+
+    assert interval.update(PollResult(NO_DATA)) == 2.0
+    assert interval.update(PollResult(UNCHANGED)) == 3.0
+    assert interval.update(PollResult(UNCHANGED)) == 3.0
+    assert interval.update(PollResult(SKIPPED)) == 3.0
+    assert interval.update(PollResult(NEW)) == 1.0
+
+def test_interval_honours_retry_after():
+    """Test Retry-After delays the next poll, even past the maximum interval"""
+    from poller import AdaptiveInterval
+    from satellite import PollResult, NO_DATA
+
+    interval = AdaptiveInterval(1.0, maximum=10.0, backoff=1.5)
+
+    assert interval.update(PollResult(NO_DATA, retry_after=4)) == 4
+    assert interval.update(PollResult(NO_DATA, retry_after=60)) == 60
+    # Retry-After doesn't change the backoff, which stays under the maximum
+    assert interval.current == 2.25
+
+def test_quiet_source_is_polled_less(mocker):
+    """Test a source answering 404 is polled less often than a busy one"""
+    from satellite import PollResult, NEW, NO_DATA
+
+    calls = {"quiet": 0, "busy": 0}
+
+    def fake_get_snapshots(url, timeout):
+        calls[url] += 1
+        return PollResult(NO_DATA if url == "quiet" else NEW)
+
+    mocker.patch("poller.get_snapshots", side_effect=fake_get_snapshots)
+
+    poller = Poller([Source("quiet", 0.02, 1), Source("busy", 0.02, 1)])
+    for interval in poller.intervals:
+        interval.backoff = 2.0
+    thread = threading.Thread(target=poller.run)
+    thread.start()
+    time.sleep(0.4)
+    poller.stop()
+    thread.join()
+
+    assert calls["busy"] >= 10
+    assert calls["quiet"] <= 6
@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime
+
+from rollups import bucket_start, rollup_rows, ALL_TAGS
+
+def test_bucket_start():
+    """Test times are truncated to the start of their bucket"""
+    time = datetime(2026, 1, 18, 14, 35, 12, 500)
+
+    assert bucket_start(time, '1m') == datetime(2026, 1, 18, 14, 35)
+    assert bucket_start(time, '1h') == datetime(2026, 1, 18, 14)
+    assert bucket_start(time, '1d') == datetime(2026, 1, 18)
+
+def test_rollup_rows_aggregate_per_bucket_and_tag():
+    """Test a batch is reduced to one row per bucket and tag"""
+    rows = [
+        (datetime(2026, 1, 18, 14, 35, 1), 10.0, ["night"]),
+        (datetime(2026, 1, 18, 14, 35, 2), 14.0, ["night", "sun-glint"]),
+        (datetime(2026, 1, 18, 14, 36, 0), 12.0, ["day"]),
+    ]
+
+    rollups = {row[:3]: row[3:] for row in rollup_rows(rows)}
+
+    # (count, sum, min, max)
+    assert rollups[('1m', datetime(2026, 1, 18, 14, 35), 'night')] == (2, 24.0, 10.0, 14.0)
+    assert rollups[('1m', datetime(2026, 1, 18, 14, 35), 'sun-glint')] == (1, 14.0, 14.0, 14.0)
+    assert rollups[('1h', datetime(2026, 1, 18, 14), ALL_TAGS)] == (3, 36.0, 10.0, 14.0)
+    assert rollups[('1d', datetime(2026, 1, 18), 'day')] == (1, 12.0, 12.0, 12.0)
+
+def test_subtract_rollups_removes_empty_buckets(mocker):
+    """Test removed rows are taken out of the rollups in key order"""
+    from rollups import subtract_rollups
+
+    mock_execute_values = mocker.patch("rollups.execute_values")
+    cursor = mocker.MagicMock()
+
+    subtract_rollups(cursor, [(datetime(2026, 1, 18, 14, 35, 1), 10.0, ["night"])])
+
+    rows = mock_execute_values.call_args.args[2]
+    assert rows == sorted(rows)
+    assert ('1m', datetime(2026, 1, 18, 14, 35), 'night', 1, 10.0, 10.0, 10.0) in rows
+    cursor.execute.assert_called_once_with("DELETE FROM snapshot_rollups WHERE count <= 0")
@@ -15,7 +15,7 @@ def test_valid_snapshots_are_logged(mocker, caplog):
     caplog.set_level(logging.DEBUG)
 
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 200
@@ -27,7 +27,7 @@ def test_valid_snapshots_are_logged(mocker, caplog):
     }
 
     # Mock database so it doesnt actually store snapshot
-    mocker.patch("satellite.add_valid_snapshot")
+    mocker.patch("satellite.save_snapshot")
 
     get_snapshots()
     print("CAPLOG!:",caplog.text)
@@ -37,7 +37,7 @@ def test_valid_snapshots_are_logged(mocker, caplog):
 def test_old_snapshots_are_logged(mocker, caplog):
     """Test old snapshots are logged as discarded"""
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 200
@@ -48,7 +48,7 @@ def test_old_snapshots_are_logged(mocker, caplog):
     }
 
     # Mock database so it doesnt actually store snapshot
-    mocker.patch("satellite.add_discarded_snapshot")
+    mocker.patch("satellite.save_snapshot")
 
     get_snapshots()
 
@@ -58,7 +58,7 @@ def test_old_snapshots_are_logged(mocker, caplog):
 def test_suspect_snapshots_are_logged(mocker, caplog):
     """Test snapshots with suspect tag are logged as discarded"""
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 200
@@ -70,7 +70,7 @@ def test_suspect_snapshots_are_logged(mocker, caplog):
     }
 
     # Mock database so it doesnt actually store snapshot
-    mocker.patch("satellite.add_discarded_snapshot")
+    mocker.patch("satellite.save_snapshot")
 
     get_snapshots()
     
@@ -80,7 +80,7 @@ def test_suspect_snapshots_are_logged(mocker, caplog):
 def test_system_snapshots_are_logged(mocker, caplog):
     """Test snapshots with system tag are logged as discarded"""
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 200
@@ -92,7 +92,7 @@ def test_system_snapshots_are_logged(mocker, caplog):
     }
 
     # Mock database so it doesnt actually store snapshot
-    mocker.patch("satellite.add_discarded_snapshot")
+    mocker.patch("satellite.save_snapshot")
 
     get_snapshots()
     
@@ -105,7 +105,7 @@ def test_404_response_from_request(mocker, caplog):
     caplog.set_level(logging.DEBUG)
 
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 404
@@ -121,7 +121,7 @@ def test_non_200_response_from_request(mocker, caplog):
     caplog.set_level(logging.DEBUG)
 
     # Mock get request
-    mock_get = mocker.patch("satellite.requests.get")
+    mock_get = mocker.patch("satellite.fetch")
 
     # Set return values
     mock_get.return_value.status_code = 500
@@ -129,4 +129,55 @@ def test_non_200_response_from_request(mocker, caplog):
     get_snapshots()
 
     # Check expected log appears
-    assert "Unexpected status code: 500" in caplog.text
\ No newline at end of file
+    assert "Unexpected status code: 500" in caplog.text
+
+def test_poll_outcomes(mocker):
+    """Test polls report new, unchanged and missing data to the poller"""
+    from satellite import NEW, UNCHANGED, NO_DATA
+
+    mock_get = mocker.patch("satellite.fetch")
+    mocker.patch("satellite.save_snapshot")
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.headers = {}
+    mock_get.return_value.json.return_value = {"time": time.time(), "value": 12.37, "tags": ["night"]}
+
+    assert get_snapshots("http://outcomes/").outcome == NEW
+    assert get_snapshots("http://outcomes/").outcome == UNCHANGED
+
+    mock_get.return_value.status_code = 404
+    mock_get.return_value.headers = {"Retry-After": "5"}
+    result = get_snapshots("http://outcomes/")
+    assert result.outcome == NO_DATA
+    assert result.retry_after == 5
+
+def test_unchanged_snapshot_is_not_saved_again(mocker):
+    """Test a repeated snapshot is neither logged nor saved again"""
+    mock_get = mocker.patch("satellite.fetch")
+    mock_save = mocker.patch("satellite.save_snapshot")
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"time": time.time(), "value": 12.37, "tags": ["night"]}
+
+    get_snapshots("http://unchanged/")
+    get_snapshots("http://unchanged/")
+
+    assert mock_save.call_count == 1
+
+def test_parse_retry_after():
+    """Test Retry-After is read as seconds or an HTTP date"""
+    from satellite import parse_retry_after
+
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+def test_snapshot_is_saved_with_its_source(mocker):
+    """Test the polled URL is stored as the snapshot's source"""
+    mock_get = mocker.patch("satellite.fetch")
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"time": time.time(), "value": 12.37, "tags": ["night"]}
+    mock_save = mocker.patch("satellite.save_snapshot")
+
+    get_snapshots("http://localhost:28463/")
+
+    assert mock_save.call_args.args[0].as_row()[-1] == "http://localhost:28463/"
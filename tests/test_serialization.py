@@ -0,0 +1,65 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+from datetime import datetime
+
+import serialization
+from serialization import encode_rows, encode_array, JSONProvider
+from storage import VALID, DISCARDED
+
+VALID_ROWS = [
+    (1, datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"]),
+    (2, datetime(2026, 1, 18, 14, 35, 2, 250000), -0.5, ["night"]),
+    (3, datetime(2026, 1, 18, 14, 35, 3), 1e-05, ["sun-glint", "ñight \"quoted\""]),
+]
+
+DISCARDED_ROWS = [
+    (7, datetime(2026, 1, 18, 14, 35, 1), 12.37, ["system"], "system", datetime(2026, 1, 18, 14, 35, 1, 5)),
+    (8, datetime(2026, 1, 18, 14, 35, 2), 1.0, [], "age", datetime(2026, 1, 18, 14, 35, 2)),
+]
+
+def expected_valid(rows):
+    return [{"id": row[0], "time": row[1].isoformat(), "value": row[2], "tags": row[3]} for row in rows]
+
+def expected_discarded(rows):
+    return [{"id": row[0], "time": row[1].isoformat(), "value": row[2], "tags": row[3],
+             "reason": row[4], "discarded_at": row[5].isoformat()} for row in rows]
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def encoder(request, monkeypatch):
+    """Run each test with orjson, when installed, and with the stdlib fallback"""
+    if request.param == "orjson":
+        if serialization.orjson is None:
+            pytest.skip("orjson not installed")
+    else:
+        monkeypatch.setattr(serialization, "orjson", None)
+    return request.param
+
+def test_encode_rows_matches_dict_encoding(encoder):
+    """Test rows encoded from tuples decode to the same objects as before"""
+    assert json.loads(encode_array(VALID, VALID_ROWS)) == expected_valid(VALID_ROWS)
+    assert json.loads(encode_array(DISCARDED, DISCARDED_ROWS)) == expected_discarded(DISCARDED_ROWS)
+
+def test_encode_rows_one_object_per_row(encoder):
+    """Test each row is a separate JSON object with sorted keys"""
+    encoded = encode_rows(VALID, VALID_ROWS[:1])
+
+    assert encoded == ['{"id":1,"tags":["night"],"time":"2026-01-18T14:35:01","value":12.37}']
+    assert encode_rows(VALID, []) == []
+    assert encode_array(DISCARDED, []) == b'[]'
+
+def test_provider_writes_iso_dates_and_sorted_keys(encoder):
+    """Test jsonify output doesn't depend on which encoder is installed"""
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+
+    with app.app_context():
+        response = app.json.response({"b": datetime(2026, 1, 18, 14, 35, 1), "a": 1})
+
+    assert response.get_data() == b'{"a":1,"b":"2026-01-18T14:35:01"}\n'
+    assert app.json.loads('{"a": [1, 2]}') == {"a": [1, 2]}
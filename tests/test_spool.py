@@ -0,0 +1,90 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from spool import Spool
+
+def open_spool(path, segment_bytes=1024):
+    return Spool(str(path), segment_bytes=segment_bytes, fsync_interval=0)
+
+def test_records_are_read_back_in_order(tmp_path):
+    """Test appended records are read in order across segments"""
+    spool = open_spool(tmp_path, segment_bytes=20)
+    for i in range(10):
+        spool.append(f'record-{i}'.encode())
+
+    records, position = spool.read(100)
+
+    assert records == [f'record-{i}'.encode() for i in range(10)]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.log')]) > 1
+    spool.close()
+
+def test_commit_deletes_finished_segments(tmp_path):
+    """Test committed segments are removed and reads carry on after them"""
+    spool = open_spool(tmp_path, segment_bytes=20)
+    for i in range(6):
+        spool.append(f'record-{i}'.encode())
+
+    records, position = spool.read(4)
+    spool.commit(position)
+
+    assert spool.read(100)[0] == [f'record-{i}'.encode() for i in range(4, 6)]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.log')]) <= 2
+    spool.close()
+
+def test_restart_resumes_after_committed_records(tmp_path):
+    """Test uncommitted records are read again after a restart"""
+    spool = open_spool(tmp_path)
+    for i in range(5):
+        spool.append(f'record-{i}'.encode())
+    records, position = spool.read(2)
+    spool.commit(position)
+    spool.close()
+
+    spool = open_spool(tmp_path)
+    spool.append(b'record-5')
+
+    assert spool.read(100)[0] == [f'record-{i}'.encode() for i in range(2, 6)]
+    assert spool.pending_bytes() == sum(len(f'record-{i}\n') for i in range(2, 6))
+    spool.close()
+
+def test_torn_record_is_skipped(tmp_path):
+    """Test a record cut short by a crash doesn't block the records after it"""
+    spool = open_spool(tmp_path)
+    spool.append(b'record-0')
+    spool.close()
+
+    segment = next(name for name in os.listdir(tmp_path) if name.endswith('.log'))
+    with open(tmp_path / segment, 'ab') as file:
+        file.write(b'record-tor')
+
+    spool = open_spool(tmp_path)
+    spool.append(b'record-1')
+
+    assert spool.read(100)[0] == [b'record-0', b'record-1']
+    spool.close()
+
+def test_spool_is_locked(tmp_path):
+    """Test two processes can't use the same spool"""
+    pytest.importorskip('fcntl')
+    spool = open_spool(tmp_path)
+
+    with pytest.raises(Exception, match="in use"):
+        open_spool(tmp_path)
+    spool.close()
+
+def test_last_append_is_synced_without_another(mocker, tmp_path):
+    """Test a burst's tail is fsynced on time even if nothing else is appended"""
+    spool = Spool(str(tmp_path), segment_bytes=1024, fsync_interval=0.05)
+    mock_fsync = mocker.patch("spool.os.fsync")
+    spool.append(b'record-0')
+
+    for _ in range(50):
+        if mock_fsync.called:
+            break
+        spool._closed.wait(0.02)
+
+    assert mock_fsync.called
+    assert not spool._dirty
+    spool.close()
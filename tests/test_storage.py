@@ -0,0 +1,339 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime
+
+from storage import SnapshotBuffer, VALID, DISCARDED, iter_valid_snapshots
+from backends.postgres import build_filters
+
+def test_buffer_writes_rows_in_batches(mocker):
+    """Test queued snapshots are written together in batches"""
+    mock_write = mocker.patch("storage.write_snapshots")
+
+    buffer = SnapshotBuffer(batch_size=3, flush_interval=10)
+    snapshot_time = datetime.now()
+
+    for i in range(5):
+        buffer.put(VALID, (snapshot_time, float(i), ["night"]))
+    buffer.put(DISCARDED, (snapshot_time, 1.0, ["system"], "system", snapshot_time))
+
+    # Closing flushes everything that is still queued
+    buffer.close()
+
+    written_valid = [row for call in mock_write.call_args_list for row in call.args[0]]
+    written_discarded = [row for call in mock_write.call_args_list for row in call.args[1]]
+
+    assert len(written_valid) == 5
+    assert len(written_discarded) == 1
+    assert written_discarded[0][3] == "system"
+    # 6 rows with a batch size of 3 means 2 writes
+    assert mock_write.call_count == 2
+
+def test_buffer_flushes_after_interval(mocker):
+    """Test a partial batch is written once the flush interval passes"""
+    mock_write = mocker.patch("storage.write_snapshots")
+
+    buffer = SnapshotBuffer(batch_size=100, flush_interval=0.05)
+    buffer.put(VALID, (datetime.now(), 12.37, ["day"]))
+
+    # Wait for the writer thread to flush without closing the buffer
+    for _ in range(50):
+        if mock_write.called:
+            break
+        buffer._stop.wait(0.02)
+
+    assert mock_write.call_count == 1
+    buffer.close()
+
+def test_failed_batch_is_retried(mocker):
+    """Test a batch the database rejects is written once it is back"""
+    mock_write = mocker.patch("storage.write_snapshots",
+                              side_effect=[Exception("database down"), Exception("database down"), None])
+
+    buffer = SnapshotBuffer(batch_size=10, flush_interval=0.01, retry_max=0.01)
+    buffer.put(VALID, (datetime.now(), 12.37, ["day"]))
+    buffer.close()
+
+    assert mock_write.call_count == 3
+    assert [len(call.args[0]) for call in mock_write.call_args_list] == [1, 1, 1]
+
+def test_batch_is_lost_after_close_timeout(mocker):
+    """Test shutdown gives up on an unreachable database and counts what was lost"""
+    from metrics import snapshots_lost
+    mocker.patch("storage.write_snapshots", side_effect=Exception("database down"))
+    before = snapshots_lost.labels('shutdown').value
+
+    buffer = SnapshotBuffer(batch_size=10, flush_interval=10, retry_max=0.01, close_timeout=0.05)
+    buffer.put(VALID, (datetime.now(), 12.37, ["day"]))
+    buffer.put(VALID, (datetime.now(), 12.5, ["day"]))
+    buffer.close()
+
+    assert snapshots_lost.labels('shutdown').value == before + 2
+
+def test_full_buffer_raises(mocker):
+    """Test backpressure raises once the queue stays full"""
+    mocker.patch("storage.SnapshotBuffer._ensure_started")
+
+    buffer = SnapshotBuffer(max_queue=1, enqueue_timeout=0.01)
+    buffer.put(VALID, (datetime.now(), 12.37, ["day"]))
+
+    with pytest.raises(Exception, match="Snapshot write buffer full"):
+        buffer.put(VALID, (datetime.now(), 12.37, ["day"]))
+
+def test_spool_record_round_trip():
+    """Test rows survive encoding as spool records"""
+    from storage import encode_record, decode_record
+
+    valid_row = (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], "http://localhost:28462/")
+    discarded_row = (datetime(2026, 1, 18, 14, 35, 1), 1.0, ["system"], "system",
+                     datetime(2026, 1, 18, 14, 35, 2), "http://localhost:28462/")
+
+    assert decode_record(encode_record(VALID, valid_row)) == (VALID, valid_row)
+    assert decode_record(encode_record(DISCARDED, discarded_row)) == (DISCARDED, discarded_row)
+
+def test_spool_record_without_source_is_read():
+    """Test records spooled before sources were stored are read with an empty source"""
+    from storage import decode_record
+
+    assert decode_record(b'["valid", "2026-01-18T14:35:01", 12.37, ["night"]]') == \
+        (VALID, (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], ""))
+
+def test_spooled_buffer_drains_to_database(mocker, tmp_path):
+    """Test spooled snapshots are written in batches and committed"""
+    from storage import SpooledBuffer
+
+    mock_write = mocker.patch("storage.write_snapshots")
+    buffer = SpooledBuffer(str(tmp_path), batch_size=3, flush_interval=0.01, fsync_interval=0)
+    snapshot_time = datetime(2026, 1, 18, 14, 35, 1)
+
+    for i in range(4):
+        buffer.put(VALID, (snapshot_time, float(i), ["night"]))
+    buffer.put(DISCARDED, (snapshot_time, 1.0, ["system"], "system", snapshot_time))
+    buffer.close()
+
+    written_valid = [row for call in mock_write.call_args_list for row in call.args[0]]
+    written_discarded = [row for call in mock_write.call_args_list for row in call.args[1]]
+    assert [row[1] for row in written_valid] == [0.0, 1.0, 2.0, 3.0]
+    assert written_discarded[0][3] == "system"
+
+    # Everything was committed, nothing is replayed on the next start
+    mock_write.reset_mock()
+    buffer.put(VALID, (snapshot_time, 9.0, ["day"]))
+    buffer.close()
+    assert [row[1] for call in mock_write.call_args_list for row in call.args[0]] == [9.0]
+
+def test_spooled_buffer_keeps_snapshots_while_database_is_down(mocker, tmp_path):
+    """Test a failed batch stays in the spool and is saved once the database is back"""
+    from storage import SpooledBuffer
+
+    mock_write = mocker.patch("storage.write_snapshots", side_effect=Exception("database down"))
+    buffer = SpooledBuffer(str(tmp_path), batch_size=10, flush_interval=0.01, fsync_interval=0)
+    buffer.put(VALID, (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"]))
+    buffer.close()
+
+    assert mock_write.called
+    assert len(os.listdir(tmp_path)) > 0
+
+    # Database is back, the spooled snapshot is saved
+    mock_write.reset_mock(side_effect=True)
+    buffer.put(VALID, (datetime(2026, 1, 18, 14, 35, 2), 12.5, ["night"]))
+    buffer.close()
+
+    written = [row[1] for call in mock_write.call_args_list for row in call.args[0]]
+    assert written == [12.37, 12.5]
+
+def test_drain_spool_saves_what_another_process_left(mocker, tmp_path):
+    """Test a spool left by a stopped process is saved and emptied"""
+    from storage import SpooledBuffer, drain_spool
+
+    mocker.patch("storage.write_snapshots", side_effect=Exception("database down"))
+    buffer = SpooledBuffer(str(tmp_path), batch_size=10, flush_interval=0.01, fsync_interval=0)
+    buffer.put(VALID, (datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], "sat-1"))
+    buffer.close()
+
+    mock_write = mocker.patch("storage.write_snapshots")
+    assert drain_spool(str(tmp_path)) == 1
+    assert mock_write.call_args.args[0] == [(datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], "sat-1")]
+    assert drain_spool(str(tmp_path)) == 0
+
+    # A directory that was never spooled to is left as it is
+    (tmp_path / "empty").mkdir()
+    assert drain_spool(str(tmp_path / "empty")) == 0
+    assert os.listdir(tmp_path / "empty") == []
+
+def test_close_pool_flushes_buffer(mocker):
+    """Test close_pool runs the buffer flush hook"""
+    import database
+    import storage
+
+    mock_close = mocker.patch.object(storage.write_buffer, "close")
+    mocker.patch("database.connection_pool", None)
+
+    database.close_pool()
+
+    mock_close.assert_called_once()
+
+def test_build_filters_pushes_reason_and_page_into_sql():
+    """Test reason, cursor and limit become part of the query"""
+    start, end = datetime.min, datetime.max
+    after = (datetime(2026, 1, 1), 42)
+
+    clause, params = build_filters(start, end, limit=100, after=after, reason="age")
+
+    assert "reason = %s" in clause
+    assert "(time, id) > (%s, %s)" in clause
+    assert clause.endswith("ORDER BY time, id LIMIT %s")
+    assert params == [start, end, "age", datetime(2026, 1, 1), 42, 100]
+
+def test_build_filters_uses_array_operators_for_tags():
+    """Test tag filters map to the containment and overlap operators"""
+    clause, params = build_filters(datetime.min, datetime.max, tags_all=("night",), tags_any=("day", "dusk"))
+
+    assert "tags @> %s::text[]" in clause
+    assert "tags && %s::text[]" in clause
+    assert params[2:] == [["night"], ["day", "dusk"]]
+
+def test_stream_query_uses_server_side_cursor(mocker):
+    """Test streamed queries use a named cursor and release the connection"""
+    mock_connection = mocker.MagicMock()
+    mock_cursor = mock_connection.cursor.return_value
+    mock_cursor.__iter__.return_value = iter([(1, datetime(2026, 1, 1), 12.37, ["night"])])
+    mock_pool = mocker.patch("database.connection_pool")
+    mock_pool.getconn.return_value = mock_connection
+
+    rows = iter_valid_snapshots(datetime.min, datetime.max)
+
+    # Nothing runs until the first row is requested
+    mock_connection.cursor.assert_not_called()
+    assert next(rows)[2] == 12.37
+    assert mock_connection.cursor.call_args.kwargs["name"].startswith("stream_valid_")
+
+    # Closing the generator early still releases the connection
+    rows.close()
+    mock_pool.putconn.assert_called_once_with(mock_connection)
+
+def test_iter_valid_batches_yields_raw_rows(mocker):
+    """Test export batches are raw tuples fetched in STREAM_ITERSIZE lists"""
+    from storage import iter_valid_batches
+
+    rows = [(1, datetime(2026, 1, 1), 12.37, ["night"])]
+    mock_connection = mocker.MagicMock()
+    mock_cursor = mock_connection.cursor.return_value
+    mock_cursor.fetchmany.side_effect = [rows, []]
+    mock_pool = mocker.patch("database.connection_pool")
+    mock_pool.getconn.return_value = mock_connection
+
+    assert list(iter_valid_batches(datetime.min, datetime.max)) == [rows]
+    assert mock_connection.cursor.call_args.kwargs["name"].startswith("batch_valid_")
+    mock_pool.putconn.assert_called_once_with(mock_connection)
+
+def test_save_snapshot_routes_by_verdict(mocker):
+    """Test (snapshot, verdict) pairs are queued for the right table"""
+    from validation import Snapshot, Verdict, ACCEPTED
+    import storage
+
+    mock_put = mocker.patch.object(storage.write_buffer, "put")
+    snapshot = Snapshot(1768747706.0, 12.37, ["night"], "sat-1")
+    discarded_at = datetime.now()
+
+    storage.save_snapshot(snapshot, ACCEPTED)
+    storage.save_snapshot(snapshot, Verdict("system", "Invalid system tag"), discarded_at)
+
+    assert mock_put.call_args_list[0].args == (VALID, (snapshot.time, 12.37, ["night"], "sat-1"))
+    assert mock_put.call_args_list[1].args == (DISCARDED, (snapshot.time, 12.37, ["night"], "system",
+                                                           discarded_at, "sat-1"))
+
+def test_repeated_snapshot_is_only_queued_once(mocker):
+    """Test the recent-key cache drops a reading returned by consecutive polls"""
+    import storage
+
+    mock_put = mocker.patch.object(storage.write_buffer, "put")
+    mocker.patch("storage.recent_keys", storage.RecentKeys(max_entries=2))
+    snapshot_time = datetime(2026, 1, 18, 14, 35, 1)
+
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["night"])
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["night"])
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["day"])
+
+    assert mock_put.call_count == 2
+
+def test_same_reading_from_two_sources_is_queued_twice(mocker):
+    """Test the recent-key cache keeps readings from different satellites apart"""
+    import storage
+
+    mock_put = mocker.patch.object(storage.write_buffer, "put")
+    mocker.patch("storage.recent_keys", storage.RecentKeys(max_entries=10))
+    snapshot_time = datetime(2026, 1, 18, 14, 35, 1)
+
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["night"], "sat-1")
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["night"], "sat-2")
+
+    assert mock_put.call_count == 2
+
+def test_recent_keys_evicts_oldest():
+    """Test the recent-key cache stays bounded"""
+    from storage import RecentKeys
+
+    keys = RecentKeys(max_entries=2)
+    assert not keys.seen("a")
+    assert not keys.seen("b")
+    assert not keys.seen("c")
+
+    assert keys.seen("c")
+    assert not keys.seen("a")
+
+def test_failed_queue_forgets_key(mocker):
+    """Test a snapshot that couldn't be queued can be saved by a later poll"""
+    import storage
+
+    mock_put = mocker.patch.object(storage.write_buffer, "put", side_effect=[Exception("full"), None])
+    mocker.patch("storage.recent_keys", storage.RecentKeys(max_entries=10))
+    snapshot_time = datetime(2026, 1, 18, 14, 35, 1)
+
+    with pytest.raises(Exception):
+        storage.add_valid_snapshot(snapshot_time, 12.37, ["night"])
+    storage.add_valid_snapshot(snapshot_time, 12.37, ["night"])
+
+    assert mock_put.call_count == 2
+
+def test_write_snapshots_counts_conflicts(mocker):
+    """Test rows skipped by ON CONFLICT are counted and left out of rollups"""
+    import storage
+
+    rows = [(datetime(2026, 1, 18, 14, 35, 1), 12.37, ["night"], "sat-1"),
+            (datetime(2026, 1, 18, 14, 35, 2), 12.5, ["night"], "sat-1")]
+    inserted = (2, *rows[1][:3])
+    mock_pool = mocker.patch("database.connection_pool")
+    mocker.patch("backends.postgres.execute_values", return_value=[inserted])
+    mock_rollups = mocker.patch("backends.postgres.update_rollups")
+    mock_listener = mocker.patch("storage.notify_write_listeners")
+    counter = storage.snapshots_deduplicated.labels('database')
+    before = counter.value
+
+    storage.write_snapshots(rows, [])
+
+    assert mock_rollups.call_args.args[1] == [rows[1][:3]]
+    mock_listener.assert_called_once_with([inserted], [])
+    assert counter.value == before + 1
+    mock_pool.putconn.assert_called_once_with(mock_pool.getconn.return_value)
+
+def test_get_snapshots_json_builds_body_in_postgres(mocker):
+    """Test the JSON page query aggregates rows with json_agg"""
+    from storage import get_snapshots_json
+
+    mock_connection = mocker.MagicMock()
+    mock_cursor = mock_connection.cursor.return_value
+    mock_cursor.fetchone.return_value = ('[]', 0, None, None)
+    mock_pool = mocker.patch("database.connection_pool")
+    mock_pool.getconn.return_value = mock_connection
+
+    assert get_snapshots_json(DISCARDED, datetime.min, datetime.max, reason="age") == ('[]', 0, (None, None))
+
+    query, params = mock_cursor.execute.call_args.args
+    assert "json_agg(json_build_object('discarded_at'" in query
+    # Times are formatted like datetime.isoformat, with all six fractional digits
+    assert "to_char(discarded_at, 'YYYY-MM-DD\"T\"HH24:MI:SS.US')" in query
+    assert "FROM discarded_snapshots" in query
+    assert params == [datetime.min, datetime.max, "age"]
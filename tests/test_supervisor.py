@@ -0,0 +1,140 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from poller import Source, parse_sources, format_sources
+import supervisor as supervisor_module
+from supervisor import HashRing, IngestSupervisor, assign_sources
+
+SOURCES = [Source(f"http://sat-{i}:28462/", 1.0, 5.0) for i in range(40)]
+
+def test_every_source_is_assigned_once():
+    """Test sources are shared between workers without gaps or overlaps"""
+    assignments = assign_sources(SOURCES, 4)
+
+    assert sorted(source.url for worker in assignments for source in worker) == sorted(s.url for s in SOURCES)
+    # Roughly even, every worker gets some
+    assert all(worker for worker in assignments)
+
+def test_adding_a_worker_only_moves_its_sources():
+    """Test consistent hashing keeps most sources where they were"""
+    before = assign_sources(SOURCES, 3)
+    after = assign_sources(SOURCES, 4)
+
+    for index in range(3):
+        # Workers only lose sources, to the new worker
+        assert set(s.url for s in after[index]) <= set(s.url for s in before[index])
+    assert len(after[3]) < len(SOURCES) / 2
+
+def test_ring_is_stable():
+    """Test the same key always maps to the same worker"""
+    assert HashRing(range(4)).worker_for("http://sat-1:28462/") == HashRing(range(4)).worker_for("http://sat-1:28462/")
+
+def test_sources_round_trip_through_setting():
+    """Test a worker's sources survive being passed as SATELLITE_SOURCES"""
+    sources = [Source("http://a:1/", 0.5, 2.0), Source("http://b:1/", 1.0, 5.0)]
+
+    assert parse_sources(format_sources(sources)) == sources
+
+@pytest.fixture
+def mock_popen(mocker):
+    """Fake worker processes that keep running until terminated"""
+    processes = []
+
+    def popen(command, env):
+        process = mocker.MagicMock()
+        process.pid = len(processes) + 1000
+        process.poll.return_value = None
+        process.terminate.side_effect = lambda: setattr(process.poll, "return_value", 0)
+        process.env = env
+        processes.append(process)
+        return process
+
+    mocker.patch("supervisor.subprocess.Popen", side_effect=popen)
+    mocker.patch("supervisor.drain_spool", return_value=0)
+    return processes
+
+def test_workers_get_their_sources_and_spool(mocker, mock_popen):
+    """Test each worker is started with its share of sources and its own spool"""
+    mocker.patch("supervisor.SPOOL_DIR", "spool")
+    supervisor = IngestSupervisor(SOURCES, 3, ["ingest"])
+    supervisor._rebalance()
+
+    assert len(mock_popen) == 3
+    started = [url for process in mock_popen for url in process.env["SATELLITE_SOURCES"].split(",")]
+    assert len(started) == len(SOURCES)
+    assert sorted(process.env["SPOOL_DIR"] for process in mock_popen) == [
+        os.path.join("spool", f"worker-{i}") for i in range(3)]
+
+def test_workers_get_their_own_metrics_port(mocker, mock_popen):
+    """Test each worker serves metrics on a port after the supervisor's"""
+    mocker.patch("supervisor.METRICS_PORT", 8081)
+    supervisor = IngestSupervisor(SOURCES, 3, ["ingest"])
+    supervisor._rebalance()
+
+    assert sorted(process.env["METRICS_PORT"] for process in mock_popen) == ["8082", "8083", "8084"]
+
+def test_resize_restarts_only_changed_workers(mock_popen):
+    """Test growing the pool leaves workers with unchanged sources running"""
+    supervisor = IngestSupervisor(SOURCES, 3, ["ingest"])
+    supervisor._rebalance()
+    before = assign_sources(SOURCES, 3)
+    after = assign_sources(SOURCES, 4)
+
+    supervisor.resize(4)
+    supervisor._rebalance()
+
+    changed = sum(before[i] != after[i] for i in range(3))
+    assert sum(process.terminate.called for process in mock_popen[:3]) == changed
+    assert len(mock_popen) == 4 + changed
+    assert len(supervisor.workers) == 4
+
+def test_crashed_worker_is_restarted_with_backoff(mock_popen, mocker):
+    """Test a worker that exits is started again, waiting longer each time"""
+    clock = mocker.patch("supervisor.time.monotonic", return_value=100.0)
+    supervisor = IngestSupervisor(SOURCES[:1], 1, ["ingest"])
+    supervisor._rebalance()
+
+    # First crash is restarted straight away
+    mock_popen[0].poll.return_value = 1
+    supervisor._check_workers()
+    supervisor._check_workers()
+    assert len(mock_popen) == 2
+
+    # Crashing again soon after waits before restarting
+    mock_popen[1].poll.return_value = 1
+    supervisor._check_workers()
+    supervisor._check_workers()
+    assert len(mock_popen) == 2
+    clock.return_value = 101.0
+    supervisor._check_workers()
+    assert len(mock_popen) == 3
+
+def test_orphaned_spools_are_drained(mocker, mock_popen, tmp_path):
+    """Test the root spool and removed workers' spools are saved by the supervisor"""
+    mocker.patch("supervisor.SPOOL_DIR", str(tmp_path))
+    for index in range(4):
+        (tmp_path / f"worker-{index}").mkdir()
+    drain = mocker.patch("supervisor.drain_spool", return_value=1)
+
+    supervisor = IngestSupervisor(SOURCES, 3, ["ingest"])
+    supervisor._rebalance()
+    assert [call.args[0] for call in drain.call_args_list] == [str(tmp_path), str(tmp_path / "worker-3")]
+
+    # Worker 2 is removed, its spool is saved after the rebalance
+    drain.reset_mock()
+    supervisor.resize(2)
+    supervisor._rebalance()
+    assert str(tmp_path / "worker-2") in [call.args[0] for call in drain.call_args_list]
+
+def test_orphaned_spools_are_retried(mocker, mock_popen, tmp_path):
+    """Test a spool the database didn't take is tried again later"""
+    mocker.patch("supervisor.SPOOL_DIR", str(tmp_path))
+    mocker.patch("supervisor.time.monotonic", return_value=100.0)
+    mocker.patch("supervisor.drain_spool", side_effect=Exception("database down"))
+
+    supervisor = IngestSupervisor(SOURCES[:1], 1, ["ingest"])
+    supervisor._rebalance()
+
+    assert supervisor._drain_at == 100.0 + supervisor_module.ORPHAN_RETRY
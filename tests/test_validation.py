@@ -0,0 +1,54 @@
+import pytest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+
+from validation import (Snapshot, ValidationPipeline, AgeRule, TagBlacklistRule,
+                        ValueRangeRule, ACCEPTED)
+
+def test_snapshot_parses_fields_once():
+    """Test snapshots are built from data-server JSON"""
+    time_now = time.time()
+    snapshot = Snapshot.from_json({"time": time_now, "value": 12.37, "tags": ["night"]}, "sat-1")
+
+    assert snapshot.timestamp == time_now
+    assert snapshot.time.timestamp() == pytest.approx(time_now)
+    assert snapshot.as_row() == (snapshot.time, 12.37, ["night"], "sat-1")
+
+    # Slots mean no per-instance dict
+    assert not hasattr(snapshot, '__dict__')
+
+def test_malformed_snapshot_raises():
+    """Test missing or badly typed fields raise ValueError"""
+    with pytest.raises(ValueError):
+        Snapshot.from_json({"time": time.time(), "tags": ["night"]})
+    with pytest.raises(ValueError):
+        Snapshot.from_json({"time": time.time(), "value": 1.0, "tags": "night"})
+
+def test_pipeline_stops_at_first_failing_rule():
+    """Test rules run in order and the first failure is the verdict"""
+    pipeline = ValidationPipeline([AgeRule(3600), TagBlacklistRule(["system", "suspect"])])
+    now = time.time()
+
+    old = Snapshot(now - 7200, 12.37, ["system"])
+    assert pipeline.validate(old, now)[1].reason == "age"
+
+    tagged = Snapshot(now, 12.37, ["suspect", "system"])
+    snapshot, verdict = pipeline.validate(tagged, now)
+    assert snapshot is tagged
+    assert verdict.reason == "system"
+    assert verdict.message == "Invalid system tag"
+
+    assert pipeline.validate(Snapshot(now, 12.37, ["night"]), now)[1] is ACCEPTED
+
+def test_value_range_rule_can_be_added():
+    """Test new rules can be added to the pipeline"""
+    pipeline = ValidationPipeline([AgeRule(3600)])
+    pipeline.add_rule(ValueRangeRule(-50, 60))
+    now = time.time()
+
+    assert pipeline.validate(Snapshot(now, 75.0, ["day"]), now)[1].reason == "range"
+    assert pipeline.validate(Snapshot(now, -51.0, ["day"]), now)[1].reason == "range"
+    assert pipeline.validate(Snapshot(now, 20.0, ["day"]), now)[1].valid
@@ -0,0 +1,129 @@
+import time
+from datetime import datetime
+from config import MAX_SNAPSHOT_AGE, BLACKLISTED_TAGS, VALUE_MIN, VALUE_MAX
+
+# A single satellite reading, parsed once from the data-server's JSON.
+# 'source' is the URL it was polled from, so readings from different
+# satellites with the same time and tags are stored separately
+class Snapshot:
+    __slots__ = ('timestamp', 'time', 'value', 'tags', 'source')
+
+    def __init__(self, timestamp, value, tags, source=''):
+        self.timestamp = timestamp
+        self.time = datetime.fromtimestamp(timestamp)
+        self.value = value
+        self.tags = tags
+        self.source = source
+
+    # Build a snapshot from a data-server response, raising ValueError
+    # if a field is missing or the wrong type
+    @classmethod
+    def from_json(cls, data, source=''):
+        try:
+            timestamp = float(data['time'])
+            value = float(data['value'])
+            tags = data['tags']
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed snapshot {data}: {e}")
+
+        if not isinstance(tags, list):
+            raise ValueError(f"Malformed snapshot {data}: tags must be a list")
+        return cls(timestamp, value, tags, source)
+
+    # Row for the valid_snapshots table
+    def as_row(self):
+        return (self.time, self.value, self.tags, self.source)
+
+    def __repr__(self):
+        return f"{{'time': {self.timestamp}, 'value': {self.value}, 'tags': {self.tags}}}"
+
+# Result of validating a snapshot. 'reason' is None for valid snapshots,
+# otherwise it is stored with the discarded snapshot
+class Verdict:
+    __slots__ = ('reason', 'message')
+
+    def __init__(self, reason=None, message=None):
+        self.reason = reason
+        self.message = message
+
+    @property
+    def valid(self):
+        return self.reason is None
+
+ACCEPTED = Verdict()
+
+# Rules return None when a snapshot passes, or a Verdict saying why it failed
+
+# Discards snapshots older than max_age seconds
+class AgeRule:
+    __slots__ = ('max_age', 'verdict')
+
+    def __init__(self, max_age=MAX_SNAPSHOT_AGE):
+        self.max_age = max_age
+        self.verdict = Verdict('age', f'Snapshot over {max_age / 3600:g}hr old, disregard')
+
+    def check(self, snapshot, now):
+        if now - snapshot.timestamp > self.max_age:
+            return self.verdict
+        return None
+
+# Discards snapshots carrying any blacklisted tag, the first match in
+# blacklist order is used as the reason
+class TagBlacklistRule:
+    __slots__ = ('tags', 'verdicts')
+
+    def __init__(self, tags=BLACKLISTED_TAGS):
+        self.tags = tuple(tags)
+        self.verdicts = {tag: Verdict(tag, f'Invalid {tag} tag') for tag in self.tags}
+
+    def check(self, snapshot, now):
+        for tag in self.tags:
+            if tag in snapshot.tags:
+                return self.verdicts[tag]
+        return None
+
+# Discards snapshots with values outside [minimum, maximum]
+class ValueRangeRule:
+    __slots__ = ('minimum', 'maximum', 'verdict')
+
+    def __init__(self, minimum=VALUE_MIN, maximum=VALUE_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.verdict = Verdict('range', f'Value outside {minimum}..{maximum}')
+
+    def check(self, snapshot, now):
+        if self.minimum is not None and snapshot.value < self.minimum:
+            return self.verdict
+        if self.maximum is not None and snapshot.value > self.maximum:
+            return self.verdict
+        return None
+
+# Runs rules in order and stops at the first one that fails
+class ValidationPipeline:
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+    def add_rule(self, rule):
+        self.rules.append(rule)
+
+    # Returns (snapshot, verdict) ready to be passed to storage.save_snapshot
+    def validate(self, snapshot, now=None):
+        if now is None:
+            now = time.time()
+
+        for rule in self.rules:
+            verdict = rule.check(snapshot, now)
+            if verdict is not None:
+                return snapshot, verdict
+        return snapshot, ACCEPTED
+
+# Every reason a snapshot can be discarded for
+DISCARD_REASONS = tuple(sorted({'age', 'range', *BLACKLISTED_TAGS}))
+
+# Pipeline built from the .env settings, used by satellite.py
+def build_pipeline():
+    rules = [AgeRule(), TagBlacklistRule()]
+    if VALUE_MIN is not None or VALUE_MAX is not None:
+        rules.append(ValueRangeRule())
+    return ValidationPipeline(rules)